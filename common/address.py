@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Разрешение адреса "страна, регион, нас. пункт, улица" в объект Street.
+
+AddressResolver заменяет цепочки get-or-create, которые раньше были
+скопированы в каждое представление, сохраняющее адрес (журнал,
+редактирование захоронения, кладбища, инициализация, импорт CSV), и
+проверки тех же названий в формах. Найденные и созданные уровни
+запоминаются на время жизни объекта (форма - запрос, импорт - весь файл),
+поэтому представление не повторяет поиск, уже сделанный при проверке
+формы, а импорт - поиск одной и той же улицы для каждой строки. Общий
+для процесса кэш - common.geocache.
+"""
+
+from django.db import transaction
+
+import geocache
+from models import GeoCountry, GeoRegion, GeoCity, Street
+
+
+class AddressResolver(object):
+    """
+    get_* только ищут уровень (None, если его нет), country/region/city/
+    street ищут или создают, resolve разрешает весь адрес. Названия
+    создаваемых уровней пишутся с заглавной буквы, если capitalize.
+    """
+    def __init__(self, capitalize=True):
+        self.capitalize = capitalize
+        self.memo = {}
+        self.created = []
+
+    def cached(self, key, lookup, *args):
+        obj = self.memo.get(key)
+        if obj is None:
+            obj = lookup(*args)
+            if obj is not None:
+                self.memo[key] = obj
+        return obj
+
+    def get_country(self, name):
+        return self.cached(("country", name), geocache.get_country, name)
+
+    def get_region(self, country, name):
+        if country is None:
+            return None
+        return self.cached(("region", country.pk, name), geocache.get_region, country, name)
+
+    def get_city(self, region, name):
+        if region is None:
+            return None
+        return self.cached(("city", region.pk, name), geocache.get_city, region, name)
+
+    def get_street(self, city, name):
+        if city is None:
+            return None
+        return self.cached(("street", city.pk, name), geocache.get_street, city, name)
+
+    def get_city_named(self, name):
+        """
+        Нас. пункт по одному названию, в любом регионе (старый формат
+        импорта без страны и области).
+        """
+        def lookup(name):
+            cities = list(GeoCity.objects.filter(name__exact=name)[:1])
+            return cities and cities[0] or None
+        return self.cached(("city", None, name), lookup, name)
+
+    def new_name(self, name):
+        if self.capitalize:
+            return name.capitalize()
+        return name
+
+    def remember(self, key, obj):
+        obj.save()
+        self.memo[key] = obj
+        self.created.append(key)
+        return obj
+
+    def commit(self):
+        """
+        Созданные уровни сохранены в базе (транзакция закоммичена).
+        """
+        self.created = []
+
+    def rollback(self):
+        """
+        Транзакция откачена: созданные в ней уровни забываются.
+        """
+        for key in self.created:
+            self.memo.pop(key, None)
+        self.created = []
+        geocache.reset()
+
+    def country(self, name):
+        return self.get_country(name) or \
+            self.remember(("country", name), GeoCountry(name=self.new_name(name)))
+
+    def region(self, country, name):
+        return self.get_region(country, name) or \
+            self.remember(("region", country.pk, name), GeoRegion(country=country, name=self.new_name(name)))
+
+    def city(self, region, name):
+        return self.get_city(region, name) or \
+            self.remember(("city", region.pk, name), GeoCity(country_id=region.country_id, region=region,
+                                                             name=self.new_name(name)))
+
+    def street(self, city, name):
+        return self.get_street(city, name) or \
+            self.remember(("street", city.pk, name), Street(city=city, name=self.new_name(name)))
+
+    def resolve(self, country, region, city, street):
+        """
+        Street для полного адреса; недостающие уровни создаются в одной
+        транзакции (в транзакции представления, если она уже есть).
+        """
+        if transaction.is_managed():
+            return self._resolve(country, region, city, street)
+        return transaction.commit_on_success(self._resolve)(country, region, city, street)
+
+    def _resolve(self, country, region, city, street):
+        return self.street(self.city(self.region(self.country(country), region), city), street)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Подсказки для полей поиска (get_deadman, get_customer_ln) из памяти процесса.
+
+Различные ФИО захороненных и фамилии заказчиков хранятся в отсортированных
+массивах нормализованных ключей; подсказки по префиксу ищутся двоичным
+поиском (bisect), без обращения к базе. Массивы строятся из строк поиска
+(BurialSearchRow) при запуске процесса (см. wsgi.py) и перестраиваются,
+когда меняется счетчик ChangeCounter.AUTOCOMPLETE (его увеличивает
+создание и удаление захоронений и изменение ФИО людей и людей
+захоронения). Счетчик проверяется не чаще раза в
+settings.AUTOCOMPLETE_CHECK_INTERVAL секунд; индексы перестраиваются в
+отдельном потоке, до конца построения подсказки - из старых.
+"""
+
+from bisect import bisect_left
+
+from django.db import DatabaseError
+
+from models import BurialSearchRow, ChangeCounter
+from utils import ProcessCache
+
+DEADMEN = "deadmen"
+CUSTOMERS = "customers"
+
+# Подсказок в ответе.
+LIMIT = 16
+
+
+def prefix_key(value):
+    return (value or u"").lower().replace(u"ё", u"е")
+
+
+class PrefixIndex(object):
+    """
+    Отсортированный массив различных значений с поиском по префиксу.
+    """
+    def __init__(self, values):
+        pairs = sorted(set([(prefix_key(value), value) for value in values if value]))
+        self.keys = [key for key, value in pairs]
+        self.values = [value for key, value in pairs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, value):
+        key = prefix_key(value)
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key and self.values[i] < value:
+            i += 1
+        if value and (i == len(self.keys) or self.values[i] != value):
+            self.keys.insert(i, key)
+            self.values.insert(i, value)
+
+    def lookup(self, prefix, limit=LIMIT):
+        key = prefix_key(prefix)
+        i = bisect_left(self.keys, key)
+        result = []
+        while i < len(self.keys) and len(result) < limit and self.keys[i].startswith(key):
+            result.append(self.values[i])
+            i += 1
+        return result
+
+
+def build_indexes():
+    deadmen = [u"%s %s %s" % names for names in BurialSearchRow.objects
+               .values_list("last_name", "first_name", "patronymic").distinct().iterator()]
+    customers = BurialSearchRow.objects.filter(customer__isnull=False) \
+        .values_list("customer_last_name", flat=True).distinct().iterator()
+    return {DEADMEN: PrefixIndex(deadmen), CUSTOMERS: PrefixIndex(customers)}
+
+
+_indexes = ProcessCache(ChangeCounter.AUTOCOMPLETE, build_indexes, background=True)
+
+
+def lookup(name, prefix, limit=LIMIT):
+    """
+    Подсказки индекса name (DEADMEN, CUSTOMERS), начинающиеся с prefix.
+    """
+    return _indexes.get()[name].lookup(prefix, limit)
+
+
+def warm():
+    """
+    Строит индексы при запуске процесса. Если таблиц еще нет (до syncdb),
+    индексы построятся при первой подсказке.
+    """
+    try:
+        _indexes.refresh(force=True)
+    except DatabaseError:
+        pass
@@ -5,4 +5,5 @@ from django.conf import settings
 def context_processor(request):
     return {
             'global_context_SITE_READONLY': settings.SITE_READONLY,
+            'principal': getattr(request, 'principal', None),
            }
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Кэш количества найденных записей для страниц поиска.
+
+Ключ кэша строится по нормализованным условиям поиска (cleaned_data формы)
+и "поколению" данных - счетчику ChangeCounter.SEARCH_COUNT в базе, общему
+для всех процессов. Любое изменение захоронений (и того, по чему их ищут)
+увеличивает поколение, и все ранее сохраненные количества перестают
+использоваться.
+
+Для очень больших таблиц вместо COUNT(*) можно взять оценку планировщика
+PostgreSQL (pg_class.reltuples), см. estimated_count.
+"""
+
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+# Поля формы, не влияющие на количество записей.
+IGNORED_FIELDS = ("per_page", "records_order_by", "page")
+
+
+def generation():
+    from models import ChangeCounter
+    return ChangeCounter.objects.value(ChangeCounter.SEARCH_COUNT)
+
+
+def invalidate():
+    """
+    Сбрасывает все сохраненные количества.
+    """
+    from models import ChangeCounter
+    ChangeCounter.objects.bump(ChangeCounter.SEARCH_COUNT)
+
+
+def normalize_value(value):
+    if hasattr(value, "_meta"):
+        return value.pk
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, basestring):
+        return value.strip().lower()
+    return value
+
+
+def criteria_key(criteria):
+    """
+    Ключ кэша для условий поиска: пустые значения и поля, не влияющие на
+    количество, отбрасываются.
+    """
+    items = [(name, normalize_value(value)) for name, value in criteria.items()
+             if name not in IGNORED_FIELDS and value not in (None, u"", False)]
+    items.sort()
+    digest = hashlib.md5(repr(items)).hexdigest()
+    return "search_count:%s:%s" % (generation(), digest)
+
+
+def cached_count(queryset, criteria):
+    """
+    queryset.count(), сохраненный в кэше по условиям поиска criteria.
+    """
+    key = criteria_key(criteria)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, settings.SEARCH_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def estimated_count(model):
+    """
+    Оценка количества строк в таблице модели по статистике PostgreSQL.
+    Для остальных БД возвращает None.
+    """
+    if "postgresql" not in settings.DATABASES["default"]["ENGINE"]:
+        return None
+    cursor = connection.cursor()
+    cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [model._meta.db_table])
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return int(row[0])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Потоковый экспорт найденных захоронений в CSV (главная страница, кнопка
+"Экспорт CSV").
+
+Строки поиска (BurialSearchRow) читаются порциями по ключу (date_fact, uuid),
+для каждой порции связанные данные - адреса заказчиков, комментарии и
+файлы - выбираются одним запросом на каждый вид. Файл отдается по мере
+формирования, целиком в памяти не держится.
+"""
+
+import csv
+import re
+from cStringIO import StringIO
+
+from django.conf import settings
+
+from simplepagination.backends.keyset import KeysetPaginator
+from models import Soul, OrderComments, OrderFiles
+
+csv.register_dialect("4mysql", escapechar="\\", quoting=csv.QUOTE_ALL, doublequote=False)
+
+DT_TEMPLATE = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Захоронений в одной порции.
+EXPORT_CHUNK_SIZE = 500
+
+def chunks(rows, chunk=EXPORT_CHUNK_SIZE):
+    """
+    Порции строк поиска в порядке даты захоронения без OFFSET.
+    """
+    return KeysetPaginator().chunks(rows.order_by("date_fact"), chunk)
+
+
+def customer_addresses(customer_ids):
+    """
+    {uuid заказчика: данные адреса} одним запросом.
+    """
+    fields = ("location__house", "location__block", "location__flat", "location__post_index",
+              "location__building", "location__street__name", "location__street__city__name",
+              "location__street__city__region__name", "location__street__city__country__name")
+    addresses = {}
+    for values in Soul.objects.filter(pk__in=customer_ids, location__isnull=False) \
+            .values_list("pk", *fields):
+        addresses[values[0]] = dict(zip(fields, values[1:]))
+    return addresses
+
+
+def export_row(row, address, comments, files):
+    """
+    Поля строки CSV в формате, который понимает импорт (import_csv).
+    """
+    address = address or {}
+    city = address.get("location__street__city__name")
+    return [
+        u"",
+        u"%s" % (row.account_book_n, ),
+        u"%s" % (row.last_name or '', ),
+        u"%s" % (row.first_name or '', ),
+        u"%s" % (row.patronymic or '', ),
+        u"",
+        u"%s" % (row.date_fact, ),
+        u"%s" % (row.area or '', ),
+        u"%s" % (row.row or '', ),
+        u"%s" % (row.seat or '', ),
+        u"%s" % (row.customer_last_name or '', ),
+        u"%s" % (row.customer_first_name or '', ),
+        u"%s" % (row.customer_patronymic or '', ),
+        u"",
+        # Как в __unicode__ GeoCity, GeoCountry, GeoRegion.
+        u"%s" % (city and city[:24] or '', ),
+        u"%s" % (address.get("location__street__name") or '', ),
+        u"%s" % (address.get("location__house") or '', ),
+        u"%s" % (address.get("location__block") or '', ),
+        u"%s" % (address.get("location__flat") or '', ),
+        u'\t'.join([u"%s~%s" % (date_of_creation.strftime(DT_TEMPLATE), re.sub(r'\t', ' ', comment))
+                    for date_of_creation, comment in comments]),
+        # в дополнение к "старому" формату экспорта
+        u"%s" % (city and address.get("location__street__city__country__name")[:16] or '', ),
+        u"%s" % (city and address.get("location__street__city__region__name")[:24] or '', ),
+        u"%s" % (row.customer_phones or '', ),
+        u'\n'.join([ofile for ofile, comment in files]),
+        u'\t'.join([comment for ofile, comment in files]),
+        u"%s" % (address.get("location__post_index") or '', ),
+        u"%s" % (address.get("location__building") or '', ),
+        u"%s" % (row.op_type[:24], ),
+    ]
+
+
+def export_csv(rows, chunk=EXPORT_CHUNK_SIZE):
+    """
+    Генератор кусков CSV-файла (по одному на порцию захоронений) для
+    строк поиска rows. На порцию - четыре запроса.
+    """
+    dialect = csv.get_dialect("4mysql")
+    for page in chunks(rows, chunk):
+        ids = [row.pk for row in page]
+        addresses = customer_addresses(set([row.customer_id for row in page]))
+        comments = {}
+        for order_id, date_of_creation, comment in OrderComments.objects.filter(order__in=ids) \
+                .values_list("order", "date_of_creation", "comment"):
+            comments.setdefault(order_id, []).append((date_of_creation, comment))
+        files = {}
+        for order_id, ofile, comment in OrderFiles.objects.filter(order__in=ids) \
+                .values_list("order", "ofile", "comment"):
+            files.setdefault(order_id, []).append((ofile, comment))
+
+        io = StringIO()
+        writer = csv.writer(io, dialect)
+        for row in page:
+            values = export_row(row, addresses.get(row.customer_id), comments.get(row.pk, []),
+                                files.get(row.pk, []))
+
+            # Из документации по Python 2, https://docs.python.org/2/library/csv.html :
+            # Dialect.escapechar
+            #   A one-character string used by the writer to escape the delimiter
+            #   if quoting is set to QUOTE_NONE and the quotechar if doublequote is False.
+            #   On reading, the escapechar removes any special meaning from the following character.
+            #   It defaults to None, which disables escaping.
+            # Т.е. escapechar экранирует (1) разделитель между полями, (2) кавычку.
+            # Сам себя escapechar, согласно документации, при записи экранировать не обязан.
+            # А вот при чтении '123\45' преобразуется в 12345, т.е. теряется символ,
+            # но самое страшное, '"поле1\","поле2"' (escapechar '\' завершает поле1)
+            # становится 'поле1",поле2', т.е. теряется поле
+            # Python 3 ведет себя аналогично.
+
+            if dialect.escapechar:
+                values = [v.replace(dialect.escapechar, dialect.escapechar * 2) for v in values]
+
+            writer.writerow([v.encode(settings.CSV_ENCODING) for v in values])
+        yield io.getvalue()
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from models import Cemetery, GeoCountry, GeoRegion, Organization, GeoCity, Phone, Operation, Street, Role, OrderComments
 from models import SoulProducttypeOperation
+from address import AddressResolver
 
 from annoying.decorators import autostrip
 
@@ -71,12 +72,25 @@ class CalendarWidget(forms.TextInput):
         super(CalendarWidget, self).__init__(attrs=attrs)
 
 
+class AddressFormMixin(object):
+    """
+    Форма с адресом: названия, найденные при проверке, представление
+    берет из того же AddressResolver (form.resolver), без повторных запросов.
+    """
+    @property
+    def resolver(self):
+        if not hasattr(self, "_resolver"):
+            self._resolver = AddressResolver()
+        return self._resolver
+
+
 @autostrip
 class SearchForm(forms.Form):
     """
     Форма поиска на главной странице.
     """
     fio = forms.CharField(required=False, max_length=100, label="ФИО")
+    fio_phonetic = forms.BooleanField(required=False, label="фамилия похожа по звучанию")
     cemetery = forms.ModelChoiceField(required=False, queryset=Cemetery.objects.order_by("name"),
                                       empty_label="Все", label="Кладбища")
     burial_date_from = forms.DateField(required=False, label="Дата захоронения с", widget=CalendarWidget)
@@ -105,7 +119,7 @@ class SearchForm(forms.Form):
 
 
 @autostrip
-class JournalForm(forms.Form):
+class JournalForm(AddressFormMixin, forms.Form):
     """
     Форма журнала - создания нового захоронения.
     """
@@ -217,9 +231,8 @@ class JournalForm(forms.Form):
         flat = cd.get("customer_flat", "")
         if country and region and city and street:
             # Страна.
-            try:
-                country_object = GeoCountry.objects.filter(name__exact=country)[0]
-            except IndexError:
+            country_object = self.resolver.get_country(country)
+            if country_object is None:
                 if not cd.get("new_country", False):
                     raise forms.ValidationError("Страна не найдена.")
                 else:
@@ -232,9 +245,8 @@ class JournalForm(forms.Form):
             # Регион.
             if new_country and not cd.get("new_region", False):
                 raise forms.ValidationError("У новой страны регион должен быть тоже новым.")
-            try:
-                region_object = GeoRegion.objects.filter(country__name__exact=country, name__exact=region)[0]
-            except IndexError:
+            region_object = self.resolver.get_region(country_object, region)
+            if region_object is None:
                 if not cd.get("new_region", False):
                     raise forms.ValidationError("Регион не найден.")
                 else:
@@ -247,9 +259,8 @@ class JournalForm(forms.Form):
             # Нас. пункт.
             if new_region and not cd.get("new_city", False):
                 raise forms.ValidationError("У нового региона нас. пункт должен быть тоже новым.")
-            try:
-                city_object = GeoCity.objects.filter(region__name__exact=region, name__exact=city)[0]
-            except IndexError:
+            city_object = self.resolver.get_city(region_object, city)
+            if city_object is None:
                 if not cd.get("new_city", False):
                     raise forms.ValidationError("Нас. пункт не найден.")
                 else:
@@ -262,9 +273,8 @@ class JournalForm(forms.Form):
             # Улица.
             if new_city and not cd.get("new_street", False):
                 raise forms.ValidationError("У нового нас. пункта улица должна быть тоже новой.")
-            try:
-                street_object = Street.objects.filter(city__name__exact=city, name__exact=street)[0]
-            except IndexError:
+            street_object = self.resolver.get_street(city_object, street)
+            if street_object is None:
                 if not cd.get("new_street", False):
                     raise forms.ValidationError("Улица не найдена.")
             else:
@@ -283,7 +293,7 @@ class JournalForm(forms.Form):
 
 
 @autostrip
-class EditBurialForm(forms.Form):
+class EditBurialForm(AddressFormMixin, forms.Form):
     account_book_n = forms.CharField(max_length=16, label="Номер в книге учета*",
                                      widget=forms.TextInput(attrs={"tabindex": "1"}))
     burial_date = forms.DateField(label="Дата захоронения*",
@@ -377,9 +387,8 @@ class EditBurialForm(forms.Form):
         flat =  cd.get("customer_flat", "")
         if country and region and city and street:
             # Страна.
-            try:
-                country_object = GeoCountry.objects.filter(name__exact=country)[0]
-            except IndexError:
+            country_object = self.resolver.get_country(country)
+            if country_object is None:
                 if not cd.get("new_country", False):
                     raise forms.ValidationError("Страна не найдена.")
                 else:
@@ -392,9 +401,8 @@ class EditBurialForm(forms.Form):
             # Регион.
             if new_country and not cd.get("new_region", False):
                 raise forms.ValidationError("У новой страны регион должен быть тоже новым.")
-            try:
-                region_object = GeoRegion.objects.filter(country__name__exact=country, name__exact=region)[0]
-            except IndexError:
+            region_object = self.resolver.get_region(country_object, region)
+            if region_object is None:
                 if not cd.get("new_region", False):
                     raise forms.ValidationError("Регион не найден.")
                 else:
@@ -407,9 +415,8 @@ class EditBurialForm(forms.Form):
             # Нас. пункт.
             if new_region and not cd.get("new_city", False):
                 raise forms.ValidationError("У нового региона нас. пункт должен быть тоже новым.")
-            try:
-                city_object = GeoCity.objects.filter(region__name__exact=region, name__exact=city)[0]
-            except IndexError:
+            city_object = self.resolver.get_city(region_object, city)
+            if city_object is None:
                 if not cd.get("new_city", False):
                     raise forms.ValidationError("Нас. пункт не найден.")
                 else:
@@ -422,9 +429,8 @@ class EditBurialForm(forms.Form):
             # Улица.
             if new_city and not cd.get("new_street", False):
                 raise forms.ValidationError("У нового нас. пункта улица должна быть тоже новой.")
-            try:
-                street_object = Street.objects.filter(city__name__exact=city, name__exact=street)[0]
-            except IndexError:
+            street_object = self.resolver.get_street(city_object, street)
+            if street_object is None:
                 if not cd.get("new_street", False):
                     raise forms.ValidationError("Улица не найдена.")
             else:
@@ -473,7 +479,7 @@ class OrderCommentForm(forms.Form):
         return cd
 
 @autostrip
-class InitalForm(forms.Form):
+class InitalForm(AddressFormMixin, forms.Form):
     """
     Форма ввода данных для инициализации системы.
     """
@@ -550,9 +556,8 @@ class InitalForm(forms.Form):
         street = cd.get("street", "")
         if country and region and city and street:
             # Страна.
-            try:
-                country_object = GeoCountry.objects.get(name__exact=country)
-            except ObjectDoesNotExist:
+            country_object = self.resolver.get_country(country)
+            if country_object is None:
                 if not cd.get("new_country", False):
                     raise forms.ValidationError("Организация: страна не найдена.")
                 else:
@@ -565,9 +570,8 @@ class InitalForm(forms.Form):
             # Регион.
             if new_country and not cd.get("new_region", False):
                 raise forms.ValidationError("Организация: у новой страны регион должен быть тоже новым.")
-            try:
-                region_object = GeoRegion.objects.get(country__name__exact=country, name__exact=region)
-            except ObjectDoesNotExist:
+            region_object = self.resolver.get_region(country_object, region)
+            if region_object is None:
                 if not cd.get("new_region", False):
                     raise forms.ValidationError("Организация: регион не найден.")
                 else:
@@ -580,9 +584,8 @@ class InitalForm(forms.Form):
             # Нас. пункт.
             if new_region and not cd.get("new_city", False):
                 raise forms.ValidationError("Организация: у нового региона нас. пункт должен быть тоже новым.")
-            try:
-                city_object = GeoCity.objects.get(region__name__exact=region, name__exact=city)
-            except ObjectDoesNotExist:
+            city_object = self.resolver.get_city(region_object, city)
+            if city_object is None:
                 if not cd.get("new_city", False):
                     raise forms.ValidationError("Организация: нас. пункт не найден.")
                 else:
@@ -595,9 +598,8 @@ class InitalForm(forms.Form):
             # Улица.
             if new_city and not cd.get("new_street", False):
                 raise forms.ValidationError("Организация: у нового нас. пункта улица должна быть тоже новой.")
-            try:
-                street_object = Street.objects.get(city__name__exact=city, name__exact=street)
-            except ObjectDoesNotExist:
+            street_object = self.resolver.get_street(city_object, street)
+            if street_object is None:
                 if not cd.get("new_street", False):
                     raise forms.ValidationError("Организация: улица не найдена.")
             else:
@@ -614,9 +616,8 @@ class InitalForm(forms.Form):
         cem_street = cd.get("cem_street", "")
         if cem_country and cem_region and cem_city and cem_street:
             # Страна.
-            try:
-                cem_country_object = GeoCountry.objects.get(name__exact=cem_country)
-            except ObjectDoesNotExist:
+            cem_country_object = self.resolver.get_country(cem_country)
+            if cem_country_object is None:
                 if not cd.get("cem_new_country", False):
                     raise forms.ValidationError("Кладбище: страна не найдена.")
                 else:
@@ -629,9 +630,8 @@ class InitalForm(forms.Form):
             # Регион.
             if cem_new_country and not cd.get("cem_new_region", False):
                 raise forms.ValidationError("Кладбище: у новой страны регион должен быть тоже новым.")
-            try:
-                cem_region_object = GeoRegion.objects.get(country__name__exact=cem_country, name__exact=cem_region)
-            except ObjectDoesNotExist:
+            cem_region_object = self.resolver.get_region(cem_country_object, cem_region)
+            if cem_region_object is None:
                 if not cd.get("cem_new_region", False):
                     raise forms.ValidationError("Кладбище: регион не найден.")
                 else:
@@ -644,9 +644,8 @@ class InitalForm(forms.Form):
             # Нас. пункт.
             if cem_new_region and not cd.get("cem_new_city", False):
                 raise forms.ValidationError("Кладбище: у нового региона нас. пункт должен быть тоже новым.")
-            try:
-                cem_city_object = GeoCity.objects.get(region__name__exact=cem_region, name__exact=cem_city)
-            except ObjectDoesNotExist:
+            cem_city_object = self.resolver.get_city(cem_region_object, cem_city)
+            if cem_city_object is None:
                 if not cd.get("cem_new_city", False):
                     raise forms.ValidationError("Кладбище: нас. пункт не найден.")
                 else:
@@ -659,9 +658,8 @@ class InitalForm(forms.Form):
             # Улица.
             if cem_new_city and not cd.get("cem_new_street", False):
                 raise forms.ValidationError("Кладбище: у нового нас. пункта улица должна быть тоже новой.")
-            try:
-                cem_street_object = Street.objects.get(city__name__exact=cem_city, name__exact=cem_street)
-            except ObjectDoesNotExist:
+            cem_street_object = self.resolver.get_street(cem_city_object, cem_street)
+            if cem_street_object is None:
                 if not cd.get("cem_new_street", False):
                     raise forms.ValidationError("Кладбище: улица не найдена.")
             else:
@@ -682,10 +680,12 @@ class ImportForm(forms.Form):
     creator = forms.ModelChoiceField(required=True, queryset=User.objects.all(), label="Создатель")
     cemetery = forms.ModelChoiceField(queryset = Cemetery.objects.all(), label="Кладбище")
     csv_file = forms.FileField(label="CSV файл")
+    validate_only = forms.BooleanField(required=False, label="Только проверить",
+                                       help_text="Отчет об ошибках в файле без импорта")
 
 
 @autostrip
-class CemeteryForm(forms.Form):
+class CemeteryForm(AddressFormMixin, forms.Form):
     """
     Форма создания кладбища.
     """
@@ -730,36 +730,32 @@ class CemeteryForm(forms.Form):
         if (house or block or building) and not street:
             raise forms.ValidationError("Отсутствует улица.")
         if country:
-            try:
-                country_obj = GeoCountry.objects.get(name=country)
-            except ObjectDoesNotExist:
+            country_obj = self.resolver.get_country(country)
+            if country_obj is None:
                 if not new_country:
                     raise forms.ValidationError("Указанная страна не существует.")
             if new_country:
                 if not new_region:
                     raise forms.ValidationError("Указанный регион не существует.")
             else:
-                try:
-                    region_obj = GeoRegion.objects.get(country=country_obj, name=region)
-                except ObjectDoesNotExist:
+                region_obj = self.resolver.get_region(country_obj, region)
+                if region_obj is None:
                     if not new_region:
                         raise forms.ValidationError("Указанный регион не существует.")
             if new_region:
                 if not new_city:
                     raise forms.ValidationError("Указанный нас. пункт не существует.")
             else:
-                try:
-                    city_obj = GeoCity.objects.get(country=country_obj, region=region_obj, name=city)
-                except ObjectDoesNotExist:
+                city_obj = self.resolver.get_city(region_obj, city)
+                if city_obj is None:
                     if not new_city:
                         raise forms.ValidationError("Указанный нас. пункт не существует.")
             if new_city:
                 if not new_street:
                     raise forms.ValidationError("Указанная улица не существует.")
             else:
-                try:
-                    street_obj = Street.objects.get(city=city_obj, name=street)
-                except ObjectDoesNotExist:
+                street_obj = self.resolver.get_street(city_obj, street)
+                if street_obj is None:
                     if not new_street:
                         raise forms.ValidationError("Указанная улица не существует.")
         return cd
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Справочник адресов (страна -> регион -> нас. пункт -> улица) в памяти
+процесса.
+
+Дерево (uuid и названия всех уровней) строится четырьмя запросами и
+перестраивается, когда меняется счетчик ChangeCounter.GEO (его увеличивает
+сохранение и удаление GeoCountry, GeoRegion, GeoCity и Street). Из него
+отвечают подсказки get_countries/get_regions/get_cities/get_street и
+разрешаются названия в объекты при проверке форм и сохранении адресов.
+
+Если название в дереве не найдено, оно ищется в базе: объект мог быть
+только что создан другим процессом, а повторное создание нарушило бы
+уникальность.
+"""
+
+from autocomplete import PrefixIndex
+from models import ChangeCounter, GeoCountry, GeoRegion, GeoCity, Street
+from utils import ProcessCache
+
+# Подсказок в ответе.
+COUNTRIES_LIMIT = 8
+LIMIT = 24
+
+
+class GeoTree(object):
+    """
+    uuid и названия всех уровней, поиск по названию внутри родителя и
+    индексы подсказок для каждого уровня.
+    """
+    def __init__(self):
+        self.countries = dict(GeoCountry.objects.values_list("pk", "name").iterator())
+        self.regions = {}
+        for pk, country_id, name in GeoRegion.objects.values_list("pk", "country", "name").iterator():
+            self.regions[pk] = (country_id, name)
+        self.cities = {}
+        for pk, country_id, region_id, name in GeoCity.objects \
+                .values_list("pk", "country", "region", "name").iterator():
+            self.cities[pk] = (country_id, region_id, name)
+        self.streets = {}
+        for pk, city_id, name in Street.objects.values_list("pk", "city", "name").iterator():
+            self.streets[pk] = (city_id, name)
+
+        self.country_ids = dict([(name, pk) for pk, name in self.countries.iteritems()])
+        self.region_ids = dict([(value, pk) for pk, value in self.regions.iteritems()])
+        self.city_ids = dict([((region_id, name), pk)
+                              for pk, (country_id, region_id, name) in self.cities.iteritems()])
+        self.street_ids = dict([(value, pk) for pk, value in self.streets.iteritems()])
+
+        self.country_index = PrefixIndex(self.countries.values())
+        self.region_index = PrefixIndex([self.region_path(pk) for pk in self.regions])
+        self.city_index = PrefixIndex([self.city_path(pk) for pk in self.cities])
+        self.street_index = PrefixIndex([self.street_path(pk) for pk in self.streets])
+
+    def add(self, obj):
+        """
+        Добавляет только что созданный объект любого уровня.
+        """
+        if isinstance(obj, GeoCountry):
+            self.countries[obj.pk] = obj.name
+            self.country_ids[obj.name] = obj.pk
+            self.country_index.add(obj.name)
+        elif isinstance(obj, GeoRegion):
+            self.regions[obj.pk] = (obj.country_id, obj.name)
+            self.region_ids[(obj.country_id, obj.name)] = obj.pk
+            self.region_index.add(self.region_path(obj.pk))
+        elif isinstance(obj, GeoCity):
+            self.cities[obj.pk] = (obj.country_id, obj.region_id, obj.name)
+            self.city_ids[(obj.region_id, obj.name)] = obj.pk
+            self.city_index.add(self.city_path(obj.pk))
+        elif isinstance(obj, Street):
+            self.streets[obj.pk] = (obj.city_id, obj.name)
+            self.street_ids[(obj.city_id, obj.name)] = obj.pk
+            self.street_index.add(self.street_path(obj.pk))
+
+    def region_path(self, pk):
+        country_id, name = self.regions[pk]
+        return u"%s/%s" % (name, self.countries.get(country_id, u""))
+
+    def city_path(self, pk):
+        country_id, region_id, name = self.cities[pk]
+        if region_id not in self.regions:
+            return u"%s//" % name
+        return u"%s/%s" % (name, self.region_path(region_id))
+
+    def street_path(self, pk):
+        city_id, name = self.streets[pk]
+        if city_id not in self.cities:
+            return u"%s///" % name
+        return u"%s/%s" % (name, self.city_path(city_id))
+
+_tree = ProcessCache(ChangeCounter.GEO, GeoTree)
+
+
+def tree():
+    return _tree.get()
+
+
+def reset():
+    """
+    Сбрасывает дерево процесса.
+    """
+    _tree.reset()
+
+
+def changed(obj, created=False):
+    """
+    Справочник изменен в этом процессе: новый объект добавляется в дерево
+    (при вводе адреса уровни создаются один за другим, и перестраивать
+    дерево после каждого незачем), после переименования или удаления
+    дерево строится заново.
+    """
+    if created and _tree.data is not None:
+        _tree.data.add(obj)
+    else:
+        reset()
+
+
+def find(model, **kwargs):
+    """
+    Объект, не найденный в дереве, - из базы (или None). Найденный объект
+    означает, что дерево устарело.
+    """
+    objects = list(model.objects.filter(**kwargs)[:1])
+    if not objects:
+        return None
+    reset()
+    return objects[0]
+
+
+def get_country(name):
+    pk = tree().country_ids.get(name)
+    if pk is None:
+        return find(GeoCountry, name=name)
+    return GeoCountry(uuid=pk, name=name)
+
+
+def get_region(country, name):
+    if country is None:
+        return None
+    pk = tree().region_ids.get((country.pk, name))
+    if pk is None:
+        return find(GeoRegion, country=country, name=name)
+    return GeoRegion(uuid=pk, country_id=country.pk, name=name)
+
+
+def get_city(region, name):
+    if region is None:
+        return None
+    geo = tree()
+    pk = geo.city_ids.get((region.pk, name))
+    if pk is None:
+        return find(GeoCity, region=region, name=name)
+    return GeoCity(uuid=pk, country_id=geo.cities[pk][0], region_id=region.pk, name=name)
+
+
+def get_street(city, name):
+    if city is None:
+        return None
+    pk = tree().street_ids.get((city.pk, name))
+    if pk is None:
+        return find(Street, city=city, name=name)
+    return Street(uuid=pk, city_id=city.pk, name=name)
@@ -0,0 +1,859 @@
+# -*- coding: utf-8 -*-
+
+"""
+Импорт захоронений из CSV (формат экспорта, см. csvexport).
+
+Строки файла обрабатываются порциями по IMPORT_CHUNK_SIZE: порция
+разбирается целиком, справочные данные (операции, тип места, места
+порции, адреса) выбираются сразу для всей порции и запоминаются, затем
+все строки порции вставляются в одной транзакции многострочными INSERT
+(QuerySet.bulk_create) - по нескольку запросов на таблицу, а не на строку.
+bulk_create не вызывает save() и не посылает сигналов, поэтому ключи
+поиска, n-граммы, строки поиска, журнал изменений и счетчики порции
+обновляются здесь же.
+Если порция не сохранилась, она откатывается и повторяется построчно -
+так, как импорт работал раньше: каждая строка в своей транзакции, строки
+с ошибками попадают в отчет.
+
+Импортер сам коммитит и откатывает транзакции, поэтому вызывается под
+transaction.commit_manually.
+
+Файлы импортируются в фоне: представление сохраняет загруженный файл и
+создает задание ImportJob, процесс manage.py run_import_jobs выполняет
+задания (run_job) и после каждой порции записывает в задание ход импорта.
+Большие файлы можно импортировать на нескольких процессах
+(ParallelImporter, настройка IMPORT_PROCESSES) или, на PostgreSQL, через
+COPY и запросы над всем файлом (common.pgimport, IMPORT_BACKEND = "copy").
+CsvValidator проверяет файл теми же правилами разбора, ничего не записывая.
+"""
+
+import csv
+import datetime
+import multiprocessing
+import operator
+import os
+import re
+import traceback
+import zlib
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction, reset_queries, DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+import counts
+from address import AddressResolver
+from csvexport import DT_TEMPLATE
+from models import Person, Location, Phone, Place, ProductType, Burial, Operation, OrderComments
+from models import OrderFiles, SearchGram, BurialSearchRow, ChangeCounter, ChangeLog, ImportJob
+from search import comment_key
+
+# Строк файла в одной порции.
+IMPORT_CHUNK_SIZE = 200
+
+# Номеров в книге учета в одном запросе проверки.
+VALIDATE_CHUNK_SIZE = 500
+
+# Мест в одном запросе PlaceCache.prefetch: по три параметра на место, а
+# SQLite принимает не больше 999 параметров.
+PLACE_PREFETCH_CHUNK_SIZE = 300
+
+# Колонок в строке импорта старого формата и добавленных позже.
+N_ITEMS = 20
+N_ITEMS_PLUS = 8
+
+# Колонки строки импорта (см. parse_row).
+COLUMNS = ("str_id", "n", "ln", "fn", "ptrc", "initials", "bur_date", "area", "row", "seat",
+           "cust_ln", "cust_fn", "cust_ptrc", "cust_initials", "city", "street", "house", "block", "flat", "comment",
+           "country", "region", "phone", "files", "file_comments", "post_index", "building", "op_type")
+
+UNKNOWN = u"НЕИЗВЕСТЕН"
+
+# Вид операции по колонке op_type: (текст, сравнивать только начало,
+# операция). Проверяются по порядку.
+OP_TYPES = (
+    (u"захоронение", False, "OPER_1"),
+    (u"урна", False, "OPER_5"),
+    (u"захоронение детское", False, "OPER_6"),
+    (u"захоронение в существ", True, "OPER_3"),
+    (u"почетное захоронение", False, "OPER_2"),
+    (u"подзахоронен", True, "OPER_4"),
+)
+# Вид операции по тексту комментария, если колонки op_type нет.
+COMMENT_OP_TYPES = (
+    (u"захоронение детское", "OPER_6"),
+    (u"захоронение в существ", "OPER_3"),
+    (u"почетное захоронение", "OPER_2"),
+    (u"подзахоронение", "OPER_4"),
+    (u"захоронение", "OPER_1"),
+    (u"урна", "OPER_5"),
+)
+
+
+def decode(value):
+    return value.decode(settings.CSV_ENCODING).strip()
+
+
+def name_value(value, null=u""):
+    """
+    Фамилия, имя, отчество: "N" - NULL в исходной базе.
+    """
+    if value == "N":
+        return null
+    return decode(value).capitalize()
+
+
+def lower_value(value):
+    if value == "N":
+        return u""
+    return decode(value).lower()
+
+
+def no_yo(value):
+    return value.replace(u"ё", u"е").replace(u"Ё", u"Е")
+
+
+def split_names(first_name, patronymic, initials):
+    """
+    Имя и отчество; если имени нет - из инициалов.
+    """
+    if first_name:
+        return first_name, first_name and patronymic or u""
+    initials = re.sub(r"[\.\,]", " ", initials.strip()).split()
+    return (initials and initials[0] or u""), (len(initials) > 1 and initials[1] or u"")
+
+
+def op_type_operation(op_type):
+    """
+    Имя настройки операции для значения колонки op_type; None, если вид
+    операции неизвестен.
+    """
+    for text, prefix, oper in OP_TYPES:
+        if op_type == text or prefix and op_type.startswith(text):
+            return oper
+    return None
+
+
+def operation_name(op_type, comment):
+    """
+    Имя настройки (OPER_1...) с uuid операции для строки.
+    """
+    name = "OPER_1"
+    if op_type:
+        name = op_type_operation(op_type) or name
+    elif comment:
+        text = comment.lower()
+        for fragment, oper in COMMENT_OP_TYPES:
+            if fragment in text:
+                name = oper
+                break
+    return name
+
+
+def check_layout(line):
+    """
+    В строке 20 колонок (старый формат) или 28.
+    """
+    if len(line) not in (N_ITEMS, N_ITEMS + N_ITEMS_PLUS):
+        raise ValueError("Wrong number of columns: %d" % len(line))
+
+
+def parse_row(line):
+    """
+    Значения строки CSV (список байтовых строк) в виде словаря.
+    Ошибка формата - исключение.
+    """
+    check_layout(line)
+    (str_id, n, ln, fn, ptrc, initials, bur_date, area, row, seat,
+     cust_ln, cust_fn, cust_ptrc, cust_initials,
+     city, street, house, block, flat, comment) = line[0:N_ITEMS]
+    country, region, phone, files, file_comments, post_index, building, op_type = [""] * N_ITEMS_PLUS
+    if len(line) > N_ITEMS:
+        (country, region, phone, files, file_comments,
+         post_index, building, op_type) = line[N_ITEMS:N_ITEMS + N_ITEMS_PLUS]
+
+    values = {}
+    values["account_book_n"] = decode(n).lower()
+    values["last_name"] = no_yo(name_value(ln))
+    values["first_name"], values["patronymic"] = split_names(
+        name_value(fn), name_value(ptrc), initials != "N" and decode(initials).upper() or u"")
+    try:
+        values["date_fact"] = datetime.datetime.strptime(bur_date[0:10], "%Y-%m-%d")
+    except ValueError:
+        values["date_fact"] = datetime.datetime.strptime(bur_date[0:10], "%d.%m.%Y")
+    # В нижнем регистре, как их сохраняет Place.save(): иначе место не
+    # найдется по ключу и ключи сортировки посчитаются не от того значения.
+    values["area"] = area == "N" and u"0" or decode(area).lower()
+    values["row"] = row == "N" and u"0" or decode(row).lower()
+    values["seat"] = seat == "N" and u"0" or decode(seat).lower()
+
+    values["customer_last_name"] = no_yo(name_value(cust_ln, UNKNOWN))
+    values["customer_first_name"], values["customer_patronymic"] = split_names(
+        name_value(cust_fn), name_value(cust_ptrc),
+        cust_initials != "N" and decode(cust_initials).upper() or u"")
+
+    city = name_value(city, UNKNOWN) or UNKNOWN
+    street = street != "N" and no_yo(decode(street).capitalize()) or u""
+    values["street"] = street
+    if street:
+        country = decode(country).capitalize()
+        region = decode(region).capitalize()
+        if country and not region:
+            region = UNKNOWN.capitalize()
+        if region and not country:
+            country = UNKNOWN
+        values["country"], values["region"], values["city"] = country, region, city
+    values["house"] = lower_value(house)
+    values["block"] = lower_value(block)
+    values["flat"] = lower_value(flat)
+    values["post_index"] = decode(post_index).lower()
+    values["building"] = decode(building).lower()
+    values["phones"] = [p for p in [decode(p) for p in phone.split("\n")] if p]
+
+    comment = comment != "N" and no_yo(decode(comment)) or u""
+    op_type = op_type and decode(op_type).lower() or u""
+    values["op_type"] = op_type
+    values["operation"] = operation_name(op_type, comment)
+    comments = []
+    if comment:
+        for c in comment.split("\t"):
+            try:
+                i_sep = c.index(u"~")
+                comments.append((datetime.datetime.strptime(c[:i_sep], DT_TEMPLATE), c[i_sep + 1:]))
+            except ValueError:
+                comments.append((None, c))
+    values["comments"] = comments
+
+    files = files.split("\n")
+    file_comments = file_comments.split("\t")[:len(files)]
+    values["files"] = [(decode(f), i < len(file_comments) and decode(file_comments[i]) or u"")
+                       for i, f in enumerate(files) if decode(f)]
+    return values
+
+
+def field_lengths():
+    """
+    Наибольшие длины значений строки: ((ключ значений, длина), ...) - по
+    полям моделей, в которые они записываются.
+    """
+    fields = (
+        ("account_book_n", Burial, "account_book_n"),
+        ("last_name", Person, "last_name"),
+        ("first_name", Person, "first_name"),
+        ("patronymic", Person, "patronymic"),
+        ("customer_last_name", Person, "last_name"),
+        ("customer_first_name", Person, "first_name"),
+        ("customer_patronymic", Person, "patronymic"),
+        ("area", Place, "area"),
+        ("row", Place, "row"),
+        ("seat", Place, "seat"),
+        ("house", Location, "house"),
+        ("block", Location, "block"),
+        ("building", Location, "building"),
+        ("flat", Location, "flat"),
+        ("post_index", Location, "post_index"),
+    )
+    return [(key, model._meta.get_field(field).max_length) for key, model, field in fields]
+
+
+class PlaceCache(object):
+    """
+    Места кладбища по (участок, ряд, место): места порции выбираются одним
+    запросом, созданные запоминаются до коммита.
+    """
+    def __init__(self, cemetery, creator):
+        self.cemetery = cemetery
+        self.creator = creator
+        self.places = {}
+        self.created = []
+        self.p_type = None
+
+    def prefetch(self, keys):
+        """
+        Выбирает места по точным ключам (участок, ряд, место), порциями по
+        PLACE_PREFETCH_CHUNK_SIZE ключей на запрос.
+        """
+        keys = list(set(keys) - set(self.places))
+        for start in xrange(0, len(keys), PLACE_PREFETCH_CHUNK_SIZE):
+            condition = reduce(operator.or_, [Q(area=area, row=row, seat=seat) for area, row, seat
+                                              in keys[start:start + PLACE_PREFETCH_CHUNK_SIZE]])
+            for place in Place.objects.filter(condition, cemetery=self.cemetery):
+                self.places[(place.area, place.row, place.seat)] = place
+
+    def get(self, area, row, seat):
+        key = (area, row, seat)
+        place = self.places.get(key)
+        if place is None:
+            self.prefetch([key])
+            place = self.places.get(key)
+        if place is None:
+            if self.p_type is None:
+                self.p_type = ProductType.objects.get(uuid=settings.PLACE_PRODUCTTYPE_ID)
+            # Название обрезается по длине поля, как и при импорте через COPY.
+            name = u"%s.уч%sряд%sместо%s" % (self.cemetery.name, area, row, seat)
+            place = Place(creator=self.creator, cemetery=self.cemetery, area=area, row=row, seat=seat,
+                          soul=self.cemetery.organization.soul_ptr, p_type=self.p_type,
+                          name=name[:Place._meta.get_field("name").max_length])
+            place.save()
+            self.places[key] = place
+            self.created.append(key)
+        return place
+
+    def commit(self):
+        self.created = []
+
+    def rollback(self):
+        for key in self.created:
+            self.places.pop(key, None)
+        self.created = []
+
+
+class CsvImporter(object):
+    """
+    Импорт строк CSV на кладбище cemetery от имени creator (Soul).
+    После run(): good_nr, bad_nr, bad_lines (исходные строки с ошибками) и
+    errors (описания ошибок). progress(importer), если задан, вызывается
+    после каждой порции.
+    """
+    def __init__(self, cemetery, creator, chunk=IMPORT_CHUNK_SIZE, progress=None):
+        self.cemetery = cemetery
+        self.creator = creator
+        self.chunk = chunk
+        self.progress = progress
+        self.resolver = AddressResolver(capitalize=False)
+        self.places = PlaceCache(cemetery, creator)
+        self.operations = None
+        self.good_nr = 0
+        self.bad_nr = 0
+        self.bad_lines = []
+        self.errors = []
+
+    def run(self, reader):
+        chunk = []
+        for line in reader:
+            if not line:
+                continue
+            chunk.append(line)
+            if len(chunk) >= self.chunk:
+                self.import_chunk(chunk)
+                self.report_progress()
+                chunk = []
+        if chunk:
+            self.import_chunk(chunk)
+            self.report_progress()
+
+    def report_progress(self):
+        if self.progress is not None:
+            self.progress(self)
+
+    def fail(self, line, error):
+        self.bad_lines.append(line)
+        self.errors.append(error)
+        self.bad_nr += 1
+
+    def commit(self):
+        transaction.commit()
+        self.resolver.commit()
+        self.places.commit()
+
+    def rollback(self):
+        transaction.rollback()
+        self.resolver.rollback()
+        self.places.rollback()
+
+    def import_chunk(self, lines):
+        parsed = []
+        for line in lines:
+            try:
+                parsed.append((line, parse_row(line)))
+            except Exception, error:
+                self.fail(line, error)
+        self.import_parsed(parsed)
+
+    def import_parsed(self, parsed):
+        """
+        Сохраняет порцию разобранных строк ((строка, значения), ...).
+        """
+        reset_queries()
+        if not parsed:
+            return
+        try:
+            self.prepare([values for line, values in parsed])
+            self.save_chunk([values for line, values in parsed])
+        except Exception:
+            # Порция не сохранилась - повторяем построчно, чтобы найти
+            # строки с ошибками.
+            self.rollback()
+        else:
+            self.commit()
+            self.good_nr += len(parsed)
+            return
+        for line, values in parsed:
+            try:
+                self.save_row(values)
+            except Exception, error:
+                self.rollback()
+                self.fail(line, error)
+            else:
+                self.commit()
+                self.good_nr += 1
+
+    def prepare(self, rows):
+        """
+        Справочные данные для порции.
+        """
+        if self.operations is None:
+            names = [name for text, prefix, name in OP_TYPES]
+            operations = Operation.objects.in_bulk([getattr(settings, name) for name in names])
+            self.operations = dict([(name, operations.get(getattr(settings, name))) for name in names])
+        self.places.prefetch([(r["area"], r["row"], r["seat"]) for r in rows])
+
+    def customer_street(self, values):
+        if values["country"]:
+            # "новый" формат, есть область и страна
+            return self.resolver.resolve(values["country"], values["region"], values["city"], values["street"])
+        # "старый" формат, без страны, области
+        city = self.resolver.get_city_named(values["city"])
+        if city is None:
+            unknown = self.resolver.country(UNKNOWN)
+            city = self.resolver.city(self.resolver.region(unknown, UNKNOWN), values["city"])
+        return self.resolver.street(city, values["street"])
+
+    def location(self, values):
+        location = Location()
+        if values["street"]:
+            location.street = self.customer_street(values)
+            location.post_index = values["post_index"]
+            if values["house"]:
+                location.house = values["house"]
+                location.block = values["block"]
+                location.building = values["building"]
+                location.flat = values["flat"]
+        return location
+
+    def save_chunk(self, rows):
+        """
+        Сохраняет строки порции пакетными вставками (несколько запросов на
+        таблицу).
+        """
+        creator = self.creator
+        locations = [self.location(values) for values in rows]
+        Location.objects.bulk_create(locations)
+
+        deadmen, customers = [], []
+        for values, location in zip(rows, locations):
+            deadmen.append(Person(creator=creator, last_name=values["last_name"],
+                                  first_name=values["first_name"], patronymic=values["patronymic"]))
+            customers.append(Person(creator=creator, last_name=values["customer_last_name"],
+                                    first_name=values["customer_first_name"],
+                                    patronymic=values["customer_patronymic"], location=location))
+        persons = deadmen + customers
+        for person in persons:
+            person.update_search_keys()
+        Person.objects.bulk_create(persons)
+
+        phones, burials = [], []
+        for values, deadman, customer in zip(rows, deadmen, customers):
+            for phone in values["phones"]:
+                phones.append(Phone(soul_id=customer.pk, f_number=phone))
+            place = self.places.get(values["area"], values["row"], values["seat"])
+            operation = self.operations[values["operation"]]
+            if operation is None:
+                raise Operation.DoesNotExist("Operation %s not found." % getattr(settings, values["operation"]))
+            burial = Burial(creator=creator, person=deadman, account_book_n=values["account_book_n"],
+                            responsible_id=self.cemetery.organization_id, customer=customer,
+                            doer=creator, date_fact=values["date_fact"], product_id=place.pk,
+                            operation=operation)
+            burial.update_sort_keys()
+            burials.append(burial)
+        Phone.objects.bulk_create(phones)
+        Burial.objects.bulk_create(burials)
+        ChangeLog.objects.log_many(ChangeLog.BURIAL, [burial.pk for burial in burials])
+
+        # Комментарии вставляются как есть (raw), чтобы сохранить их даты:
+        # uuid и дата создания задаются здесь.
+        now = datetime.datetime.now()
+        uuid_field = OrderComments._meta.pk
+        comments, files = [], []
+        for values, burial in zip(rows, burials):
+            for date_of_creation, text in values["comments"]:
+                comments.append(OrderComments(uuid=unicode(uuid_field.create_uuid()), order_id=burial.pk,
+                                              comment=text, creator_id=creator.pk,
+                                              date_of_creation=date_of_creation or now))
+            for ofile, comment in values["files"]:
+                order_file = OrderFiles(creator=creator, order_id=burial.pk, comment=comment)
+                order_file.ofile.name = ofile
+                files.append(order_file)
+        OrderComments.objects.bulk_create(comments, raw=True)
+        OrderFiles.objects.bulk_create(files)
+
+        SearchGram.objects.reindex_many(SearchGram.LAST_NAME, [(p.pk, p.last_name_key) for p in persons])
+        SearchGram.objects.reindex_many(SearchGram.COMMENT, [(c.pk, comment_key(c.comment)) for c in comments])
+        BurialSearchRow.objects.refresh([burial.pk for burial in burials])
+        counts.invalidate()
+        ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+
+    def save_row(self, values):
+        creator = self.creator
+        deadman = Person(creator=creator, last_name=values["last_name"],
+                         first_name=values["first_name"], patronymic=values["patronymic"])
+        deadman.save()
+
+        location = self.location(values)
+        location.save()
+        customer = Person(creator=creator, last_name=values["customer_last_name"],
+                          first_name=values["customer_first_name"],
+                          patronymic=values["customer_patronymic"], location=location)
+        customer.save()
+        for phone in values["phones"]:
+            Phone(soul=customer.soul_ptr, f_number=phone).save()
+
+        place = self.places.get(values["area"], values["row"], values["seat"])
+        operation = self.operations[values["operation"]]
+        if operation is None:
+            raise Operation.DoesNotExist("Operation %s not found." % getattr(settings, values["operation"]))
+        burial = Burial(creator=creator, person=deadman, account_book_n=values["account_book_n"],
+                        responsible=self.cemetery.organization.soul_ptr, customer=customer, doer=creator,
+                        date_fact=values["date_fact"], product=place.product_ptr, operation=operation)
+        burial.save()
+        for date_of_creation, text in values["comments"]:
+            comment = burial.add_comment(text, creator)
+            if date_of_creation:
+                OrderComments.objects.filter(pk=comment.pk).update(date_of_creation=date_of_creation)
+        for ofile, comment in values["files"]:
+            order_file = OrderFiles(creator=creator, order=burial.order_ptr, comment=comment)
+            order_file.ofile.name = ofile
+            order_file.save()
+
+
+def error_text(error):
+    """
+    Описание ошибки строкой (байтами), которую можно передать из
+    процесса-обработчика и записать в отчет.
+    """
+    try:
+        return str(error)
+    except UnicodeError:
+        return unicode(error).encode("utf8")
+
+
+def partition_key(values):
+    return zlib.crc32((u"%s\0%s\0%s" % (values["area"], values["row"], values["seat"])).encode("utf8"))
+
+
+# ParallelImporter родительского процесса: процессы пула получают его
+# копию (вместе с выбранными справочниками) при fork.
+_parallel = None
+
+
+def _import_partition(rows):
+    try:
+        return _parallel.import_partition(rows)
+    finally:
+        for conn in connections.all():
+            conn.close()
+
+
+class ParallelImporter(object):
+    """
+    Импорт на нескольких процессах. Файл разбирается в родительском
+    процессе, справочные данные (организация кладбища, операции, адреса
+    всех строк, существующие места) выбираются и создаются заранее, затем
+    строки делятся на части по (участок, ряд, место): строки одного места
+    всегда попадают в одну часть, и процессы не создают одно и то же место
+    одновременно. Части импортируются на пуле из processes процессов, у
+    каждого свое соединение с базой и свои транзакции порций; результаты
+    частей сводятся в общий отчет в порядке строк файла.
+
+    Атрибуты и progress - как у CsvImporter. Если processes меньше 2 или
+    база SQLite, части импортируются в этом же процессе.
+    """
+    # Частей на процесс: чем больше частей, тем ровнее загрузка процессов
+    # и чаще отчет о ходе импорта.
+    PARTITIONS_PER_PROCESS = 4
+
+    def __init__(self, cemetery, creator, processes, chunk=IMPORT_CHUNK_SIZE, progress=None):
+        self.cemetery = cemetery
+        self.creator = creator
+        self.processes = processes
+        self.chunk = chunk
+        self.progress = progress
+        self.importer = CsvImporter(cemetery, creator, chunk)
+        self.good_nr = 0
+        self.bad_nr = 0
+        self.bad_lines = []
+        self.errors = []
+
+    def parallel(self):
+        engine = connections[DEFAULT_DB_ALIAS].settings_dict["ENGINE"]
+        return self.processes > 1 and "sqlite" not in engine
+
+    def run(self, reader):
+        global _parallel
+        failures = []
+        parsed = []
+        for index, line in enumerate(reader):
+            if not line:
+                continue
+            try:
+                parsed.append((index, line, parse_row(line)))
+            except Exception, error:
+                failures.append((index, line, error_text(error)))
+        self.bad_nr = len(failures)
+
+        self.prepare([values for index, line, values in parsed])
+        n = max(self.processes, 1) * self.PARTITIONS_PER_PROCESS
+        partitions = [[] for i in range(n)]
+        for row in parsed:
+            partitions[partition_key(row[2]) % n].append(row)
+        partitions = [rows for rows in partitions if rows]
+
+        if self.parallel():
+            # Соединения не должны достаться процессам пула.
+            for conn in connections.all():
+                conn.close()
+            _parallel = self
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = pool.imap_unordered(_import_partition, partitions)
+                for good_nr, partition_failures in results:
+                    self.add_result(good_nr, partition_failures, failures)
+            finally:
+                pool.close()
+                pool.join()
+                _parallel = None
+        else:
+            for rows in partitions:
+                good_nr, partition_failures = self.import_partition(rows)
+                self.add_result(good_nr, partition_failures, failures)
+
+        failures.sort(key=lambda failure: failure[0])
+        self.bad_lines = [line for index, line, error in failures]
+        self.errors = [error for index, line, error in failures]
+
+    def add_result(self, good_nr, partition_failures, failures):
+        self.good_nr += good_nr
+        self.bad_nr += len(partition_failures)
+        failures.extend(partition_failures)
+        if self.progress is not None:
+            self.progress(self)
+
+    def prepare(self, rows):
+        """
+        Справочные данные для всех строк файла, созданные уровни адресов
+        коммитятся.
+        """
+        importer = self.importer
+        # Организация кладбища нужна каждой строке: выбирается один раз.
+        self.cemetery.organization
+        importer.prepare(rows)
+        streets = set()
+        for values in rows:
+            if values["street"]:
+                key = (values["country"], values["region"], values["city"], values["street"])
+                if key not in streets:
+                    streets.add(key)
+                    importer.customer_street(values)
+        importer.commit()
+
+    @transaction.commit_manually
+    def import_partition(self, rows):
+        """
+        Импортирует часть ((номер строки, строка, значения), ...) порциями.
+        Результат: (удачных строк, [(номер строки, строка, ошибка), ...]).
+        """
+        importer = CsvImporter(self.cemetery, self.creator, self.chunk)
+        importer.resolver = self.importer.resolver
+        importer.places = self.importer.places
+        importer.operations = self.importer.operations
+        for start in xrange(0, len(rows), self.chunk):
+            importer.import_parsed([(line, values) for index, line, values in rows[start:start + self.chunk]])
+        indexes = dict([(id(line), index) for index, line, values in rows])
+        failures = [(indexes[id(line)], line, error_text(error))
+                    for line, error in zip(importer.bad_lines, importer.errors)]
+        return importer.good_nr, failures
+
+
+class CsvValidator(object):
+    """
+    Проверка файла импорта без записи в базу: строки разбираются тем же
+    parse_row, что и при импорте, затем значения проверяются по колонкам
+    сразу для всего файла - длины полей, вид операции, номера в книге
+    учета, повторяющиеся в файле или уже занятые на кладбище. Для каждой
+    строки в отчет попадают все найденные ошибки. Атрибуты после run() -
+    как у CsvImporter (good_nr - строки без ошибок), отчет - write_report.
+    """
+    def __init__(self, cemetery, progress=None):
+        self.cemetery = cemetery
+        self.progress = progress
+        self.good_nr = 0
+        self.bad_nr = 0
+        self.bad_lines = []
+        self.errors = []
+
+    def run(self, reader):
+        # Номер строки -> (строка, [ошибки]).
+        failures = {}
+        rows = []
+        for index, line in enumerate(reader):
+            if not line:
+                continue
+            errors = self.check_line(line)
+            if not errors:
+                try:
+                    rows.append((index, line, parse_row(line)))
+                except Exception, error:
+                    errors = [error_text(error)]
+            if errors:
+                failures[index] = (line, errors)
+
+        def fail(index, line, error):
+            failures.setdefault(index, (line, []))[1].append(error)
+        for check in (self.check_lengths, self.check_operations, self.check_account_book):
+            check(rows, fail)
+
+        self.good_nr = len([index for index, line, values in rows if index not in failures])
+        self.bad_nr = len(failures)
+        for index in sorted(failures):
+            line, errors = failures[index]
+            self.bad_lines.append(line)
+            self.errors.append("; ".join(errors))
+        if self.progress is not None:
+            self.progress(self)
+
+    def check_line(self, line):
+        """
+        Число колонок и кодировка каждой колонки.
+        """
+        try:
+            check_layout(line)
+        except ValueError, error:
+            return [error_text(error)]
+        errors = []
+        for name, value in zip(COLUMNS, line):
+            try:
+                value.decode(settings.CSV_ENCODING)
+            except UnicodeError:
+                errors.append("%s: not in %s" % (name, settings.CSV_ENCODING))
+        return errors
+
+    def check_lengths(self, rows, fail):
+        checks = [(key, max_length, lambda values, key=key: [values[key]]) for key, max_length in field_lengths()]
+        checks += [
+            ("phone", Phone._meta.get_field("f_number").max_length, lambda values: values["phones"]),
+            ("files", OrderFiles._meta.get_field("ofile").max_length,
+             lambda values: [f for f, comment in values["files"]]),
+            ("file_comments", OrderFiles._meta.get_field("comment").max_length,
+             lambda values: [comment for f, comment in values["files"]]),
+        ]
+        for name, max_length, get in checks:
+            for index, line, values in rows:
+                if [v for v in get(values) if len(v) > max_length]:
+                    fail(index, line, "%s: value is longer than %d characters." % (name, max_length))
+
+    def check_operations(self, rows, fail):
+        names = [name for text, prefix, name in OP_TYPES]
+        operations = Operation.objects.in_bulk([getattr(settings, name) for name in names])
+        for index, line, values in rows:
+            if values["op_type"] and op_type_operation(values["op_type"]) is None:
+                fail(index, line, ("op_type: unknown operation type %s" % values["op_type"]).encode("utf8"))
+            elif getattr(settings, values["operation"]) not in operations:
+                fail(index, line, "Operation %s not found." % getattr(settings, values["operation"]))
+
+    def check_account_book(self, rows, fail):
+        first = {}
+        for index, line, values in rows:
+            n = values["account_book_n"]
+            if not n:
+                continue
+            if n in first:
+                fail(index, line, "account_book_n: same as in line %d" % (first[n] + 1))
+            else:
+                first[n] = index
+        existing = set()
+        numbers = first.keys()
+        for start in xrange(0, len(numbers), VALIDATE_CHUNK_SIZE):
+            existing.update(Burial.objects.filter(product__place__cemetery=self.cemetery, is_trash=False,
+                                                  account_book_n__in=numbers[start:start + VALIDATE_CHUNK_SIZE])
+                            .values_list("account_book_n", flat=True))
+        for index, line, values in rows:
+            if values["account_book_n"] in existing:
+                fail(index, line, "account_book_n: already used in the cemetery")
+
+
+def make_importer(cemetery, creator, processes=1, progress=None, backend="orm"):
+    """
+    PgCopyImporter, если backend "copy" и база PostgreSQL, иначе
+    CsvImporter или, если processes больше 1, ParallelImporter.
+    """
+    engine = connections[DEFAULT_DB_ALIAS].settings_dict["ENGINE"]
+    if backend == "copy" and engine.endswith("postgresql_psycopg2"):
+        from pgimport import PgCopyImporter
+        return PgCopyImporter(cemetery, creator, progress=progress)
+    if processes > 1:
+        return ParallelImporter(cemetery, creator, processes, progress=progress)
+    return CsvImporter(cemetery, creator, progress=progress)
+
+
+def write_report(out, importer, started, finished):
+    """
+    Отчет импорта (итоги, строки с ошибками, описания ошибок) в out.
+    """
+    out.write("Начало/Конец: %s/%s\n" % (started, finished))
+    out.write("Всего/Удачно/Ошибок: %d/%d/%d\n" % (importer.good_nr + importer.bad_nr,
+                                                   importer.good_nr, importer.bad_nr))
+    out.write("=== СТРОКИ С ОШИБКАМИ ===\n")
+    writer = csv.writer(out, "4mysql")
+    for line in importer.bad_lines:
+        writer.writerow(line)
+    writer.writerow([u"=== ОПИСАНИЕ ОШИБОК ===".encode("utf8")])
+    for error in importer.errors:
+        writer.writerow((error,))
+
+
+def update_job(job, importer):
+    """
+    Ход импорта в задании; коммитится сразу, чтобы его видела страница
+    задания.
+    """
+    job.good_nr, job.bad_nr = importer.good_nr, importer.bad_nr
+    job.rows_done = job.good_nr + job.bad_nr
+    ImportJob.objects.filter(pk=job.pk).update(rows_done=job.rows_done, good_nr=job.good_nr,
+                                               bad_nr=job.bad_nr)
+    transaction.commit()
+
+
+def run_job(job, processes=1, backend=None):
+    """
+    Выполняет задание импорта (уже переведенное в RUNNING, см.
+    ImportJobManager.claim) на processes процессах способом backend (по
+    умолчанию settings.IMPORT_BACKEND). Вызывается под
+    transaction.commit_manually.
+    """
+    importer = make_importer(job.cemetery, job.creator, processes,
+                             progress=lambda importer: update_job(job, importer),
+                             backend=backend or settings.IMPORT_BACKEND)
+    try:
+        job.csv_file.open("rb")
+        try:
+            importer.run(csv.reader(job.csv_file, "4mysql"))
+        finally:
+            job.csv_file.close()
+    except Exception:
+        transaction.rollback()
+        job.status = ImportJob.FAILED
+        job.message = traceback.format_exc()
+    else:
+        job.status = ImportJob.DONE
+    job.finished = datetime.datetime.now()
+    update_job(job, importer)
+    if importer.bad_lines or importer.errors:
+        out = StringIO()
+        write_report(out, importer, job.started, job.finished)
+        name = "%s_errors.csv" % os.path.splitext(os.path.basename(job.csv_file.name))[0]
+        job.report.save(name, ContentFile(out.getvalue()), save=False)
+    ImportJob.objects.filter(pk=job.pk).update(status=job.status, message=job.message,
+                                               finished=job.finished, report=job.report.name or "")
+    transaction.commit()
+    return importer
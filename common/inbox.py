@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Прием выгрузок изменений с других серверов (manage.py export_changes):
+файлы NDJSON из INBOX_DIR применяются к common.ImpCem/common.ImpBur.
+
+Файлы одного сервера-источника применяются по порядку номеров журнала
+изменений; номер последнего примененного (отметка источника) хранится в
+common.SyncState, поэтому повторно доставленные файлы пропускаются. Файл,
+перед которым не хватает изменений (пришел раньше предыдущего), ждет в
+INBOX_DIR, и источник не обрабатывается дальше, пока пропуск не заполнится.
+Записи применяются порциями в отдельных транзакциях: существующие строки
+читаются одним запросом на порцию, перезаписываемые удаляются одним
+запросом и вместе с новыми создаются одним bulk_create. Из двух
+версий записи побеждает более поздняя по времени изменения на источнике
+(date_of_change). Источники независимы и обрабатываются параллельно.
+"""
+
+import gzip
+import multiprocessing
+import os
+import re
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils import simplejson
+
+from common.models import ImpCem, ImpBur, SyncState
+
+# Записей на транзакцию.
+APPLY_CHUNK_SIZE = 500
+
+# Имя файла выгрузки: время.хост.uuid сервера.после-до.ndjson[.gz]
+FILENAME_RE = re.compile(r"^(?P<date>\d{14})\.(?P<host>.+)\.(?P<source>[0-9a-f-]{36})\."
+                         r"(?P<after>\d+)-(?P<upto>\d+)\.ndjson(\.gz)?$")
+
+# Обработанные файлы переносятся в этот подкаталог INBOX_DIR.
+APPLIED_DIR = "applied"
+
+MODELS = {
+    "common.impcem": ImpCem,
+    "common.impbur": ImpBur,
+}
+
+
+def source_state(source):
+    """
+    Имя отметки источника в common.SyncState.
+    """
+    return "inbox.%s" % source
+
+
+def inbox_files(inbox_dir):
+    """
+    Готовые файлы выгрузок (не ".partial"), сгруппированные по источнику:
+    {uuid: [(после, до, путь), ...]} в порядке применения.
+    """
+    sources = {}
+    for name in os.listdir(inbox_dir):
+        match = FILENAME_RE.match(name)
+        if match is None:
+            continue
+        sources.setdefault(match.group("source"), []).append(
+            (int(match.group("after")), int(match.group("upto")), match.group("date"),
+             os.path.join(inbox_dir, name)))
+    for files in sources.values():
+        files.sort()
+    return dict([(source, [(after, upto, path) for after, upto, date, path in files])
+                 for source, files in sources.items()])
+
+
+def read_records(path):
+    """
+    Записи файла выгрузки по одной, без чтения файла целиком.
+    """
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rb")
+    else:
+        f = open(path, "rb")
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield simplejson.loads(line)
+    finally:
+        f.close()
+
+
+def record_values(model, fields):
+    """
+    Значения полей модели (по attname) из полей записи; неизвестные поля
+    пропускаются.
+    """
+    names = dict([(field.name, field) for field in model._meta.fields])
+    values = {}
+    for name, value in fields.items():
+        field = names.get(name)
+        if field is None or field.primary_key:
+            continue
+        value = field.to_python(value)
+        if value is None and not field.null:
+            value = u""
+        values[field.attname] = value
+    return values
+
+
+_parallel = None
+
+
+def _apply_source(source_files):
+    try:
+        return _parallel.apply_source(*source_files)
+    finally:
+        for conn in connections.all():
+            conn.close()
+
+
+class InboxApplier(object):
+    """
+    Применяет файлы выгрузок из inbox_dir на processes процессах (по
+    источнику на процесс). Если processes меньше 2 или база SQLite,
+    источники обрабатываются в этом же процессе.
+
+    Результат в атрибутах: applied/skipped/waiting (применено/пропущено
+    файлов/ждут предыдущих), changed/stale (записано записей/отброшено как
+    устаревшие).
+    """
+    def __init__(self, inbox_dir, processes=1, chunk=APPLY_CHUNK_SIZE):
+        self.inbox_dir = inbox_dir
+        self.processes = processes
+        self.chunk = chunk
+        self.applied = 0
+        self.skipped = 0
+        self.waiting = 0
+        self.changed = 0
+        self.stale = 0
+
+    def parallel(self):
+        engine = connections[DEFAULT_DB_ALIAS].settings_dict["ENGINE"]
+        return self.processes > 1 and "sqlite" not in engine
+
+    def run(self):
+        global _parallel
+        sources = inbox_files(self.inbox_dir).items()
+        if self.parallel() and len(sources) > 1:
+            # Соединения не должны достаться процессам пула.
+            for conn in connections.all():
+                conn.close()
+            _parallel = self
+            pool = multiprocessing.Pool(min(self.processes, len(sources)))
+            try:
+                for result in pool.imap_unordered(_apply_source, sources):
+                    self.add_result(*result)
+            finally:
+                pool.close()
+                pool.join()
+                _parallel = None
+        else:
+            for source, files in sources:
+                self.add_result(*self.apply_source(source, files))
+
+    def add_result(self, applied, skipped, waiting, changed, stale):
+        self.applied += applied
+        self.skipped += skipped
+        self.waiting += waiting
+        self.changed += changed
+        self.stale += stale
+
+    @transaction.commit_manually
+    def apply_source(self, source, files):
+        """
+        Файлы одного источника по порядку. Результат: (применено файлов,
+        пропущено файлов, ждущих файлов, записано записей, устаревших
+        записей).
+        """
+        applied = skipped = waiting = changed = stale = 0
+        try:
+            seq = SyncState.objects.seq(source_state(source))
+            transaction.commit()
+            for index, (after, upto, path) in enumerate(files):
+                if after > seq:
+                    # Изменения с seq по after еще не пришли: этот и
+                    # следующие файлы ждут в INBOX_DIR.
+                    waiting = len(files) - index
+                    break
+                if upto <= seq:
+                    # Уже применен: повторная доставка.
+                    skipped += 1
+                else:
+                    # Файл, начинающийся до отметки (after < seq),
+                    # применяется целиком. Это верно только потому, что
+                    # запись идемпотентна: уже примененные записи
+                    # перезаписываются теми же значениями.
+                    file_changed, file_stale = self.apply_file(path)
+                    SyncState.objects.set_seq(source_state(source), upto)
+                    transaction.commit()
+                    seq = upto
+                    applied += 1
+                    changed += file_changed
+                    stale += file_stale
+                self.move_applied(path)
+        except:
+            transaction.rollback()
+            raise
+        return applied, skipped, waiting, changed, stale
+
+    def apply_file(self, path):
+        """
+        Применяет файл порциями, каждая порция коммитится (повторное
+        применение порции после сбоя ничего не меняет). Результат:
+        (записано записей, устаревших записей).
+        """
+        changed = stale = 0
+        records = []
+        for record in read_records(path):
+            records.append(record)
+            if len(records) >= self.chunk:
+                chunk_changed, chunk_stale = self.apply_chunk(records)
+                transaction.commit()
+                changed += chunk_changed
+                stale += chunk_stale
+                records = []
+        if records:
+            chunk_changed, chunk_stale = self.apply_chunk(records)
+            changed += chunk_changed
+            stale += chunk_stale
+        return changed, stale
+
+    def apply_chunk(self, records):
+        """
+        Порция записей: кладбища раньше захоронений, из нескольких версий
+        одной записи в порции остается последняя.
+        """
+        grouped = {}
+        for record in records:
+            model = MODELS.get(record["model"])
+            if model is not None:
+                grouped.setdefault(model, {})[record["pk"]] = record_values(model, record["fields"])
+        changed = stale = 0
+        for model in (ImpCem, ImpBur):
+            rows = grouped.get(model)
+            if rows:
+                if model is ImpBur:
+                    self.ensure_cemeteries(set([values["cemetery_id"] for values in rows.values()]))
+                model_changed, model_stale = self.upsert(model, rows)
+                changed += model_changed
+                stale += model_stale
+        return changed, stale
+
+    def upsert(self, model, rows):
+        """
+        Записывает {pk: значения} одним DELETE и одним bulk_create на
+        порцию: существующие строки, если запись не старше строки в базе,
+        удаляются и вставляются заново вместе с новыми (поля, которых нет в
+        записи, берутся из старой строки).
+        """
+        pk_name = model._meta.pk.attname
+        existing = dict([(row.pop(pk_name), row) for row in model.objects.filter(pk__in=rows.keys()).values()])
+        created, replaced = [], []
+        changed = stale = 0
+        for pk, values in rows.items():
+            row = existing.get(pk)
+            if row is not None:
+                if row["date_of_change"] is not None and values.get("date_of_change") is not None \
+                        and row["date_of_change"] > values["date_of_change"]:
+                    stale += 1
+                    continue
+                values = dict(row, **values)
+                replaced.append(pk)
+            created.append(model(pk=pk, **values))
+            changed += 1
+        if replaced:
+            self.delete(model, replaced)
+        if created:
+            model.objects.bulk_create(created)
+        return changed, stale
+
+    def delete(self, model, pks):
+        """
+        Удаляет строки одним запросом, без каскада delete(): захоронения
+        удаляемого кладбища остаются, строка кладбища тут же вставляется
+        заново (на PostgreSQL внешние ключи проверяются при коммите).
+        """
+        connection = connections[DEFAULT_DB_ALIAS]
+        qn = connection.ops.quote_name
+        connection.cursor().execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(model._meta.db_table), qn(model._meta.pk.column), ", ".join(["%s"] * len(pks))), pks)
+
+    def ensure_cemeteries(self, cemetery_ids):
+        """
+        Кладбища захоронений, которых еще нет: пустые строки без времени
+        выгрузки, их заполнит первая же выгрузка кладбища.
+        """
+        cemetery_ids = set(cemetery_ids) - set(ImpCem.objects.filter(pk__in=cemetery_ids)
+                                                .values_list("pk", flat=True))
+        if cemetery_ids:
+            ImpCem.objects.bulk_create([ImpCem(pk=pk) for pk in cemetery_ids])
+
+    def move_applied(self, path):
+        applied_dir = os.path.join(self.inbox_dir, APPLIED_DIR)
+        if not os.path.isdir(applied_dir):
+            os.makedirs(applied_dir)
+        os.rename(path, os.path.join(applied_dir, os.path.basename(path)))
+
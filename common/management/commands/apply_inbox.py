@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from common.inbox import InboxApplier, APPLY_CHUNK_SIZE
+
+
+class Command(NoArgsCommand):
+    """
+    Применяет выгрузки изменений других серверов (manage.py export_changes)
+    из INBOX_DIR к common.ImpCem/common.ImpBur, см. common.inbox.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', action='store', dest='processes', type='int', default=None,
+            help='Number of source servers to process in parallel (default: settings.IMPORT_PROCESSES).'),
+        make_option('--chunk', action='store', dest='chunk', type='int', default=APPLY_CHUNK_SIZE,
+            help='Number of records to apply per transaction.'),
+    )
+    help = "Applies sync files from INBOX_DIR (last writer wins, replays are skipped)."
+
+    def handle_noargs(self, **options):
+        processes = options.get("processes") or settings.IMPORT_PROCESSES
+        applier = InboxApplier(settings.INBOX_DIR, processes, options.get("chunk", APPLY_CHUNK_SIZE))
+        applier.run()
+        if int(options.get("verbosity", 1)) > 0:
+            print "Files applied/skipped/waiting %d/%d/%d, records changed/stale %d/%d" % (
+                applier.applied, applier.skipped, applier.waiting, applier.changed, applier.stale)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+from common.models import Person, OrderComments, SearchGram
+from common.search import name_key, phonetic_key, comment_key
+from common.utils import pk_chunks
+from common import counts
+
+
+class Command(NoArgsCommand):
+    """
+    Заполнение поисковых ключей и n-граммного индекса у существующих записей.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk', action='store', dest='chunk', type='int', default=1000,
+            help='Number of rows to update per transaction.'),
+    )
+    help = "Fills normalized name search keys and the n-gram search index."
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        chunk = options.get("chunk", 1000)
+        verbose = int(options.get("verbosity", 1)) > 1
+        grams = SearchGram.objects.enabled()
+        persons = Person.objects.values_list("uuid", "last_name", "first_name", "patronymic",
+                                             "last_name_key", "first_name_key", "patronymic_key",
+                                             "last_name_phonetic")
+        comments = OrderComments.objects.values_list("uuid", "comment")
+        updated = 0
+        try:
+            for rows in pk_chunks(persons, chunk):
+                for uuid, ln, fn, ptrc, ln_key, fn_key, ptrc_key, ln_phonetic in rows:
+                    keys = {
+                        "last_name_key": name_key(ln),
+                        "first_name_key": name_key(fn),
+                        "patronymic_key": name_key(ptrc),
+                        "last_name_phonetic": phonetic_key(ln),
+                    }
+                    if grams:
+                        SearchGram.objects.reindex(SearchGram.LAST_NAME, uuid, keys["last_name_key"])
+                    if (ln_key, fn_key, ptrc_key, ln_phonetic) == (keys["last_name_key"], keys["first_name_key"],
+                                                                   keys["patronymic_key"],
+                                                                   keys["last_name_phonetic"]):
+                        continue
+                    # update() вместо save(): не трогаем last_sync_date захоронений.
+                    Person.objects.filter(pk=uuid).update(**keys)
+                    updated += 1
+                transaction.commit()
+                if verbose:
+                    print rows[-1][0], updated
+            if grams:
+                for rows in pk_chunks(comments, chunk):
+                    for uuid, comment in rows:
+                        SearchGram.objects.reindex(SearchGram.COMMENT, uuid, comment_key(comment))
+                    transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        counts.invalidate()
+        print "Updated: %d" % updated
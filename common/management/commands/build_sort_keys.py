@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+from common.models import Burial, Place
+from common.search import natural_key
+from common.utils import pk_chunks
+from common import counts
+
+
+class Command(NoArgsCommand):
+    """
+    Заполнение ключей "естественной" сортировки у существующих захоронений и мест.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk', action='store', dest='chunk', type='int', default=1000,
+            help='Number of rows to update per transaction.'),
+    )
+    help = "Fills natural sort keys of burial account book numbers and place area/row/seat."
+
+    def keys(self, prefix, value):
+        key = natural_key(value)
+        return dict(zip(["%s_prefix" % prefix, "%s_number" % prefix, "%s_suffix" % prefix], key))
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        chunk = options.get("chunk", 1000)
+        burials = Burial.objects.values_list("pk", "account_book_n", "abn_prefix", "abn_number", "abn_suffix")
+        places = Place.objects.values_list("pk", "area", "row", "seat",
+                                           "area_prefix", "area_number", "area_suffix",
+                                           "row_prefix", "row_number", "row_suffix",
+                                           "seat_prefix", "seat_number", "seat_suffix")
+        updated = 0
+        try:
+            for rows in pk_chunks(burials, chunk):
+                for row in rows:
+                    if natural_key(row[1]) == tuple(row[2:]):
+                        continue
+                    # update() вместо save(): не трогаем last_sync_date.
+                    Burial.objects.filter(pk=row[0]).update(**self.keys("abn", row[1]))
+                    updated += 1
+                transaction.commit()
+            for rows in pk_chunks(places, chunk):
+                for row in rows:
+                    if natural_key(row[1]) + natural_key(row[2]) + natural_key(row[3]) == tuple(row[4:]):
+                        continue
+                    keys = self.keys("area", row[1])
+                    keys.update(self.keys("row", row[2]))
+                    keys.update(self.keys("seat", row[3]))
+                    Place.objects.filter(pk=row[0]).update(**keys)
+                    updated += 1
+                transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        counts.invalidate()
+        print "Updated: %d" % updated
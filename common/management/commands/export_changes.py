@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import gzip
+import os
+import socket
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from optparse import make_option
+
+from common.models import ChangeLog, SyncState, Env, Phone, Place
+from common.utils import pk_chunks
+
+# Поля строки кладбища (common.ImpCem) и откуда они берутся.
+CEMETERY_FIELDS = (
+    ("name", "name"),
+    ("country", "location__street__city__region__country__name"),
+    ("region", "location__street__city__region__name"),
+    ("city", "location__street__city__name"),
+    ("street", "location__street__name"),
+    ("post_index", "location__post_index"),
+    ("house", "location__house"),
+    ("block", "location__block"),
+    ("building", "location__building"),
+)
+
+# Поля строки захоронения (common.ImpBur, первичный ключ - uuid
+# похороненного) и откуда они берутся.
+BURIAL_FIELDS = (
+    ("bur_pk", "pk"),
+    ("last_name", "person__last_name"),
+    ("first_name", "person__first_name"),
+    ("patronymic", "person__patronymic"),
+    ("birth_date", "person__birth_date"),
+    ("death_date", "person__death_date"),
+    ("burial_date", "date_fact"),
+)
+
+# Поля места захоронения (обратную связь product -> place values() не
+# проходит, поэтому места читаются отдельным запросом на порцию).
+PLACE_FIELDS = ("cemetery", "area", "row", "seat", "gps_x", "gps_y", "gps_z")
+
+
+def latest(dates, ids):
+    """
+    Самое позднее время изменения из dates среди объектов ids (None, если
+    ни одного нет).
+    """
+    found = [dates[obj_id] for obj_id in ids if obj_id in dates]
+    return found and max(found) or None
+
+
+class Command(NoArgsCommand):
+    """
+    Выгрузка изменений для синхронизации: кладбища и захоронения,
+    измененные после прошлой выгрузки (по журналу common.ChangeLog),
+    пишутся в OUTBOX_DIR построчно - по объекту JSON в строке (NDJSON) в
+    формате сериализации Django для common.ImpCem/common.ImpBur. Время
+    изменения записи (date_of_change) - время последней записи журнала о
+    ней самой или о том, от чего она зависит; по нему получатель
+    разрешает конфликты. Захоронения читаются порциями по первичному
+    ключу (запрос с соединениями, запрос мест и запросы журнала на
+    порцию), поэтому память не зависит от объема выгрузки. Файл пишется
+    под именем ".partial" и переименовывается, когда записан целиком;
+    затем отметка выгрузки (common.SyncState) переносится на последнюю
+    выгруженную запись журнала.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help='Compress the output file with gzip.'),
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Export every change in the log, ignoring the high-water mark.'),
+        make_option('--chunk', action='store', dest='chunk', type='int', default=500,
+            help='Number of burials to read per query.'),
+        make_option('--name', action='store', dest='name', default='outbox',
+            help='Name of the high-water mark (common.SyncState).'),
+    )
+    help = "Exports changed cemeteries and burials to OUTBOX_DIR as NDJSON."
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        name = options.get("name", "outbox")
+        chunk = options.get("chunk", 500)
+        verbose = int(options.get("verbosity", 1)) > 0
+        try:
+            after = not options.get("full") and SyncState.objects.seq(name) or 0
+            # Номер читается в отдельной транзакции: блокировка журнала
+            # (см. committed_seq) снимается сразу.
+            upto = ChangeLog.objects.committed_seq()
+            transaction.commit()
+            if upto is None:
+                # Журнал пишет долгая транзакция: выгрузка - в следующий раз,
+                # отметка не двигается.
+                if verbose:
+                    print "Change log is busy, nothing exported after %d" % after
+                return
+            if upto <= after:
+                transaction.commit()
+                if verbose:
+                    print "No changes after %d" % after
+                return
+            filename = self.filename(after, upto, options.get("gzip"))
+            partial = "%s.partial" % filename
+            if options.get("gzip"):
+                out = gzip.open(partial, "wb")
+            else:
+                out = open(partial, "wb")
+            try:
+                cemeteries = self.write_cemeteries(out, after, upto)
+                burials = self.write_burials(out, after, upto, chunk)
+            finally:
+                out.close()
+            os.rename(partial, filename)
+            SyncState.objects.set_seq(name, upto)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        if verbose:
+            print "%s: cemeteries/burials %d/%d" % (filename, cemeteries, burials)
+
+    def filename(self, after, upto, compress):
+        serv_uuid = Env.objects.all()[0].uuid
+        name = "%s.%s.%s.%d-%d.ndjson" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+                                          socket.gethostname(), serv_uuid, after, upto)
+        if compress:
+            name += ".gz"
+        return os.path.join(settings.OUTBOX_DIR, name)
+
+    def write(self, out, model, pk, fields):
+        out.write(DjangoJSONEncoder(ensure_ascii=False).encode({"model": model, "pk": pk, "fields": fields})
+                  .encode("utf8"))
+        out.write("\n")
+
+    def change_dates(self, after, upto, entities):
+        """
+        {obj_id: время последнего изменения} для [(тип записи журнала, ids), ...].
+        """
+        dates = {}
+        for entity, ids in entities:
+            dates.update(ChangeLog.objects.change_dates(entity, set(ids), after, upto))
+        return dates
+
+    def write_cemeteries(self, out, after, upto):
+        # Кладбищ немного - одним запросом.
+        cemeteries = list(ChangeLog.objects.changed_cemeteries(after, upto)
+                          .values_list("pk", "organization", "location", *[path for name, path in CEMETERY_FIELDS]))
+        phones = {}
+        for soul_id, f_number in Phone.objects.filter(soul__in=[row[1] for row in cemeteries]) \
+                .order_by("uuid").values_list("soul", "f_number"):
+            phones.setdefault(soul_id, f_number)
+        dates = self.change_dates(after, upto, [(ChangeLog.CEMETERY, [row[0] for row in cemeteries]),
+                                                (ChangeLog.ORGANIZATION, [row[1] for row in cemeteries]),
+                                                (ChangeLog.LOCATION, [row[2] for row in cemeteries if row[2]])])
+        for row in cemeteries:
+            fields = dict([(name, value or u"") for (name, path), value in zip(CEMETERY_FIELDS, row[3:])])
+            fields["f_number"] = phones.get(row[1], u"")
+            fields["date_of_change"] = latest(dates, row[:3])
+            self.write(out, "common.impcem", row[0], fields)
+        return len(cemeteries)
+
+    def write_burials(self, out, after, upto, chunk):
+        count = 0
+        qs = ChangeLog.objects.changed_burials(after, upto) \
+            .values_list("pk", "person", "product", *[path for name, path in BURIAL_FIELDS])
+        for rows in pk_chunks(qs, chunk):
+            places = dict([(row[0], row[1:]) for row in Place.objects.filter(pk__in=[row[2] for row in rows])
+                           .values_list("pk", *PLACE_FIELDS)])
+            dates = self.change_dates(after, upto, [(ChangeLog.BURIAL, [row[0] for row in rows]),
+                                                    (ChangeLog.PERSON, [row[1] for row in rows]),
+                                                    (ChangeLog.PLACE, [row[2] for row in rows])])
+            for row in rows:
+                fields = dict(zip([name for name, path in BURIAL_FIELDS], row[3:]))
+                fields.update(zip(PLACE_FIELDS, places.get(row[2], (None,) * len(PLACE_FIELDS))))
+                if fields["burial_date"]:
+                    fields["burial_date"] = fields["burial_date"].date()
+                fields["date_of_change"] = latest(dates, row[:3])
+                self.write(out, "common.impbur", row[1], fields)
+            count += len(rows)
+        return count
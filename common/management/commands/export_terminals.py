@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import os
+import stat
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from common.models import BurialSearchRow, initials
+from common.utils import iter_rows
+
+COLUMNS = ("uuid", "last_name", "initials", "date", "area", "row", "seat", "cemetery")
+
+# Поля строки поиска, из которых строятся столбцы.
+ROW_FIELDS = ("person", "last_name", "first_name", "patronymic", "date_fact", "area", "row", "seat",
+              "cemetery", "cemetery_name")
+
+# Захоронения с такими фамилиями на терминалы не выгружаются.
+SKIP_NAMES = (u"неизвестен", u"безфамильн")
+
+# rw-rw-rw-: файл забирают терминалы.
+FILE_MODE = stat.S_IWOTH | stat.S_IROTH | stat.S_IWGRP | stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR
+
+
+class Target(object):
+    """
+    Одна выгрузка из settings.TERMINAL_EXPORTS.
+    """
+    def __init__(self, path, encoding="cp1251", upper=False, columns=COLUMNS, dialect=None, cemeteries=None):
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError("Unknown terminal export column: %s" % column)
+        self.path = path
+        self.partial = "%s.partial" % path
+        self.encoding = encoding
+        self.upper = upper
+        self.columns = columns
+        self.dialect = dialect or {"delimiter": "\t"}
+        self.cemeteries = cemeteries is not None and set(cemeteries) or None
+        self.count = 0
+        self.f = None
+
+    def open(self):
+        self.f = open(self.partial, "wb")
+        self.writer = csv.writer(self.f, **self.dialect)
+
+    def write(self, cemetery_id, values):
+        if self.cemeteries is not None and cemetery_id not in self.cemeteries:
+            return
+        if self.upper:
+            values = dict(values, last_name=values["last_name"].upper(), initials=values["initials"].upper())
+        self.writer.writerow([values[column].encode(self.encoding) for column in self.columns])
+        self.count += 1
+
+    def publish(self):
+        self.f.close()
+        os.chmod(self.partial, FILE_MODE)
+        os.rename(self.partial, self.path)
+
+    def discard(self):
+        if self.f is not None:
+            self.f.close()
+            os.remove(self.partial)
+
+
+class Command(NoArgsCommand):
+    """
+    Выгрузка реестра захоронений для терминалов по settings.TERMINAL_EXPORTS
+    (вместо отдельного скрипта contrib/export2term*.py на каждый терминал).
+    Реестр читается один раз одним запросом к плоской таблице строк поиска
+    (common.BurialSearchRow) через серверный курсор, каждая строка пишется
+    во все выгрузки. Файлы пишутся под именем ".partial" и переименовываются,
+    когда записаны все.
+    """
+    help = "Exports the burial registry to the terminal files in settings.TERMINAL_EXPORTS."
+
+    def handle_noargs(self, **options):
+        targets = [Target(**config) for config in settings.TERMINAL_EXPORTS]
+        try:
+            for target in targets:
+                target.open()
+            self.export(targets)
+        except:
+            for target in targets:
+                target.discard()
+            raise
+        for target in targets:
+            target.publish()
+        if int(options.get("verbosity", 1)) > 0:
+            for target in targets:
+                print "%s: %d" % (target.path, target.count)
+
+    def export(self, targets):
+        qs = BurialSearchRow.objects.filter(is_trash=False) \
+            .order_by("last_name", "first_name", "patronymic").values_list(*ROW_FIELDS)
+        for person_id, last_name, first_name, patronymic, date_fact, area, row, seat, cemetery_id, cemetery_name \
+                in iter_rows(qs):
+            if not last_name or [name for name in SKIP_NAMES if name in last_name.lower()]:
+                continue
+            values = {
+                "uuid": person_id,
+                "last_name": last_name,
+                "initials": initials(first_name, patronymic) or u"-",
+                "date": date_fact and u"%02d.%02d.%04d" % (date_fact.day, date_fact.month, date_fact.year) or u"-",
+                "area": area,
+                "row": row,
+                "seat": seat,
+                "cemetery": cemetery_name,
+            }
+            for target in targets:
+                target.write(cemetery_id, values)
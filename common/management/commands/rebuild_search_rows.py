@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+from common.models import Burial, BurialSearchRow, ChangeCounter
+from common.utils import pk_chunks
+from common import counts
+
+
+class Command(NoArgsCommand):
+    """
+    Полное перестроение таблицы строк поиска захоронений.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk', action='store', dest='chunk', type='int', default=500,
+            help='Number of burials to rebuild per transaction.'),
+    )
+    help = "Rebuilds the flattened burial search rows (common.BurialSearchRow)."
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        chunk = options.get("chunk", 500)
+        verbose = int(options.get("verbosity", 1)) > 1
+        updated = 0
+        try:
+            # Строки удаленных в обход ORM захоронений.
+            BurialSearchRow.objects.exclude(burial__in=Burial.objects.values("pk")).delete()
+            transaction.commit()
+            for rows in pk_chunks(Burial.objects.values_list("pk"), chunk):
+                BurialSearchRow.objects.refresh([row[0] for row in rows])
+                transaction.commit()
+                updated += len(rows)
+                if verbose:
+                    print rows[-1][0], updated
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        counts.invalidate()
+        ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+        print "Updated: %d" % updated
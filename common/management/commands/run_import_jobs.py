@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+from common.models import ImportJob
+from common.importer import run_job
+
+
+class Command(NoArgsCommand):
+    """
+    Обработчик заданий импорта CSV (common.ImportJob): забирает задания
+    из очереди и выполняет их по одному. Задания, брошенные остановившимся
+    обработчиком на этом хосте, переводятся в FAILED.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit when the queue is empty instead of waiting for new jobs.'),
+        make_option('--sleep', action='store', dest='sleep', type='int', default=5,
+            help='Seconds to wait between queue checks.'),
+        make_option('--processes', action='store', dest='processes', type='int', default=None,
+            help='Number of processes per job (default: settings.IMPORT_PROCESSES).'),
+        make_option('--backend', action='store', dest='backend', type='choice', choices=['orm', 'copy'],
+            default=None, help='Import backend: orm or copy (default: settings.IMPORT_BACKEND).'),
+    )
+    help = "Runs queued CSV import jobs (common.ImportJob)."
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        once = options.get("once", False)
+        sleep = options.get("sleep", 5)
+        processes = options.get("processes") or settings.IMPORT_PROCESSES
+        backend = options.get("backend") or settings.IMPORT_BACKEND
+        verbose = int(options.get("verbosity", 1)) > 0
+        while True:
+            failed = ImportJob.objects.fail_dead()
+            job = ImportJob.objects.claim()
+            transaction.commit()
+            if failed and verbose:
+                print "Failed %d job(s) left running by a stopped worker" % failed
+            if job is None:
+                if once:
+                    break
+                time.sleep(sleep)
+                continue
+            if verbose:
+                print "Job %s: %s" % (job.pk, job.csv_file.name)
+            importer = run_job(job, processes, backend)
+            if verbose:
+                print "Job %s: %s, good/bad %d/%d" % (job.pk, job.status, importer.good_nr, importer.bad_nr)
@@ -1,8 +1,19 @@
 from django.http import HttpResponse
 
+from principal import get_principal
+
 class NoCacheMiddleware(object):
     def process_response(self, request, response):
         response['Pragma'] = 'no-cache'
 #        response['Expires'] = '-1'
         response['Cache-Control'] = 'no-cache no-store must-revalidate proxy-revalidate'
-        return response
\ No newline at end of file
+        return response
+
+
+class PrincipalMiddleware(object):
+    """
+    request.principal: группы и профиль пользователя, загружаемые один раз
+    на запрос (см. common.principal). Ставится после AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        request.principal = get_principal(request.user, request.session)
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.db import models, router, connections, transaction, DatabaseError
+from django.db.models import signals
+from django.core.signals import got_request_exception
 from django.contrib.auth.models import User, Group
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.storage import FileSystemStorage
 
 from south.modelsinspector import add_introspection_rules
 
 import datetime
+import errno
 import os
+import socket
+import time
 #import re
 
 from django_extensions.db.fields import UUIDField
 
+from search import name_key, phonetic_key, comment_key, ngrams, natural_key
+import counts
+import principal
+
 PER_PAGE_VALUES = (
     (5, '5'),
     (10, '10'),
@@ -120,7 +131,89 @@ class Street(models.Model):
         return self.name
 
 
-class Location(models.Model):
+class DirtyFieldsMixin(object):
+    """
+    Значения полей объекта, загруженного из базы (или только что
+    сохраненного): save() объекта, в котором ничего не изменилось, ничего
+    не пишет и не посылает сигналов, а измененного - обновляет только
+    измененные колонки. Имена (attname) полей, измененных при последнем
+    сохранении, - в changed_fields (None, если объект новый или сохранен
+    целиком); по ним обработчики post_save решают, что нужно обновить.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DirtyFieldsMixin, self).__init__(*args, **kwargs)
+        self.changed_fields = None
+        self.snapshot()
+
+    def tracked_fields(self):
+        # Первичный ключ (и связь с родителем) не меняется, отложенные
+        # (defer/only) поля не загружены.
+        return [f for f in self._meta.fields if not f.primary_key and f.attname in self.__dict__]
+
+    def snapshot(self):
+        self._original = dict([(f.attname, getattr(self, f.attname)) for f in self.tracked_fields()])
+
+    def dirty_fields(self):
+        """
+        Поля, измененные после загрузки или сохранения.
+        """
+        original = self._original
+        dirty = set()
+        for f in self.tracked_fields():
+            if f.attname not in original:
+                dirty.add(f.attname)
+                continue
+            # Значение из формы может быть другого типа (дата вместо
+            # даты и времени).
+            value = getattr(self, f.attname)
+            try:
+                value = f.to_python(value)
+            except Exception:
+                pass
+            if value != original[f.attname]:
+                dirty.add(f.attname)
+        return dirty
+
+    def save(self, force_insert=False, force_update=False, using=None):
+        if self._state.adding or force_insert or force_update or self._deferred:
+            self.changed_fields = None
+            super(DirtyFieldsMixin, self).save(force_insert=force_insert, force_update=force_update, using=using)
+        else:
+            self.changed_fields = self.dirty_fields()
+            if not self.changed_fields:
+                return
+            self.save_dirty(self.changed_fields, using)
+        self.snapshot()
+    save.alters_data = True
+
+    def save_dirty(self, dirty, using=None):
+        """
+        UPDATE только полей dirty (в таблицах модели и ее родителей).
+        """
+        cls = self.__class__
+        using = using or router.db_for_write(cls, instance=self)
+        signals.pre_save.send(sender=cls, instance=self, raw=False)
+        values = dict([(f.name, f.pre_save(self, False)) for f in self._meta.fields
+                       if f.attname in dirty or getattr(f, "auto_now", False)])
+        if not cls._base_manager.using(using).filter(pk=self.pk).update(**values):
+            # Записи уже нет - сохраняем объект целиком.
+            self.changed_fields = None
+            super(DirtyFieldsMixin, self).save(using=using)
+            return
+        self._state.db = using
+        signals.post_save.send(sender=cls, instance=self, created=False, raw=False)
+
+
+def sync_fields_changed(instance):
+    """
+    Изменилось ли при последнем сохранении instance поле из SYNC_FIELDS
+    его модели (выгружаемые данные).
+    """
+    changed = getattr(instance, "changed_fields", None)
+    return changed is None or bool(changed & set(instance.SYNC_FIELDS))
+
+
+class Location(DirtyFieldsMixin, models.Model):
     """
     Адрес.
     """
@@ -134,19 +227,18 @@ class Location(models.Model):
     gps_x = models.FloatField("Координата X", blank=True, null=True)  # GPS X-ось.
     gps_y = models.FloatField("Координата Y", blank=True, null=True)  # GPS Y-ось.
     gps_z = models.FloatField("Координата Z", blank=True, null=True)  # GPS Z-ось.
+    # Выгружаемые поля (адрес кладбища), см. ChangeLog.
+    SYNC_FIELDS = ("post_index", "street_id", "house", "block", "building", "flat")
     def __unicode__(self):
         if self.street:
             return u'%s (дом %s, корп. %s, строен. %s, кв. %s)' % (self.street,
                                 self.house, self.block, self.building, self.flat)
         else:
             return u"незаполненный адрес"
-    def save(self, *args, **kwargs):
-        Cemetery.objects.filter(location=self).update(last_sync_date=datetime.datetime(2000, 1, 1, 0, 0))
-        super(Location, self).save(*args, **kwargs)
 
 
 # Checked.
-class Soul(models.Model):
+class Soul(DirtyFieldsMixin, models.Model):
     """
     Душа.
     """
@@ -156,6 +248,7 @@ class Soul(models.Model):
     location = models.ForeignKey(Location, blank=True, null=True)  # Адрес орг-ии или человека (Person).
     creator = models.ForeignKey("Soul", blank=True, null=True)  # Создатель записи.
     date_of_creation = models.DateTimeField(auto_now_add=True)  # Дата создания записи.
+    SYNC_FIELDS = ("birth_date", "death_date")
     def __unicode__(self):
         if hasattr(self, "person"):
             return u"Физ. лицо: %s" % self.person
@@ -163,30 +256,22 @@ class Soul(models.Model):
             return u"Юр. лицо: %s" % self.organization
         else:
             return self.uuid
-    def save(self, *args, **kwargs):
-        if hasattr(self, "person"):
-            Burial.objects.filter(person=self.person).update(last_sync_date=datetime.datetime(2000, 1, 1, 0, 0))
-        super(Soul, self).save(*args, **kwargs)
     class Meta:
         ordering = ['uuid']
 
 
-class Phone(models.Model):
+class Phone(DirtyFieldsMixin, models.Model):
     """
     Телефонный номер.
     """
     uuid = UUIDField(primary_key=True)
     soul = models.ForeignKey(Soul)
     f_number = models.CharField("Номер телефона", max_length=20)  # Телефон.
+    SYNC_FIELDS = ("soul_id", "f_number")
     class Meta:
         unique_together = (("soul", "f_number"),)
     def __unicode__(self):
         return self.f_number
-    def save(self, *args, **kwargs):
-        soul = self.soul
-        if hasattr(soul, "organization"):
-            Cemetery.objects.filter(organization=soul.organization).update(last_sync_date=datetime.datetime(2000, 1, 1, 0, 0))
-        super(Phone, self).save(*args, **kwargs)
 
 
 class Email(models.Model):
@@ -198,6 +283,18 @@ class Email(models.Model):
     e_addr = models.EmailField()  # e-mail.
 
 
+def initials(first_name, patronymic):
+    """
+    Инициалы ("И.О.") по имени и отчеству.
+    """
+    result = u""
+    if first_name:
+        result = u"%s." % first_name[:1].upper()
+        if patronymic:
+            result = u"%s%s." % (result, patronymic[:1].upper())
+    return result
+
+
 class Person(Soul):
     """
     Физическое лицо (клиент, сотрудник, кто угодно).
@@ -205,7 +302,13 @@ class Person(Soul):
     last_name = models.CharField("Фамилия", max_length=128)  # Фамилия.
     first_name = models.CharField("Имя", max_length=30, blank=True)  # Имя.
     patronymic = models.CharField("Отчество", max_length=30, blank=True)  # Отчество.
+    # Нормализованные ключи для поиска (см. common.search.name_key).
+    last_name_key = models.CharField(max_length=128, blank=True, db_index=True, editable=False)
+    first_name_key = models.CharField(max_length=30, blank=True, db_index=True, editable=False)
+    patronymic_key = models.CharField(max_length=30, blank=True, db_index=True, editable=False)
+    last_name_phonetic = models.CharField(max_length=128, blank=True, db_index=True, editable=False)
     roles = models.ManyToManyField("Role", through="PersonRole", verbose_name="Роли")
+    SYNC_FIELDS = Soul.SYNC_FIELDS + ("last_name", "first_name", "patronymic")
     def __unicode__(self):
         if self.last_name:
             result = self.last_name
@@ -217,15 +320,15 @@ class Person(Soul):
             result = self.uuid
         return result
     def save(self, *args, **kwargs):
-        Burial.objects.filter(person=self).update(last_sync_date=datetime.datetime(2000, 1, 1, 0, 0))
+        self.update_search_keys()
         super(Person, self).save(*args, **kwargs)
+    def update_search_keys(self):
+        self.last_name_key = name_key(self.last_name)
+        self.first_name_key = name_key(self.first_name)
+        self.patronymic_key = name_key(self.patronymic)
+        self.last_name_phonetic = phonetic_key(self.last_name)
     def get_initials(self):
-        initials = u""
-        if self.first_name:
-            initials = u"%s." % self.first_name[:1].upper()
-            if self.patronymic:
-                initials = u"%s%s." % (initials, self.patronymic[:1].upper())
-        return initials
+        return initials(self.first_name, self.patronymic)
     class Meta:
         verbose_name = ('физ. лицо')
         verbose_name_plural = ('физ. лица')
@@ -306,7 +409,7 @@ class PersonRole(models.Model):
         unique_together = (("person", "role"),)
 
 
-class Cemetery(models.Model):
+class Cemetery(DirtyFieldsMixin, models.Model):
     """
     Кладбище.
     """
@@ -341,7 +444,7 @@ class ProductType(models.Model):
         verbose_name_plural = ('типы продуктов')
 
 
-class Product(models.Model):
+class Product(DirtyFieldsMixin, models.Model):
     """
     Продукт.
     """
@@ -405,6 +508,17 @@ class Place(Product):
     gps_z = models.FloatField("Координата Z", blank=True, null=True)  # GPS Z-ось.
     creator = models.ForeignKey(Soul, verbose_name="Создатель записи")  # Создатель записи.
     date_of_creation = models.DateTimeField("Дата создания записи", auto_now_add=True)  # Дата создания записи.
+    # Ключи "естественной" сортировки (см. common.search.natural_key).
+    area_prefix = models.CharField(max_length=9, blank=True, editable=False)
+    area_number = models.FloatField(default=0, editable=False)
+    area_suffix = models.CharField(max_length=9, blank=True, editable=False)
+    row_prefix = models.CharField(max_length=9, blank=True, editable=False)
+    row_number = models.FloatField(default=0, editable=False)
+    row_suffix = models.CharField(max_length=9, blank=True, editable=False)
+    seat_prefix = models.CharField(max_length=9, blank=True, editable=False)
+    seat_number = models.FloatField(default=0, editable=False)
+    seat_suffix = models.CharField(max_length=9, blank=True, editable=False)
+    SYNC_FIELDS = ("cemetery_id", "area", "row", "seat", "gps_x", "gps_y", "gps_z")
     def save(self, *args, **kwargs):
         """
         Всегда приводим area/row/seat к нижнему регистру.
@@ -412,9 +526,12 @@ class Place(Product):
         self.area = self.area.lower()
         self.row = self.row.lower()
         self.seat = self.seat.lower()
-
-        Burial.objects.filter(product__place=self).update(last_sync_date=datetime.datetime(2000, 1, 1, 0, 0))
+        self.update_sort_keys()
         super(Place, self).save(*args, **kwargs)
+    def update_sort_keys(self):
+        self.area_prefix, self.area_number, self.area_suffix = natural_key(self.area)
+        self.row_prefix, self.row_number, self.row_suffix = natural_key(self.row)
+        self.seat_prefix, self.seat_number, self.seat_suffix = natural_key(self.seat)
     def __unicode__(self):
         return  '%s, %s, %s (%s)' % (self.area, self.row, self.seat,
                                      self.cemetery)
@@ -422,29 +539,6 @@ class Place(Product):
         unique_together = (("cemetery", "area", "row", "seat"),)
 
 
-class Place1(Product): # Места
-    cemetery = models.ForeignKey(Cemetery)  # Связь с кладбищем.
-    area = models.CharField(max_length=9)  # Участок.
-    row = models.CharField(max_length=9)  # Ряд.
-    seat = models.CharField(max_length=9)  # Место.
-    gps_x = models.FloatField(blank=True, null=True)  # GPS X-ось.
-    gps_y = models.FloatField(blank=True, null=True)  # GPS Y-ось.
-    gps_z = models.FloatField(blank=True, null=True)  # GPS Z-ось.
-    creator = models.ForeignKey(Soul)  # Создатель записи.
-    date_of_creation = models.DateTimeField()  # Дата создания записи.
-    s1 = models.TextField(blank=True)
-    s2 = models.FloatField(blank=True, null=True)
-    s3 = models.TextField(blank=True)
-    s4 = models.TextField(blank=True)
-    s5 = models.FloatField(blank=True, null=True)
-    s6 = models.TextField(blank=True)
-    s7 = models.TextField(blank=True)
-    s8 = models.FloatField(blank=True, null=True)
-    s9 = models.TextField(blank=True)
-    class Meta:
-        managed = False
-
-
 class Operation(models.Model):
     """
     Операция с продуктом.
@@ -458,7 +552,7 @@ class Operation(models.Model):
         verbose_name_plural = ('операции с продуктом')
 
 
-class Order(models.Model):
+class Order(DirtyFieldsMixin, models.Model):
     """
     Заказ.
     """
@@ -525,6 +619,10 @@ class Burial(Order):
     person = models.ForeignKey(Person, verbose_name="Похороненный", related_name='buried')  # Похороненный.
     account_book_n = models.CharField("Номер в книге учета", max_length=16)  # Номер записи к книге учета.
     last_sync_date = models.DateTimeField("Дата последней синхронизации", default=datetime.datetime(2000, 1, 1, 0, 0))
+    # Ключи "естественной" сортировки номера в книге учета.
+    abn_prefix = models.CharField(max_length=16, blank=True, editable=False)
+    abn_number = models.FloatField(default=0, db_index=True, editable=False)
+    abn_suffix = models.CharField(max_length=16, blank=True, editable=False)
     class Meta:
         verbose_name = ('захоронение')
         verbose_name_plural = ('захоронения')
@@ -533,17 +631,10 @@ class Burial(Order):
         return u"захоронение: %s" % self.person.__unicode__()
     def save(self, *args, **kwargs):
         self.last_sync_date = datetime.datetime(2000, 1, 1, 0, 0)
+        self.update_sort_keys()
         super(Burial, self).save(*args, **kwargs)
-
-
-class Burial1(Order): # Захоронения
-    person = models.ForeignKey(Person)  # Похороненный.
-    account_book_n = models.CharField(max_length=16, unique=True)  # Номер записи к книге учета.
-    s1 = models.TextField(blank=True, null=True)
-    s2 = models.FloatField(blank=True, null=True)
-    s3 = models.TextField(blank=True, null=True)
-    class Meta:
-        managed = False
+    def update_sort_keys(self):
+        self.abn_prefix, self.abn_number, self.abn_suffix = natural_key(self.account_book_n)
 
 
 class UserProfile(models.Model):
@@ -610,6 +701,9 @@ class ImpCem(models.Model):
     block = models.CharField("Корпус", max_length=16, blank=True)
     building = models.CharField("Строение", max_length=16, blank=True)
     f_number = models.CharField("Номер телефона", max_length=15, blank=True)
+    # Время последнего изменения записи на сервере-источнике (по журналу
+    # изменений; при приеме побеждает более позднее).
+    date_of_change = models.DateTimeField(blank=True, null=True)
 
 
 class ImpBur(models.Model):
@@ -631,7 +725,8 @@ class ImpBur(models.Model):
     gps_x = models.FloatField("Координата X", blank=True, null=True)
     gps_y = models.FloatField("Координата Y", blank=True, null=True)
     gps_z = models.FloatField("Координата Z", blank=True, null=True)
-    
+    date_of_change = models.DateTimeField(blank=True, null=True)
+
 
 class Media(models.Model):
     """
@@ -642,3 +737,655 @@ class Media(models.Model):
     url = models.URLField(blank=True, verify_exists=False)
     comment = models.TextField(blank=True)
     timestamp = models.DateTimeField(blank=True, null=True)
+
+
+
+class SearchGramManager(models.Manager):
+    # Не больше стольких n-грамм на один поисковый запрос: остальные условия
+    # запроса все равно проверяются по самим данным.
+    MAX_QUERY_GRAMS = 6
+
+    def enabled(self):
+        return getattr(settings, "SEARCH_NGRAM_INDEX", "table") == "table"
+
+    def reindex(self, kind, obj_id, text):
+        """
+        Перестраивает n-граммы объекта.
+        """
+        if not self.enabled():
+            return
+        self.filter(kind=kind, obj_id=obj_id).delete()
+        for gram in ngrams(text):
+            self.create(kind=kind, obj_id=obj_id, gram=gram)
+
+    def reindex_many(self, kind, items):
+        """
+        Перестраивает n-граммы объектов items ((obj_id, text), ...) одним
+        удалением и пакетной вставкой.
+        """
+        if not self.enabled() or not items:
+            return
+        self.filter(kind=kind, obj_id__in=[obj_id for obj_id, text in items]).delete()
+        self.bulk_create([self.model(kind=kind, obj_id=obj_id, gram=gram)
+                          for obj_id, text in items for gram in ngrams(text)])
+
+    def matching(self, kind, grams):
+        """
+        Подзапрос (values("obj_id")) с объектами, у которых есть все n-граммы
+        grams. None, если n-грамм нет или индекс ведет PostgreSQL (pg_trgm).
+        """
+        if not grams or not self.enabled():
+            return None
+        ids = None
+        for gram in sorted(grams)[:self.MAX_QUERY_GRAMS]:
+            qs = self.filter(kind=kind, gram=gram)
+            if ids is not None:
+                qs = qs.filter(obj_id__in=ids)
+            ids = qs.values("obj_id")
+        return ids
+
+
+class SearchGram(models.Model):
+    """
+    N-граммный индекс для поиска по подстроке (фамилии, комментарии).
+    Ведется при сохранении объектов, если SEARCH_NGRAM_INDEX == "table".
+    На PostgreSQL с pg_trgm (SEARCH_NGRAM_INDEX = "pg_trgm") не нужен.
+    """
+    LAST_NAME = "l"
+    COMMENT = "c"
+    KIND_CHOICES = (
+        (LAST_NAME, "Фамилия"),
+        (COMMENT, "Комментарий к заказу"),
+    )
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    gram = models.CharField(max_length=3)
+    obj_id = models.CharField(max_length=36, db_index=True)  # uuid Person или OrderComments.
+    objects = SearchGramManager()
+    class Meta:
+        unique_together = (("kind", "gram", "obj_id"),)
+
+
+class ChangeCounterManager(models.Manager):
+    def value(self, name):
+        """
+        Текущее значение счетчика (0, если его еще нет).
+        """
+        values = self.filter(name=name).values_list("value", flat=True)[:1]
+        return values and values[0] or 0
+
+    def bump(self, name):
+        """
+        Увеличивает счетчик на единицу одним UPDATE.
+        """
+        if not self.filter(name=name).update(value=models.F("value") + 1):
+            self.create(name=name, value=1)
+
+
+class ChangeCounter(models.Model):
+    """
+    Счетчик изменений данных, по которому процессы узнают, что их копии в
+    памяти (например, индекс подсказок common.autocomplete) устарели.
+    """
+    AUTOCOMPLETE = "autocomplete"  # Захоронения и люди (ФИО, фамилии заказчиков).
+    GEO = "geo"  # Страны, регионы, нас. пункты, улицы (common.geocache).
+    GROUPS = "groups"  # Группы пользователей (common.principal).
+    SEARCH_COUNT = "search_count"  # Количества найденных записей (common.counts).
+
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.PositiveIntegerField(default=0)
+    objects = ChangeCounterManager()
+
+
+# Попытки взять блокировку журнала изменений (см.
+# ChangeLogManager.committed_seq) и пауза между ними, в секундах.
+CHANGE_LOG_LOCK_ATTEMPTS = 10
+CHANGE_LOG_LOCK_DELAY = 0.5
+
+
+class ChangeLogManager(models.Manager):
+    def log(self, entity, obj_id):
+        self.create(entity=entity, obj_id=obj_id)
+
+    def log_many(self, entity, ids):
+        """
+        Записи для объектов, сохраненных в обход save() (bulk_create).
+        """
+        self.bulk_create([self.model(entity=entity, obj_id=obj_id) for obj_id in ids])
+
+    def last_seq(self):
+        """
+        Номер последней записи (0, если журнал пуст).
+        """
+        seqs = self.order_by("-seq").values_list("seq", flat=True)[:1]
+        return seqs and seqs[0] or 0
+
+    def committed_seq(self):
+        """
+        Номер последней записи, после которого записей с меньшими номерами
+        уже не появится. Записи пишутся внутри транзакций, и запись N+1
+        может быть закоммичена раньше N. На PostgreSQL блокировка SHARE ROW
+        EXCLUSIVE берется, только когда журнал не пишет ни одна транзакция,
+        и не пускает новые, пока читается номер. Блокировка берется с
+        NOWAIT: ожидающий LOCK встал бы в очередь за долгой транзакцией
+        (импортом) и задержал бы всех, кто пишет журнал. Если журнал занят
+        все CHANGE_LOG_LOCK_ATTEMPTS попыток - None. Вызывать в отдельной
+        короткой транзакции: блокировка держится до ее конца.
+        """
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.settings_dict["ENGINE"].endswith("postgresql_psycopg2"):
+            sql = "LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE NOWAIT" % \
+                connection.ops.quote_name(self.model._meta.db_table)
+            for attempt in xrange(CHANGE_LOG_LOCK_ATTEMPTS):
+                sid = transaction.savepoint(using)
+                try:
+                    connection.cursor().execute(sql)
+                except DatabaseError:
+                    transaction.savepoint_rollback(sid, using)
+                    time.sleep(CHANGE_LOG_LOCK_DELAY)
+                else:
+                    transaction.savepoint_commit(sid, using)
+                    break
+            else:
+                return None
+        return self.last_seq()
+
+    def between(self, after, upto=None):
+        """
+        Записи с номерами после after (и не больше upto) - по индексу
+        первичного ключа.
+        """
+        qs = self.filter(seq__gt=after)
+        if upto is not None:
+            qs = qs.filter(seq__lte=upto)
+        return qs
+
+    def ids(self, entity, after, upto=None):
+        return self.between(after, upto).filter(entity=entity).values("obj_id")
+
+    def change_dates(self, entity, ids, after, upto=None):
+        """
+        {obj_id: время последней записи} для объектов ids типа entity среди
+        записей после after (и не больше upto).
+        """
+        return dict(self.between(after, upto).filter(entity=entity, obj_id__in=list(ids))
+                    .values_list("obj_id").annotate(models.Max("date_of_creation")))
+
+    def changed_burials(self, after, upto=None):
+        """
+        Захоронения, измененные после записи after: сами захоронения, их
+        похороненные и места.
+        """
+        return Burial.objects.filter(models.Q(pk__in=self.ids(self.model.BURIAL, after, upto)) |
+                                     models.Q(person__in=self.ids(self.model.PERSON, after, upto)) |
+                                     models.Q(product__in=self.ids(self.model.PLACE, after, upto)))
+
+    def changed_cemeteries(self, after, upto=None):
+        """
+        Кладбища, измененные после записи after: сами кладбища, их адреса
+        и телефоны организаций.
+        """
+        return Cemetery.objects.filter(models.Q(pk__in=self.ids(self.model.CEMETERY, after, upto)) |
+                                       models.Q(location__in=self.ids(self.model.LOCATION, after, upto)) |
+                                       models.Q(organization__in=self.ids(self.model.ORGANIZATION, after, upto)))
+
+
+class ChangeLog(models.Model):
+    """
+    Журнал изменений для синхронизации (только добавление). Каждое
+    изменение - одна запись с возрастающим номером seq: сохраненное
+    захоронение или кладбище, либо человек, место, адрес или организация,
+    от которых зависят выгружаемые данные. Какие захоронения и кладбища
+    затронуты, определяется при чтении (changed_burials,
+    changed_cemeteries); раньше каждое сохранение человека или места
+    переписывало last_sync_date всех его захоронений.
+    """
+    BURIAL = "b"
+    CEMETERY = "c"
+    PERSON = "p"  # Похороненный: его захоронения.
+    PLACE = "l"  # Место: его захоронения.
+    LOCATION = "a"  # Адрес: кладбища с этим адресом.
+    ORGANIZATION = "o"  # Организация (ее телефоны): ее кладбища.
+    ENTITY_CHOICES = (
+        (BURIAL, "Захоронение"),
+        (CEMETERY, "Кладбище"),
+        (PERSON, "Физ. лицо"),
+        (PLACE, "Место"),
+        (LOCATION, "Адрес"),
+        (ORGANIZATION, "Организация"),
+    )
+
+    seq = models.AutoField(primary_key=True)
+    entity = models.CharField(max_length=1, choices=ENTITY_CHOICES)
+    obj_id = models.CharField(max_length=36)
+    date_of_creation = models.DateTimeField(auto_now_add=True)
+    objects = ChangeLogManager()
+
+
+class SyncStateManager(models.Manager):
+    def seq(self, name):
+        """
+        Последняя обработанная запись журнала изменений (0, если еще не
+        было ни одной выгрузки).
+        """
+        seqs = self.filter(name=name).values_list("seq", flat=True)[:1]
+        return seqs and seqs[0] or 0
+
+    def set_seq(self, name, seq):
+        if not self.filter(name=name).update(seq=seq, date_of_update=datetime.datetime.now()):
+            self.create(name=name, seq=seq)
+
+
+class SyncState(models.Model):
+    """
+    Отметка выгрузки: номер записи журнала изменений (ChangeLog.seq), до
+    которого изменения уже выгружены получателем name.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    seq = models.PositiveIntegerField(default=0)
+    date_of_update = models.DateTimeField(auto_now_add=True)
+    objects = SyncStateManager()
+
+
+class BurialSearchRowManager(models.Manager):
+    # Поле строки поиска -> поле захоронения, места или заказчика, из
+    # которого оно берется. Место и заказчик связаны с захоронением через
+    # наследование (Product -> Place, Soul -> Person), поэтому читаются
+    # отдельными запросами.
+    BURIAL_FIELDS = (
+        ("burial_id", "uuid"),
+        ("is_trash", "is_trash"),
+        ("account_book_n", "account_book_n"),
+        ("abn_prefix", "abn_prefix"),
+        ("abn_number", "abn_number"),
+        ("abn_suffix", "abn_suffix"),
+        ("person_id", "person"),
+        ("last_name", "person__last_name"),
+        ("first_name", "person__first_name"),
+        ("patronymic", "person__patronymic"),
+        ("last_name_key", "person__last_name_key"),
+        ("first_name_key", "person__first_name_key"),
+        ("patronymic_key", "person__patronymic_key"),
+        ("last_name_phonetic", "person__last_name_phonetic"),
+        ("date_fact", "date_fact"),
+        ("product_id", "product"),
+        ("operation_id", "operation"),
+        ("op_type", "operation__op_type"),
+        ("customer_id", "customer"),
+        ("creator_id", "creator"),
+    )
+    PLACE_FIELDS = (
+        ("cemetery_id", "cemetery"),
+        ("cemetery_name", "cemetery__name"),
+        ("area", "area"),
+        ("area_prefix", "area_prefix"),
+        ("area_number", "area_number"),
+        ("area_suffix", "area_suffix"),
+        ("row", "row"),
+        ("row_prefix", "row_prefix"),
+        ("row_number", "row_number"),
+        ("row_suffix", "row_suffix"),
+        ("seat", "seat"),
+        ("seat_prefix", "seat_prefix"),
+        ("seat_number", "seat_number"),
+        ("seat_suffix", "seat_suffix"),
+        ("gps_x", "gps_x"),
+        ("gps_y", "gps_y"),
+        ("gps_z", "gps_z"),
+    )
+    CUSTOMER_FIELDS = (
+        ("customer_last_name", "last_name"),
+        ("customer_first_name", "first_name"),
+        ("customer_patronymic", "patronymic"),
+        ("customer_last_name_key", "last_name_key"),
+    )
+
+    def _values(self, qs, fields):
+        """
+        {pk: {поле строки: значение}} для полей fields объектов qs.
+        """
+        names = [name for name, source in fields]
+        return dict([(values[0], dict(zip(names, values[1:]))) for values in
+                     qs.values_list("pk", *[source for name, source in fields])])
+
+    def refresh(self, burials):
+        """
+        Перестраивает строки поиска захоронений burials (QuerySet или
+        список uuid): по одному запросу на захоронения, места, заказчиков,
+        их телефоны и файлы, старые строки удаляются и новые вставляются
+        пакетно.
+        """
+        if not isinstance(burials, models.query.QuerySet):
+            burials = Burial.objects.filter(pk__in=list(burials))
+        rows = self._values(burials, self.BURIAL_FIELDS).values()
+        if not rows:
+            return
+        places = self._values(Place.objects.filter(pk__in=[r["product_id"] for r in rows]), self.PLACE_FIELDS)
+        customer_ids = set([r["customer_id"] for r in rows])
+        customers = self._values(Person.objects.filter(pk__in=customer_ids), self.CUSTOMER_FIELDS)
+        phones = {}
+        for soul_id, f_number in Phone.objects.filter(soul__in=customer_ids).values_list("soul", "f_number"):
+            phones.setdefault(soul_id, []).append(f_number)
+        with_files = set(OrderFiles.objects.filter(order__in=[r["burial_id"] for r in rows])
+                         .values_list("order", flat=True))
+        for r in rows:
+            r.update(places.get(r.pop("product_id"), {}))
+            r.update(customers.get(r["customer_id"], {}))
+            r["customer_phones"] = u"\n".join(phones.get(r["customer_id"], []))
+            r["has_files"] = r["burial_id"] in with_files
+        self.filter(burial__in=[r["burial_id"] for r in rows]).delete()
+        self.bulk_create([self.model(**r) for r in rows])
+
+    def refresh_phones(self, soul_id):
+        """
+        Обновляет телефоны заказчика в уже существующих строках.
+        """
+        phones = Phone.objects.filter(soul=soul_id).values_list("f_number", flat=True)
+        self.filter(customer=soul_id).update(customer_phones=u"\n".join(phones))
+
+    def refresh_files(self, order_id):
+        """
+        Обновляет признак приложенных файлов в уже существующей строке.
+        """
+        self.filter(burial=order_id).update(has_files=OrderFiles.objects.filter(order=order_id).exists())
+
+
+class BurialSearchRow(models.Model):
+    """
+    Плоская строка поиска захоронений: все, что нужно главной странице для
+    фильтрации, сортировки и вывода, в одной таблице без соединений.
+    Ведется сигналами при сохранении захоронений и связанных объектов,
+    полностью перестраивается командой manage.py rebuild_search_rows.
+    """
+    burial = models.OneToOneField(Burial, primary_key=True, related_name="search_row")
+    is_trash = models.BooleanField(default=False, db_index=True)
+    account_book_n = models.CharField(max_length=16)
+    abn_prefix = models.CharField(max_length=16, blank=True)
+    abn_number = models.FloatField(default=0, db_index=True)
+    abn_suffix = models.CharField(max_length=16, blank=True)
+    person = models.ForeignKey(Person, related_name="burial_search_rows")
+    last_name = models.CharField(max_length=128)
+    first_name = models.CharField(max_length=30, blank=True)
+    patronymic = models.CharField(max_length=30, blank=True)
+    last_name_key = models.CharField(max_length=128, blank=True, db_index=True)
+    first_name_key = models.CharField(max_length=30, blank=True, db_index=True)
+    patronymic_key = models.CharField(max_length=30, blank=True, db_index=True)
+    last_name_phonetic = models.CharField(max_length=128, blank=True, db_index=True)
+    date_fact = models.DateTimeField(blank=True, null=True, db_index=True)
+    cemetery = models.ForeignKey(Cemetery, blank=True, null=True)
+    cemetery_name = models.CharField(max_length=99, blank=True)
+    area = models.CharField(max_length=9, blank=True)
+    area_prefix = models.CharField(max_length=9, blank=True)
+    area_number = models.FloatField(default=0)
+    area_suffix = models.CharField(max_length=9, blank=True)
+    row = models.CharField(max_length=9, blank=True)
+    row_prefix = models.CharField(max_length=9, blank=True)
+    row_number = models.FloatField(default=0)
+    row_suffix = models.CharField(max_length=9, blank=True)
+    seat = models.CharField(max_length=9, blank=True)
+    seat_prefix = models.CharField(max_length=9, blank=True)
+    seat_number = models.FloatField(default=0)
+    seat_suffix = models.CharField(max_length=9, blank=True)
+    gps_x = models.FloatField(blank=True, null=True)
+    gps_y = models.FloatField(blank=True, null=True)
+    gps_z = models.FloatField(blank=True, null=True)
+    operation = models.ForeignKey(Operation)
+    op_type = models.CharField(max_length=100, blank=True)
+    customer = models.ForeignKey(Soul, related_name="customer_search_rows")
+    customer_last_name = models.CharField(max_length=128, blank=True)
+    customer_first_name = models.CharField(max_length=30, blank=True)
+    customer_patronymic = models.CharField(max_length=30, blank=True)
+    customer_last_name_key = models.CharField(max_length=128, blank=True, db_index=True)
+    customer_phones = models.TextField(blank=True)  # Телефоны заказчика, по одному в строке.
+    creator = models.ForeignKey(Soul, related_name="created_search_rows")
+    has_files = models.BooleanField(default=False)
+    objects = BurialSearchRowManager()
+
+
+import_storage = FileSystemStorage(location=settings.IMPORT_ROOT)
+
+
+def import_worker():
+    """
+    Имя обработчика импорта: "хост:pid".
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+class ImportJobManager(models.Manager):
+    def claim(self):
+        """
+        Следующее задание из очереди, переведенное в RUNNING, или None.
+        Задание забирается условным UPDATE, поэтому одно задание не
+        достанется двум обработчикам.
+        """
+        for pk in self.filter(status=ImportJob.QUEUED).order_by("date_of_creation").values_list("pk", flat=True):
+            if self.filter(pk=pk, status=ImportJob.QUEUED).update(status=ImportJob.RUNNING,
+                                                                   started=datetime.datetime.now(),
+                                                                   worker=import_worker()):
+                return self.get(pk=pk)
+        return None
+
+    def fail_dead(self):
+        """
+        Задания RUNNING, обработчик которых на этом хосте завершился (упал
+        или был убит), переводятся в FAILED, иначе они выполнялись бы
+        вечно. Заново в очередь они не ставятся: импорт через ORM коммитит
+        файл порциями, и повтор задвоил бы уже импортированные строки.
+        Возвращает число таких заданий.
+        """
+        prefix = "%s:" % socket.gethostname()
+        dead = [pk for pk, worker in self.filter(status=ImportJob.RUNNING, worker__startswith=prefix)
+                .values_list("pk", "worker") if not process_alive(int(worker[len(prefix):]))]
+        if not dead:
+            return 0
+        return self.filter(pk__in=dead, status=ImportJob.RUNNING).update(
+            status=ImportJob.FAILED, finished=datetime.datetime.now(),
+            message=u"Обработчик импорта завершился, не закончив задание; часть строк могла быть импортирована.")
+
+
+class ImportJob(models.Model):
+    """
+    Задание импорта CSV: загруженный файл ждет на диске, импорт выполняет
+    отдельный процесс (manage.py run_import_jobs), страница задания
+    показывает ход импорта.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "В очереди"),
+        (RUNNING, "Выполняется"),
+        (DONE, "Завершено"),
+        (FAILED, "Ошибка"),
+    )
+    uuid = UUIDField(primary_key=True)
+    csv_file = models.FileField(upload_to="%Y/%m", storage=import_storage)
+    cemetery = models.ForeignKey(Cemetery)
+    creator = models.ForeignKey(Soul)  # Создатель импортируемых записей.
+    user = models.ForeignKey(User)  # Кто загрузил файл.
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    good_nr = models.PositiveIntegerField(default=0)
+    bad_nr = models.PositiveIntegerField(default=0)
+    report = models.FileField(upload_to="%Y/%m", storage=import_storage, blank=True)  # Строки с ошибками и их описания.
+    message = models.TextField(blank=True)  # Причина ошибки всего задания.
+    date_of_creation = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True)  # Обработчик ("хост:pid"), см. fail_dead.
+    objects = ImportJobManager()
+    class Meta:
+        ordering = ["-date_of_creation"]
+    def __unicode__(self):
+        return u"%s (%s)" % (os.path.basename(self.csv_file.name), self.get_status_display())
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+    def elapsed(self):
+        """
+        Секунд с начала импорта.
+        """
+        if not self.started:
+            return 0
+        delta = (self.finished or datetime.datetime.now()) - self.started
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+    def rate(self):
+        """
+        Строк в секунду.
+        """
+        elapsed = self.elapsed()
+        return elapsed and self.rows_done / elapsed or 0
+    def as_dict(self):
+        return {
+            "uuid": self.uuid,
+            "status": self.status,
+            "status_display": self.get_status_display(),
+            "rows_done": self.rows_done,
+            "good_nr": self.good_nr,
+            "bad_nr": self.bad_nr,
+            "rate": round(self.rate(), 1),
+            "elapsed": int(self.elapsed()),
+            "finished": self.is_finished(),
+            "has_report": bool(self.report),
+            "message": self.message,
+        }
+
+
+def person_post_save(sender, instance, **kwargs):
+    SearchGram.objects.reindex(SearchGram.LAST_NAME, instance.pk, instance.last_name_key)
+signals.post_save.connect(person_post_save, sender=Person)
+
+def ordercomments_post_save(sender, instance, **kwargs):
+    SearchGram.objects.reindex(SearchGram.COMMENT, instance.pk, comment_key(instance.comment))
+signals.post_save.connect(ordercomments_post_save, sender=OrderComments)
+
+def search_gram_post_delete(sender, instance, **kwargs):
+    SearchGram.objects.filter(obj_id=instance.pk).delete()
+signals.post_delete.connect(search_gram_post_delete, sender=Person)
+signals.post_delete.connect(search_gram_post_delete, sender=OrderComments)
+
+def search_count_invalidate(sender, **kwargs):
+    counts.invalidate()
+for model in (Burial, Person, Place, OrderComments):
+    signals.post_save.connect(search_count_invalidate, sender=model)
+    signals.post_delete.connect(search_count_invalidate, sender=model)
+
+def search_row_burial_post_save(sender, instance, **kwargs):
+    BurialSearchRow.objects.refresh([instance.pk])
+signals.post_save.connect(search_row_burial_post_save, sender=Burial)
+
+def search_row_person_post_save(sender, instance, **kwargs):
+    BurialSearchRow.objects.refresh(Burial.objects.filter(models.Q(person=instance.pk) |
+                                                          models.Q(customer=instance.pk)))
+signals.post_save.connect(search_row_person_post_save, sender=Person)
+
+def search_row_place_post_save(sender, instance, **kwargs):
+    BurialSearchRow.objects.refresh(Burial.objects.filter(product=instance.pk))
+signals.post_save.connect(search_row_place_post_save, sender=Place)
+
+def search_row_cemetery_post_save(sender, instance, **kwargs):
+    BurialSearchRow.objects.filter(cemetery=instance).update(cemetery_name=instance.name)
+signals.post_save.connect(search_row_cemetery_post_save, sender=Cemetery)
+
+def search_row_operation_post_save(sender, instance, **kwargs):
+    BurialSearchRow.objects.filter(operation=instance).update(op_type=instance.op_type)
+signals.post_save.connect(search_row_operation_post_save, sender=Operation)
+
+# Телефоны и файлы обновляют только существующие строки: при каскадном
+# удалении захоронения нельзя создавать строку заново.
+def search_row_phone_changed(sender, instance, **kwargs):
+    BurialSearchRow.objects.refresh_phones(instance.soul_id)
+signals.post_save.connect(search_row_phone_changed, sender=Phone)
+signals.post_delete.connect(search_row_phone_changed, sender=Phone)
+
+def search_row_orderfiles_changed(sender, instance, **kwargs):
+    BurialSearchRow.objects.refresh_files(instance.order_id)
+signals.post_save.connect(search_row_orderfiles_changed, sender=OrderFiles)
+signals.post_delete.connect(search_row_orderfiles_changed, sender=OrderFiles)
+
+# Журнал изменений: новые люди, места и адреса еще ни с чем не связаны,
+# у остальных учитываются только изменения выгружаемых полей.
+def changelog_burial_post_save(sender, instance, **kwargs):
+    ChangeLog.objects.log(ChangeLog.BURIAL, instance.pk)
+signals.post_save.connect(changelog_burial_post_save, sender=Burial)
+
+def changelog_cemetery_post_save(sender, instance, **kwargs):
+    ChangeLog.objects.log(ChangeLog.CEMETERY, instance.pk)
+signals.post_save.connect(changelog_cemetery_post_save, sender=Cemetery)
+
+def changelog_person_post_save(sender, instance, created=False, **kwargs):
+    if not created and sync_fields_changed(instance):
+        ChangeLog.objects.log(ChangeLog.PERSON, instance.pk)
+signals.post_save.connect(changelog_person_post_save, sender=Person)
+
+def changelog_soul_post_save(sender, instance, created=False, **kwargs):
+    # Душа человека, сохраненная сама по себе (даты рождения и смерти).
+    if not created and sync_fields_changed(instance) and Person.objects.filter(pk=instance.pk).exists():
+        ChangeLog.objects.log(ChangeLog.PERSON, instance.pk)
+signals.post_save.connect(changelog_soul_post_save, sender=Soul)
+
+def changelog_place_post_save(sender, instance, created=False, **kwargs):
+    if not created and sync_fields_changed(instance):
+        ChangeLog.objects.log(ChangeLog.PLACE, instance.pk)
+signals.post_save.connect(changelog_place_post_save, sender=Place)
+
+def changelog_location_post_save(sender, instance, created=False, **kwargs):
+    if not created and sync_fields_changed(instance):
+        ChangeLog.objects.log(ChangeLog.LOCATION, instance.pk)
+signals.post_save.connect(changelog_location_post_save, sender=Location)
+
+def changelog_phone_post_save(sender, instance, **kwargs):
+    if sync_fields_changed(instance) and Organization.objects.filter(pk=instance.soul_id).exists():
+        ChangeLog.objects.log(ChangeLog.ORGANIZATION, instance.soul_id)
+signals.post_save.connect(changelog_phone_post_save, sender=Phone)
+
+def principal_groups_changed(sender, **kwargs):
+    principal.invalidate()
+signals.m2m_changed.connect(principal_groups_changed, sender=User.groups.through)
+signals.post_save.connect(principal_groups_changed, sender=Group)
+signals.post_delete.connect(principal_groups_changed, sender=Group)
+
+# Подсказки строятся из ФИО захороненных и фамилий заказчиков: счетчик
+# увеличивается, только если изменилось то, из чего они строятся. Новый
+# человек еще не связан с захоронением.
+AUTOCOMPLETE_FIELDS = {
+    Burial: ("person_id", "customer_id"),
+    Person: ("last_name", "first_name", "patronymic"),
+}
+
+def autocomplete_post_save(sender, instance, created=False, **kwargs):
+    if sender is Person and created:
+        return
+    changed = getattr(instance, "changed_fields", None)
+    if changed is None or changed & set(AUTOCOMPLETE_FIELDS[sender]):
+        ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+
+def autocomplete_post_delete(sender, **kwargs):
+    ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+for model in AUTOCOMPLETE_FIELDS:
+    signals.post_save.connect(autocomplete_post_save, sender=model)
+    signals.post_delete.connect(autocomplete_post_delete, sender=model)
+
+def geo_changed(sender, instance, created=False, **kwargs):
+    import geocache
+    ChangeCounter.objects.bump(ChangeCounter.GEO)
+    geocache.changed(instance, created)
+for model in (GeoCountry, GeoRegion, GeoCity, Street):
+    signals.post_save.connect(geo_changed, sender=model)
+    signals.post_delete.connect(geo_changed, sender=model)
+
+def geo_request_failed(sender, **kwargs):
+    # Транзакция запроса откатывается: добавленные в дерево объекты могли
+    # не сохраниться.
+    import geocache
+    geocache.reset()
+got_request_exception.connect(geo_request_failed)
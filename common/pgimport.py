@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+
+"""
+Импорт CSV в PostgreSQL через промежуточную таблицу.
+
+Для самых больших файлов (перенос исторических данных, см.
+contrib/mysql2csv.sql) даже пакетные вставки ORM медленны. Здесь файл
+потоком загружается во временную таблицу import_stage командой COPY FROM
+STDIN, нормализация (NULL вместо "N", ё -> е, заглавные буквы, даты,
+инициалы, вид операции по тексту комментария, ключи поиска и сортировки)
+выполняется запросами сразу над всеми строками, и строки переносятся в
+common_soul, common_person, common_location, common_order, common_burial
+и связанные таблицы запросами INSERT ... SELECT. Отклоненные строки с
+причинами попадают в тот же отчет, что и у CsvImporter.
+
+Правила разбора те же, что в common.importer.parse_row (таблицы видов
+операций и ключи поиска берутся оттуда же и из common.search), адреса
+разрешаются тем же AddressResolver - разных адресов в файле немного.
+Весь файл импортируется одной транзакцией. Работает только на
+PostgreSQL; на других базах импортирует CsvImporter (см.
+common.importer.make_importer).
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+
+import counts
+from importer import CsvImporter, OP_TYPES, COMMENT_OP_TYPES, COLUMNS, UNKNOWN
+from importer import check_layout, error_text, field_lengths
+from models import Phone, OrderFiles, SearchGram, BurialSearchRow, ChangeCounter, ChangeLog, Place
+from search import PHONETIC_VOWELS, PHONETIC_VOICED, PHONETIC_VOICELESS, NATURAL_KEY_NO_NUMBER
+
+# Захоронений в одном обновлении строк поиска и журнала изменений.
+SEARCH_ROWS_CHUNK = 500
+
+
+def copy_value(value):
+    """
+    Значение для текстового формата COPY.
+    """
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class StageStream(object):
+    """
+    Строки CSV в текстовом формате COPY (файловый объект для
+    cursor.copy_from): номер строки и 28 колонок в UTF-8. Строки с
+    неверным числом колонок или не в кодировке CSV_ENCODING сразу
+    попадают в rejected ((номер строки, строка, ошибка), ...).
+    """
+    def __init__(self, reader, rejected):
+        self.rejected = rejected
+        self.lines = self.generate(reader)
+        self.buffer = ""
+        self.count = 0
+
+    def generate(self, reader):
+        width = len(COLUMNS)
+        for line_no, line in enumerate(reader):
+            if not line:
+                continue
+            try:
+                check_layout(line)
+                values = [v.decode(settings.CSV_ENCODING).encode("utf8") for v in line]
+            except (ValueError, UnicodeError), error:
+                self.rejected.append((line_no, line, error_text(error)))
+                continue
+            values += [""] * (width - len(values))
+            self.count += 1
+            yield "%d\t%s\n" % (line_no, "\t".join([copy_value(v) for v in values]))
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += self.lines.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if "\n" not in self.buffer:
+            try:
+                self.buffer += self.lines.next()
+            except StopIteration:
+                pass
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+
+def phonetic_sql(key):
+    """
+    Выражение SQL с фонетическим ключом (как search.phonetic_key) для
+    выражения key с ключом имени. Оглушенные согласные временно пишутся
+    заглавными, чтобы следующая согласная проверялась по исходному ключу.
+    """
+    sql = ur"regexp_replace(regexp_replace(%s, '[ьъ]', '', 'g'), '[йи][ое]', 'и', 'g')" % key
+    for voiced, voiceless in sorted(PHONETIC_VOICED.items()):
+        sql = u"regexp_replace(%s, '%s(?=[%s]|$)', '%s', 'g')" % (sql, voiced, PHONETIC_VOICELESS,
+                                                                 voiceless.upper())
+    vowels = sorted(PHONETIC_VOWELS.items())
+    sql = u"translate(lower(%s), '%s', '%s')" % (sql, u"".join([v for v, a in vowels]),
+                                                 u"".join([a for v, a in vowels]))
+    return u"regexp_replace(replace(%s, 'тс', 'ц'), E'(.)\\\\1+', E'\\\\1', 'g')" % sql
+
+
+# Вспомогательные функции сеанса (схема pg_temp).
+FUNCTIONS = (
+    r"""CREATE OR REPLACE FUNCTION pg_temp.strip(text) RETURNS text AS $$
+        SELECT regexp_replace($1, '^[[:space:]]+|[[:space:]]+$', '', 'g')
+    $$ LANGUAGE sql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.capitalize(text) RETURNS text AS $$
+        SELECT upper(substr($1, 1, 1)) || lower(substr($1, 2))
+    $$ LANGUAGE sql IMMUTABLE""",
+    ur"""CREATE OR REPLACE FUNCTION pg_temp.no_yo(text) RETURNS text AS $$
+        SELECT translate($1, 'ёЁ', 'еЕ')
+    $$ LANGUAGE sql IMMUTABLE""",
+    # Фамилия, имя, отчество: "N" - NULL в исходной базе (importer.name_value).
+    r"""CREATE OR REPLACE FUNCTION pg_temp.name_value(text, text) RETURNS text AS $$
+        SELECT CASE WHEN $1 = 'N' THEN $2 ELSE pg_temp.capitalize(pg_temp.strip($1)) END
+    $$ LANGUAGE sql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.lower_value(text) RETURNS text AS $$
+        SELECT CASE WHEN $1 = 'N' THEN '' ELSE lower(pg_temp.strip($1)) END
+    $$ LANGUAGE sql IMMUTABLE""",
+    # n-й из инициалов ("И.И.", "И, И").
+    r"""CREATE OR REPLACE FUNCTION pg_temp.initial(text, integer) RETURNS text AS $$
+        SELECT coalesce((regexp_split_to_array(pg_temp.strip(regexp_replace(
+            CASE WHEN $1 = 'N' THEN '' ELSE upper(pg_temp.strip($1)) END, '[.,]', ' ', 'g')),
+            '[[:space:]]+'))[$2], '')
+    $$ LANGUAGE sql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.parse_date(value text) RETURNS timestamp AS $$
+    BEGIN
+        IF value ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}' THEN
+            RETURN substr(value, 1, 10)::date;
+        ELSIF value ~ '^[0-9]{2}[.][0-9]{2}[.][0-9]{4}' THEN
+            RETURN (substr(value, 7, 4) || '-' || substr(value, 4, 2) || '-' || substr(value, 1, 2))::date;
+        END IF;
+        RETURN NULL;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE""",
+    # Дата комментария "2011-02-03T04:05:06.000000~текст" (csvexport.DT_TEMPLATE).
+    r"""CREATE OR REPLACE FUNCTION pg_temp.comment_date(value text) RETURNS timestamp AS $$
+    BEGIN
+        IF value ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}[.][0-9]{1,6}~' THEN
+            RETURN replace(split_part(value, '~', 1), 'T', ' ')::timestamp;
+        END IF;
+        RETURN NULL;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.new_uuid() RETURNS varchar AS $$
+        SELECT md5(random()::text || clock_timestamp()::text)::uuid::varchar
+    $$ LANGUAGE sql VOLATILE""",
+    # Ключи (search.name_key, search.natural_key).
+    ur"""CREATE OR REPLACE FUNCTION pg_temp.name_key(text) RETURNS text AS $$
+        SELECT regexp_replace(translate(lower(coalesce($1, '')), 'ё', 'е'), '[^[:alnum:]]+', '', 'g')
+    $$ LANGUAGE sql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.nk_prefix(text) RETURNS text AS $$
+        SELECT substring($1 from '^([^0-9]*)')
+    $$ LANGUAGE sql IMMUTABLE""",
+    r"""CREATE OR REPLACE FUNCTION pg_temp.nk_number(text) RETURNS double precision AS $$
+        SELECT CASE WHEN substring($1 from '^[^0-9]*([0-9]*)') <> ''
+                    THEN substr(substring($1 from '^[^0-9]*([0-9]*)'), 1, 10)::double precision
+                    ELSE %d END
+    $$ LANGUAGE sql IMMUTABLE""" % NATURAL_KEY_NO_NUMBER,
+    r"""CREATE OR REPLACE FUNCTION pg_temp.nk_suffix(text) RETURNS text AS $$
+        SELECT substring($1 from '^[^0-9]*[0-9]*(.*)$')
+    $$ LANGUAGE sql IMMUTABLE""",
+    u"""CREATE OR REPLACE FUNCTION pg_temp.phonetic_key(text) RETURNS text AS $$
+        SELECT %s
+    $$ LANGUAGE sql IMMUTABLE""" % phonetic_sql("pg_temp.name_key($1)"),
+)
+
+
+def operation_sql():
+    """
+    Выражение SQL с именем настройки операции (importer.operation_name) и
+    его параметры.
+    """
+    op_cases, op_params = [], []
+    for text, prefix, name in OP_TYPES:
+        if prefix:
+            op_cases.append("WHEN substr(op_type, 1, %d) = %%s THEN %%s" % len(text))
+        else:
+            op_cases.append("WHEN op_type = %s THEN %s")
+        op_params += [text, name]
+    comment_cases, comment_params = [], []
+    for fragment, name in COMMENT_OP_TYPES:
+        comment_cases.append("WHEN strpos(lower(comment), %s) > 0 THEN %s")
+        comment_params += [fragment, name]
+    sql = ("CASE WHEN op_type <> '' THEN CASE %s ELSE 'OPER_1' END "
+           "WHEN comment <> '' THEN CASE %s ELSE 'OPER_1' END ELSE 'OPER_1' END") % (
+        " ".join(op_cases), " ".join(comment_cases))
+    return sql, op_params + comment_params
+
+
+class PgCopyImporter(object):
+    """
+    Импорт через COPY и запросы над всеми строками сразу, в одной
+    транзакции. Атрибуты и progress - как у CsvImporter; отчет о ходе
+    импорта - один, в конце.
+    """
+    def __init__(self, cemetery, creator, progress=None):
+        self.cemetery = cemetery
+        self.creator = creator
+        self.progress = progress
+        # Адреса и операции разрешаются так же, как при импорте через ORM.
+        self.importer = CsvImporter(cemetery, creator)
+        self.good_nr = 0
+        self.bad_nr = 0
+        self.bad_lines = []
+        self.errors = []
+
+    def execute(self, sql, params=()):
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def report_progress(self):
+        if self.progress is not None:
+            self.progress(self)
+
+    def run(self, reader):
+        rejected = []
+        try:
+            # Отчета о ходе импорта до конца нет: progress задания
+            # (importer.update_job) коммитит, а коммит удалил бы временные
+            # таблицы (ON COMMIT DROP) и половину импорта.
+            self.stage(reader, rejected)
+            self.normalize()
+            self.resolve_streets()
+            self.reject(rejected)
+            burial_ids = self.merge()
+            self.good_nr = len(burial_ids)
+            # Строки поиска и журнал изменений - в той же транзакции, что и
+            # захоронения: импорт виден поиску и выгрузке целиком или не
+            # виден вовсе (незакоммиченные записи журнала выгрузка
+            # дожидается, см. ChangeLogManager.committed_seq).
+            for start in xrange(0, len(burial_ids), SEARCH_ROWS_CHUNK):
+                ids = burial_ids[start:start + SEARCH_ROWS_CHUNK]
+                BurialSearchRow.objects.refresh(ids)
+                ChangeLog.objects.log_many(ChangeLog.BURIAL, ids)
+            counts.invalidate()
+            ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+        except:
+            transaction.rollback()
+            self.importer.resolver.rollback()
+            raise
+        transaction.commit()
+        self.importer.resolver.commit()
+
+        rejected.sort(key=lambda failure: failure[0])
+        self.bad_nr = len(rejected)
+        self.bad_lines = [line for line_no, line, error in rejected]
+        self.errors = [error for line_no, line, error in rejected]
+        self.report_progress()
+
+    def stage(self, reader, rejected):
+        """
+        Файл - во временную таблицу import_stage.
+        """
+        for sql in FUNCTIONS:
+            self.execute(sql)
+        self.execute("CREATE TEMP TABLE import_stage (line_no integer PRIMARY KEY, %s) ON COMMIT DROP" %
+                     ", ".join(["%s text" % c for c in COLUMNS]))
+        cursor = connection.cursor()
+        cursor.copy_from(StageStream(reader, rejected), "import_stage", columns=("line_no", ) + COLUMNS)
+
+    def normalize(self):
+        """
+        Нормализованные строки - во временную таблицу import_rows
+        (importer.parse_row над всеми строками сразу).
+        """
+        operation, params = operation_sql()
+        self.execute(u"""
+            CREATE TEMP TABLE import_rows ON COMMIT DROP AS
+            SELECT line_no, account_book_n, last_name,
+                   CASE WHEN fn <> '' THEN fn ELSE pg_temp.initial(initials, 1) END AS first_name,
+                   CASE WHEN fn <> '' THEN ptrc ELSE pg_temp.initial(initials, 2) END AS patronymic,
+                   bur_date, pg_temp.parse_date(bur_date) AS date_fact, area, "row", seat,
+                   customer_last_name,
+                   CASE WHEN cust_fn <> '' THEN cust_fn ELSE pg_temp.initial(cust_initials, 1) END
+                       AS customer_first_name,
+                   CASE WHEN cust_fn <> '' THEN cust_ptrc ELSE pg_temp.initial(cust_initials, 2) END
+                       AS customer_patronymic,
+                   street, city,
+                   CASE WHEN street = '' THEN '' WHEN region <> '' AND country = '' THEN %%s
+                        ELSE country END AS country,
+                   CASE WHEN street = '' THEN '' WHEN country <> '' AND region = '' THEN %%s
+                        ELSE region END AS region,
+                   house, block, flat, post_index, building, phone, files, file_comments, comment,
+                   %s AS operation,
+                   NULL::varchar(36) AS street_id, NULL::varchar(36) AS operation_id, NULL::text AS reason,
+                   pg_temp.new_uuid() AS deadman_id, pg_temp.new_uuid() AS customer_id,
+                   pg_temp.new_uuid() AS location_id, pg_temp.new_uuid() AS burial_id
+            FROM (
+                SELECT line_no,
+                       lower(pg_temp.strip(n)) AS account_book_n,
+                       pg_temp.no_yo(pg_temp.name_value(ln, '')) AS last_name,
+                       pg_temp.name_value(fn, '') AS fn, pg_temp.name_value(ptrc, '') AS ptrc, initials,
+                       bur_date,
+                       CASE WHEN area = 'N' THEN '0' ELSE lower(pg_temp.strip(area)) END AS area,
+                       CASE WHEN "row" = 'N' THEN '0' ELSE lower(pg_temp.strip("row")) END AS "row",
+                       CASE WHEN seat = 'N' THEN '0' ELSE lower(pg_temp.strip(seat)) END AS seat,
+                       pg_temp.no_yo(pg_temp.name_value(cust_ln, %%s)) AS customer_last_name,
+                       pg_temp.name_value(cust_fn, '') AS cust_fn, pg_temp.name_value(cust_ptrc, '') AS cust_ptrc,
+                       cust_initials,
+                       coalesce(nullif(pg_temp.name_value(city, %%s), ''), %%s) AS city,
+                       CASE WHEN street = 'N' THEN '' ELSE pg_temp.no_yo(pg_temp.capitalize(pg_temp.strip(street)))
+                            END AS street,
+                       pg_temp.capitalize(pg_temp.strip(country)) AS country,
+                       pg_temp.capitalize(pg_temp.strip(region)) AS region,
+                       pg_temp.lower_value(house) AS house, pg_temp.lower_value(block) AS block,
+                       pg_temp.lower_value(flat) AS flat, lower(pg_temp.strip(post_index)) AS post_index,
+                       lower(pg_temp.strip(building)) AS building, phone, files, file_comments,
+                       CASE WHEN comment = 'N' THEN '' ELSE pg_temp.no_yo(pg_temp.strip(comment)) END AS comment,
+                       lower(pg_temp.strip(op_type)) AS op_type
+                FROM import_stage
+            ) s""" % operation,
+            [UNKNOWN, UNKNOWN.capitalize()] + params + [UNKNOWN, UNKNOWN, UNKNOWN])
+        self.importer.prepare([])
+        for name, operation in self.importer.operations.items():
+            if operation is not None:
+                self.execute("UPDATE import_rows SET operation_id = %s WHERE operation = %s",
+                             [operation.pk, name])
+
+    def resolve_streets(self):
+        """
+        Улицы заказчиков: разных адресов немного, они разрешаются (и
+        недостающие создаются) AddressResolver'ом.
+        """
+        cursor = self.execute("SELECT DISTINCT country, region, city, street FROM import_rows WHERE street <> ''")
+        for country, region, city, street in cursor.fetchall():
+            values = {"country": country, "region": region, "city": city, "street": street}
+            street_id = self.importer.customer_street(values).pk
+            self.execute("UPDATE import_rows SET street_id = %s WHERE street <> '' AND country = %s "
+                         "AND region = %s AND city = %s AND street = %s",
+                         [street_id, country, region, city, street])
+
+    def reject(self, rejected):
+        """
+        Причины отказа - в import_rows.reason, отклоненные строки - в
+        rejected.
+        """
+        cases = [("date_fact IS NULL", "Bad date: ' || coalesce(bur_date, '') || '"),
+                 ("operation_id IS NULL", "Operation ' || operation || ' not found.")]
+        for name, max_length in field_lengths():
+            cases.append(("length(\"%s\") > %d" % (name, max_length),
+                          "%s: value is longer than %d characters." % (name, max_length)))
+        # Телефоны, файлы и комментарии к файлам - по одному значению.
+        for name, separator, model, field in (("phone", "n", Phone, "f_number"),
+                                              ("files", "n", OrderFiles, "ofile"),
+                                              ("file_comments", "t", OrderFiles, "comment")):
+            max_length = model._meta.get_field(field).max_length
+            cases.append(("EXISTS (SELECT 1 FROM regexp_split_to_table(%s, E'\\%s') AS v "
+                          "WHERE length(pg_temp.strip(v)) > %d)" % (name, separator, max_length),
+                          "%s: value is longer than %d characters." % (name, max_length)))
+        self.execute("UPDATE import_rows SET reason = CASE %s END" %
+                     " ".join(["WHEN %s THEN '%s'" % case for case in cases]))
+        cursor = self.execute("SELECT s.line_no, r.reason, %s FROM import_rows r JOIN import_stage s "
+                              "ON s.line_no = r.line_no WHERE r.reason IS NOT NULL" %
+                              ", ".join(["s.%s" % c for c in COLUMNS]))
+        for row in cursor.fetchall():
+            line = [(v or u"").encode(settings.CSV_ENCODING) for v in row[2:]]
+            rejected.append((row[0], line, row[1].encode("utf8")))
+
+    def merge(self):
+        """
+        Принятые строки - в таблицы приложения. Возвращает uuid созданных
+        захоронений.
+        """
+        creator_id = self.creator.pk
+        org_id = self.cemetery.organization_id
+        ok = "reason IS NULL"
+
+        # Места: существующие - по (участок, ряд, место), недостающие
+        # создаются.
+        self.execute("""
+            CREATE TEMP TABLE import_places ON COMMIT DROP AS
+            SELECT r.area, r."row", r.seat, min(p.product_ptr_id) AS place_id,
+                   min(p.product_ptr_id) IS NULL AS is_new
+            FROM (SELECT DISTINCT area, "row", seat FROM import_rows WHERE %s) r
+            LEFT JOIN common_place p ON p.cemetery_id = %%s AND p.area = r.area AND p."row" = r."row"
+                AND p.seat = r.seat
+            GROUP BY r.area, r."row", r.seat""" % ok, [self.cemetery.pk])
+        self.execute("UPDATE import_places SET place_id = pg_temp.new_uuid() WHERE is_new")
+        self.execute(u"""
+            INSERT INTO common_product (uuid, soul_id, name, measure, p_type_id)
+            SELECT place_id, %s, substr(%s || '.уч' || area || 'ряд' || "row" || 'место' || seat, 1, %s), '', %s
+            FROM import_places WHERE is_new""",
+            [org_id, self.cemetery.name, Place._meta.get_field("name").max_length, settings.PLACE_PRODUCTTYPE_ID])
+        self.execute("""
+            INSERT INTO common_place (product_ptr_id, cemetery_id, area, "row", seat, creator_id, date_of_creation,
+                                      area_prefix, area_number, area_suffix, row_prefix, row_number, row_suffix,
+                                      seat_prefix, seat_number, seat_suffix)
+            SELECT place_id, %s, area, "row", seat, %s, now(),
+                   pg_temp.nk_prefix(area), pg_temp.nk_number(area), pg_temp.nk_suffix(area),
+                   pg_temp.nk_prefix("row"), pg_temp.nk_number("row"), pg_temp.nk_suffix("row"),
+                   pg_temp.nk_prefix(seat), pg_temp.nk_number(seat), pg_temp.nk_suffix(seat)
+            FROM import_places WHERE is_new""", [self.cemetery.pk, creator_id])
+
+        self.execute("""
+            INSERT INTO common_location (uuid, post_index, street_id, house, block, building, flat)
+            SELECT location_id,
+                   CASE WHEN street_id IS NULL THEN '' ELSE post_index END, street_id,
+                   CASE WHEN street_id IS NULL OR house = '' THEN '' ELSE house END,
+                   CASE WHEN street_id IS NULL OR house = '' THEN '' ELSE block END,
+                   CASE WHEN street_id IS NULL OR house = '' THEN '' ELSE building END,
+                   CASE WHEN street_id IS NULL OR house = '' THEN '' ELSE flat END
+            FROM import_rows WHERE %s""" % ok)
+        self.execute("""
+            INSERT INTO common_soul (uuid, location_id, creator_id, date_of_creation)
+            SELECT deadman_id, NULL, %%s, now() FROM import_rows WHERE %s
+            UNION ALL
+            SELECT customer_id, location_id, %%s, now() FROM import_rows WHERE %s""" % (ok, ok),
+            [creator_id, creator_id])
+        self.execute("""
+            INSERT INTO common_person (soul_ptr_id, last_name, first_name, patronymic,
+                                       last_name_key, first_name_key, patronymic_key, last_name_phonetic)
+            SELECT id, ln, fn, ptrc, pg_temp.name_key(ln), pg_temp.name_key(fn), pg_temp.name_key(ptrc),
+                   pg_temp.phonetic_key(ln)
+            FROM (SELECT deadman_id AS id, last_name AS ln, first_name AS fn, patronymic AS ptrc
+                  FROM import_rows WHERE %s
+                  UNION ALL
+                  SELECT customer_id, customer_last_name, customer_first_name, customer_patronymic
+                  FROM import_rows WHERE %s) p""" % (ok, ok))
+        self.execute("""
+            INSERT INTO common_phone (uuid, soul_id, f_number)
+            SELECT pg_temp.new_uuid(), customer_id, f
+            FROM (SELECT customer_id, pg_temp.strip(regexp_split_to_table(phone, E'\\n')) AS f
+                  FROM import_rows WHERE %s) p
+            WHERE f <> ''""" % ok)
+        self.execute("""
+            INSERT INTO common_order (uuid, responsible_id, customer_id, doer_id, date_fact, product_id,
+                                      operation_id, is_trash, creator_id, date_of_creation)
+            SELECT burial_id, %%s, customer_id, %%s, date_fact, p.place_id, operation_id, false, %%s, now()
+            FROM import_rows r JOIN import_places p ON p.area = r.area AND p."row" = r."row" AND p.seat = r.seat
+            WHERE %s""" % ok, [org_id, creator_id, creator_id])
+        self.execute("""
+            INSERT INTO common_burial (order_ptr_id, person_id, account_book_n, last_sync_date,
+                                       abn_prefix, abn_number, abn_suffix)
+            SELECT burial_id, deadman_id, account_book_n, '2000-01-01 00:00',
+                   pg_temp.nk_prefix(account_book_n), pg_temp.nk_number(account_book_n),
+                   pg_temp.nk_suffix(account_book_n)
+            FROM import_rows WHERE %s""" % ok)
+
+        # Комментарии "дата~текст" через табуляцию, без даты - текущее время.
+        self.execute("""
+            CREATE TEMP TABLE import_comments ON COMMIT DROP AS
+            SELECT pg_temp.new_uuid() AS uuid, burial_id,
+                   CASE WHEN d IS NULL THEN c ELSE substr(c, strpos(c, '~') + 1) END AS comment,
+                   coalesce(d, now()) AS date_of_creation
+            FROM (SELECT burial_id, c, pg_temp.comment_date(c) AS d
+                  FROM (SELECT burial_id, regexp_split_to_table(comment, E'\\t') AS c
+                        FROM import_rows WHERE %s AND comment <> '') s) c""" % ok)
+        self.execute("""
+            INSERT INTO common_ordercomments (uuid, order_id, comment, creator_id, date_of_creation)
+            SELECT uuid, burial_id, comment, %s, date_of_creation FROM import_comments""", [creator_id])
+
+        # Файлы: имена через перевод строки, комментарии к ним через табуляцию.
+        self.execute("""
+            INSERT INTO common_orderfiles (uuid, order_id, ofile, comment, creator_id, date_of_creation)
+            SELECT pg_temp.new_uuid(), burial_id, pg_temp.strip(names[i]),
+                   coalesce(pg_temp.strip(comments[i]), ''), %%s, now()
+            FROM (SELECT burial_id, names, comments, generate_series(1, array_upper(names, 1)) AS i
+                  FROM (SELECT burial_id, string_to_array(files, E'\\n') AS names,
+                               string_to_array(file_comments, E'\\t') AS comments
+                        FROM import_rows WHERE %s AND files <> '') f) f
+            WHERE pg_temp.strip(names[i]) <> ''""" % ok, [creator_id])
+
+        if SearchGram.objects.enabled():
+            for kind, source in ((SearchGram.LAST_NAME,
+                                  "SELECT soul_ptr_id, last_name_key FROM common_person "
+                                  "WHERE soul_ptr_id IN (SELECT deadman_id FROM import_rows WHERE %s "
+                                  "UNION ALL SELECT customer_id FROM import_rows WHERE %s)" % (ok, ok)),
+                                 (SearchGram.COMMENT,
+                                  u"SELECT uuid, translate(lower(comment), 'ё', 'е') FROM import_comments")):
+                self.execute("""
+                    INSERT INTO common_searchgram (kind, gram, obj_id)
+                    SELECT DISTINCT %%s, substr(k, i, 3), id
+                    FROM (SELECT id, k, generate_series(1, length(k) - 2) AS i FROM (%s) AS s (id, k)) g""" %
+                             source, [kind])
+
+        cursor = self.execute("SELECT burial_id FROM import_rows WHERE %s ORDER BY line_no" % ok)
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Данные текущего пользователя для проверок прав: группы, профиль, Soul и
+Person.
+
+Principal создается один раз на запрос (PrincipalMiddleware, request.principal)
+и запоминается на объекте пользователя, поэтому декоратор is_in_group и
+фильтр in_group в шаблонах не делают запросов на каждую проверку.
+Имена групп дополнительно хранятся в сессии вместе с номером версии; версия
+(счетчик ChangeCounter.GROUPS в базе, общий для всех процессов и никогда не
+уменьшающийся) увеличивается при любом изменении групп (см. сигналы в
+models.py), и после этого группы читаются из базы заново.
+"""
+
+SESSION_KEY = "_principal_groups"
+
+
+def version():
+    from models import ChangeCounter
+    return ChangeCounter.objects.value(ChangeCounter.GROUPS)
+
+
+def invalidate():
+    """
+    Сбрасывает сохраненные в сессиях группы всех пользователей.
+    """
+    from models import ChangeCounter
+    ChangeCounter.objects.bump(ChangeCounter.GROUPS)
+
+
+class Principal(object):
+    """
+    Пользователь с лениво загружаемыми группами, профилем, Soul и Person.
+    """
+    def __init__(self, user, session=None):
+        self.user = user
+        self.session = session
+
+    @property
+    def groups(self):
+        """
+        Множество имен групп пользователя.
+        """
+        if not hasattr(self, "_groups"):
+            self._groups = frozenset(self.load_groups())
+        return self._groups
+
+    def load_groups(self):
+        if not self.user.is_authenticated():
+            return []
+        current = version()
+        if self.session is not None:
+            stored = self.session.get(SESSION_KEY)
+            if stored and stored[0] == current and stored[1] == self.user.pk:
+                return stored[2]
+        names = list(self.user.groups.values_list("name", flat=True))
+        if self.session is not None:
+            self.session[SESSION_KEY] = (current, self.user.pk, names)
+        return names
+
+    def in_group(self, name, ignore_case=False):
+        if ignore_case:
+            name = name.lower()
+            return name in [group.lower() for group in self.groups]
+        return name in self.groups
+
+    @property
+    def profile(self):
+        """
+        UserProfile (вместе с Soul) или None.
+        """
+        if not hasattr(self, "_profile"):
+            from models import UserProfile
+            self._profile = None
+            if self.user.is_authenticated():
+                try:
+                    self._profile = UserProfile.objects.select_related("soul").get(user=self.user)
+                except UserProfile.DoesNotExist:
+                    pass
+                else:
+                    # user.userprofile в представлениях - без запроса.
+                    self.user._userprofile_cache = self._profile
+        return self._profile
+
+    @property
+    def soul(self):
+        return self.profile and self.profile.soul
+
+    @property
+    def person(self):
+        if not hasattr(self, "_person"):
+            from models import Person
+            self._person = None
+            if self.soul:
+                try:
+                    self._person = self.soul.person
+                except Person.DoesNotExist:
+                    pass
+        return self._person
+
+
+def get_principal(user, session=None):
+    """
+    Principal пользователя, один на объект user.
+    """
+    principal = getattr(user, "_principal", None)
+    if principal is None:
+        principal = Principal(user, session)
+        user._principal = principal
+    return principal
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""
+Потоковая печать найденных захоронений (главная страница, print=1).
+
+Таблица отдается по частям: шапка, затем строки порциями по PRINT_CHUNK_SIZE
+(ключевая пагинация в порядке сортировки страницы, комментарии порции -
+одним запросом), затем подвал. Печатается не больше settings.PRINT_MAX_ROWS
+строк; если найдено больше, в подвале - ссылка "Продолжить печать" с
+курсором последней напечатанной строки.
+"""
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from simplepagination.backends.keyset import KeysetPaginator
+
+# Строк в одной порции.
+PRINT_CHUNK_SIZE = 200
+
+
+def print_burials(rows, obj_nr, params):
+    """
+    Генератор кусков HTML страницы печати для строк поиска rows.
+    obj_nr - количество найденных записей, params - GET-параметры запроса
+    (курсор продолжения печати - в KeysetPaginator.AFTER).
+    """
+    paginator = KeysetPaginator()
+    after = paginator.decode(params.get(paginator.AFTER))
+    max_rows = settings.PRINT_MAX_ROWS
+
+    yield render_to_string("burials_print_head.html", {"obj_nr": obj_nr})
+    printed = 0
+    last = None
+    for chunk in paginator.chunks(rows, min(PRINT_CHUNK_SIZE, max_rows), after):
+        chunk = chunk[:max_rows - printed]
+        yield render_to_string("burials_print_rows.html", {"object_list": chunk})
+        printed += len(chunk)
+        last = chunk[-1]
+        if printed >= max_rows:
+            break
+
+    continue_url = None
+    if printed >= max_rows:
+        cursor = paginator.sort_key(rows, last)
+        if paginator.has_more(rows, cursor):
+            params = params.copy()
+            params[paginator.AFTER] = paginator.encode(cursor)
+            continue_url = "?%s" % params.urlencode()
+    yield render_to_string("burials_print_foot.html", {"printed": printed,
+                                                        "max_rows": max_rows,
+                                                        "continue_url": continue_url})
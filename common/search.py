@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Поиск по ФИО через нормализованные ключи.
+
+Ключ - это строка в нижнем регистре, в которой "ё" заменена на "е", а все
+знаки препинания и пробелы удалены. Ключи хранятся в индексированных полях
+Person (last_name_key, first_name_key, patronymic_key), поэтому поиск по
+префиксу превращается в просмотр диапазона индекса, а не в iregex по всей
+таблице. Для поиска "похожих по звучанию" фамилий рядом хранится
+фонетический ключ (last_name_phonetic).
+"""
+
+import re
+
+RE_KEY_JUNK = re.compile(r"[\W_]+", re.UNICODE)
+RE_PATTERN_JUNK = re.compile(r"[^\w\?\*]+|_+", re.UNICODE)
+
+# Фонетический ключ: гласные, сведенные к четырем классам, и звонкие
+# согласные, оглушаемые перед глухими и в конце слова.
+PHONETIC_VOWELS = {u"о": u"а", u"ы": u"а", u"я": u"а", u"е": u"и", u"э": u"и", u"ю": u"у"}
+PHONETIC_VOICED = {u"б": u"п", u"в": u"ф", u"г": u"к", u"д": u"т", u"ж": u"ш", u"з": u"с"}
+PHONETIC_VOICELESS = u"пфктшсхцчщ"
+
+
+def name_key(value):
+    """
+    Нормализованный ключ имени (фамилии, отчества).
+    """
+    value = (value or u"").lower().replace(u"ё", u"е")
+    return RE_KEY_JUNK.sub(u"", value)
+
+
+def phonetic_key(value):
+    """
+    Фонетический ключ фамилии (упрощенный русский Metaphone): Петров и
+    Петрофф, Шевченко и Шевченка дают один и тот же ключ.
+    """
+    key = re.sub(u"[ьъ]", u"", name_key(value))
+    key = re.sub(u"[йи][ое]", u"и", key)
+    result = []
+    for i, ch in enumerate(key):
+        if ch in PHONETIC_VOWELS:
+            ch = PHONETIC_VOWELS[ch]
+        elif ch in PHONETIC_VOICED:
+            following = key[i + 1:i + 2]
+            if not following or following in PHONETIC_VOICELESS:
+                ch = PHONETIC_VOICED[ch]
+        result.append(ch)
+    key = u"".join(result).replace(u"тс", u"ц")
+    # Удвоенные буквы - как одна.
+    return re.sub(r"(.)\1+", r"\1", key)
+
+
+def pattern_key(pattern):
+    """
+    Нормализует шаблон поиска так же, как name_key, но сохраняет
+    подстановочные символы "?" (один символ) и "*" (любое количество).
+    """
+    pattern = (pattern or u"").lower().replace(u"ё", u"е")
+    return RE_PATTERN_JUNK.sub(u"", pattern)
+
+
+def name_lookups(field, pattern, anchor_end=True):
+    """
+    Условия фильтра для поиска по ключевому полю field по шаблону pattern.
+
+    Правила шаблона те же, что были у iregex-поиска на главной странице:
+        "етер"    - начинается с "етер"
+        "етер*"   - начинается с "етер"
+        "етер?"   - "етер" и еще ровно один символ
+        "?етер"   - любой первый символ, затем "етер"
+        "*етер"   - заканчивается на "етер"
+    Если anchor_end=False (имя, отчество), шаблон не привязывается к концу
+    строки, а шаблон, начинающийся с "?" или "*", - и к началу: "*ван"
+    находит и "Иван", и "Ивановна".
+
+    Возвращает словарь для QuerySet.filter(). Литеральный префикс шаблона
+    всегда уходит в startswith (диапазон индекса), регулярное выражение по
+    ключу добавляется, только если в шаблоне остались подстановки.
+    Пустой шаблон дает пустой словарь.
+    """
+    key = pattern_key(pattern)
+    if not key.strip(u"*"):
+        return {}
+    regex = key.replace(u"?", u".").replace(u"*", u".*")
+    if not anchor_end:
+        if not regex.startswith(u"."):
+            regex = u"^%s" % regex
+    elif regex.startswith(u".*"):
+        regex = u"%s$" % regex
+    else:
+        regex = u"^%s" % regex
+        if regex.endswith(u"."):
+            regex = u"%s$" % regex
+
+    lookups = {}
+    prefix = re.split(r"[\?\*]", key, 1)[0]
+    if prefix:
+        lookups["%s__startswith" % field] = prefix
+    # Литерал или литерал со звездочками в конце - хватает одного префикса.
+    if not prefix or key[len(prefix):].strip(u"*"):
+        lookups["%s__regex" % field] = regex
+    return lookups
+
+
+# Число для значений без цифр: такие значения сортируются после номеров.
+NATURAL_KEY_NO_NUMBER = 9999999999
+
+
+def natural_key(value):
+    """
+    Ключ "естественной" сортировки: (префикс, число, суффикс).
+    "12а" -> (u"", 12, u"а"), "б/н" -> (u"б/н", 9999999999, u"").
+    Разбор тот же, что был в представлениях common_burial1/common_place1.
+    """
+    m = re.match(r"(\D*)(\d*)(.*)$", value or u"", re.DOTALL)
+    prefix, digits, suffix = m.groups()
+    if digits:
+        number = float(digits[:10])
+    else:
+        number = float(NATURAL_KEY_NO_NUMBER)
+    return prefix, number, suffix
+
+
+GRAM_SIZE = 3
+
+
+def comment_key(value):
+    """
+    Нормализация текста комментария для n-граммного индекса.
+    """
+    return (value or u"").lower().replace(u"ё", u"е")
+
+
+def ngrams(text):
+    """
+    Множество n-грамм (по умолчанию триграмм) строки.
+    """
+    return set([text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)])
+
+
+def infix_grams(pattern):
+    """
+    N-граммы литеральных кусков шаблона, который начинается с подстановки
+    ("*етер", "?етер*"). Для шаблонов с литеральным префиксом хватает
+    индекса по ключу (см. name_lookups), поэтому результат пустой.
+    """
+    key = pattern_key(pattern)
+    if not key or key[0] not in u"?*":
+        return set()
+    grams = set()
+    for part in re.split(r"[\?\*]+", key):
+        grams |= ngrams(part)
+    return grams
@@ -0,0 +1,2 @@
+-- Составной индекс для сортировки по номеру в книге учета (natural_key).
+CREATE INDEX common_burial_abn_natural ON common_burial (abn_prefix, abn_number, abn_suffix);
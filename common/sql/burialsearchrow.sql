@@ -0,0 +1,7 @@
+-- Составные индексы для сортировок главной страницы.
+CREATE INDEX common_burialsearchrow_fio ON common_burialsearchrow (last_name, first_name, patronymic);
+CREATE INDEX common_burialsearchrow_abn_natural ON common_burialsearchrow (abn_prefix, abn_number, abn_suffix);
+CREATE INDEX common_burialsearchrow_area_natural ON common_burialsearchrow (area_prefix, area_number, area_suffix);
+CREATE INDEX common_burialsearchrow_row_natural ON common_burialsearchrow (row_prefix, row_number, row_suffix);
+CREATE INDEX common_burialsearchrow_seat_natural ON common_burialsearchrow (seat_prefix, seat_number, seat_suffix);
+CREATE INDEX common_burialsearchrow_place ON common_burialsearchrow (cemetery_id, area, row, seat);
@@ -0,0 +1,4 @@
+-- Составные индексы для сортировки по участку, ряду, месту (natural_key).
+CREATE INDEX common_place_area_natural ON common_place (area_prefix, area_number, area_suffix);
+CREATE INDEX common_place_row_natural ON common_place (row_prefix, row_number, row_suffix);
+CREATE INDEX common_place_seat_natural ON common_place (seat_prefix, seat_number, seat_suffix);
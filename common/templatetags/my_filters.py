@@ -1,8 +1,10 @@
 from django import template
 from django.utils.encoding import force_unicode
 
+from common.principal import get_principal
+
 register = template.Library()
 
 @register.filter
 def in_group(user, group):
-    return bool(user.groups.filter(name__iexact=group))
\ No newline at end of file
+    return get_principal(user).in_group(group, ignore_case=True)
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """
 This file demonstrates two different styles of tests (one doctest and one
 unittest). These will both pass when you run "manage.py test".
@@ -5,7 +6,46 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+from django.http import QueryDict
+from django.utils import simplejson
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.contrib.auth.models import Group, User
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from common.models import Person, SearchGram, Soul, Organization, Cemetery, ProductType, Place, Operation
+from common.models import Burial, BurialSearchRow, Phone, OrderFiles, Role, UserProfile, ChangeCounter
+from common.models import GeoCountry, GeoRegion, GeoCity, Street, Location, ImportJob, ChangeLog
+from common.models import SyncState, Env, ImpCem, ImpBur, import_storage
+from common import models
+from common.inbox import InboxApplier, source_state
+from common.csvexport import export_csv
+from common.address import AddressResolver
+from common.importer import CsvImporter, ParallelImporter, CsvValidator, PlaceCache, run_job, make_importer
+from common.pgimport import StageStream, PgCopyImporter
+from common.printing import print_burials
+from simplepagination.backends.keyset import KeysetPaginator
+from common import counts
+from common.principal import Principal, SESSION_KEY
+from common import autocomplete, geocache
+from common.utils import ProcessCache
+from common.search import name_key, name_lookups, infix_grams, phonetic_key, natural_key
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +61,1264 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+class NameSearchTest(TestCase):
+    def test_name_key(self):
+        self.assertEqual(name_key(u"Пётр-Иванов "), u"петриванов")
+        self.assertEqual(name_key(None), u"")
+
+    def test_name_lookups(self):
+        self.assertEqual(name_lookups("k", u"Петр"), {"k__startswith": u"петр"})
+        self.assertEqual(name_lookups("k", u"Петр*"), {"k__startswith": u"петр"})
+        self.assertEqual(name_lookups("k", u"Петр?"), {"k__startswith": u"петр", "k__regex": u"^петр.$"})
+        self.assertEqual(name_lookups("k", u"Петр?", anchor_end=False),
+                         {"k__startswith": u"петр", "k__regex": u"^петр."})
+        self.assertEqual(name_lookups("k", u"*етер"), {"k__regex": u".*етер$"})
+        self.assertEqual(name_lookups("k", u"?етер"), {"k__regex": u"^.етер"})
+        self.assertEqual(name_lookups("k", u"*"), {})
+        self.assertEqual(name_lookups("k", u"*ван", anchor_end=False), {"k__regex": u".*ван"})
+        self.assertEqual(name_lookups("k", u"?ван", anchor_end=False), {"k__regex": u".ван"})
+
+    def test_person_search(self):
+        Person(last_name=u"Пётров", first_name=u"Иван").save()
+        Person(last_name=u"Петраков").save()
+        found = Person.objects.filter(**name_lookups("last_name_key", u"петр?в"))
+        self.assertEqual([p.last_name for p in found], [u"Пётров"])
+        found = Person.objects.filter(**name_lookups("last_name_key", u"ПЕТР")).order_by("last_name")
+        self.assertEqual([p.last_name for p in found], [u"Петраков", u"Пётров"])
+
+    def test_first_name_infix(self):
+        Person(last_name=u"Петров", first_name=u"Иван").save()
+        Person(last_name=u"Петрова", first_name=u"Ивановна").save()
+        found = Person.objects.filter(**name_lookups("first_name_key", u"*ван", anchor_end=False))
+        self.assertEqual(sorted([p.first_name for p in found]), [u"Иван", u"Ивановна"])
+
+    def test_infix_grams(self):
+        self.assertEqual(infix_grams(u"Петр*"), set())
+        self.assertEqual(infix_grams(u"*етер"), set([u"ете", u"тер"]))
+        self.assertEqual(infix_grams(u"?ет*ров"), set([u"ров"]))
+
+    def test_gram_index(self):
+        petrov = Person(last_name=u"Петров")
+        petrov.save()
+        Person(last_name=u"Сидоров").save()
+        ids = SearchGram.objects.matching(SearchGram.LAST_NAME, infix_grams(u"*етров"))
+        self.assertEqual([p.last_name for p in Person.objects.filter(pk__in=ids)], [u"Петров"])
+        petrov.last_name = u"Иванов"
+        petrov.save()
+        self.assertEqual(Person.objects.filter(pk__in=ids).count(), 0)
+
+    def test_phonetic_key(self):
+        self.assertEqual(phonetic_key(u"Петров"), phonetic_key(u"Петрофф"))
+        self.assertEqual(phonetic_key(u"Шевченко"), phonetic_key(u"Шевченка"))
+        self.assertNotEqual(phonetic_key(u"Петров"), phonetic_key(u"Сидоров"))
+        person = Person(last_name=u"Петрофф")
+        person.save()
+        self.assertEqual(Person.objects.get(last_name_phonetic=phonetic_key(u"петров")), person)
+
+
+class SortKeyTest(TestCase):
+    def test_natural_key(self):
+        self.assertEqual(natural_key(u"12а"), (u"", 12.0, u"а"))
+        self.assertEqual(natural_key(u"кв3-1"), (u"кв", 3.0, u"-1"))
+        self.assertEqual(natural_key(u"б/н"), (u"б/н", 9999999999.0, u""))
+        self.assertEqual(natural_key(u""), (u"", 9999999999.0, u""))
+        values = [u"10", u"9а", u"9", u"100", u"б/н"]
+        self.assertEqual(sorted(values, key=natural_key), [u"9", u"9а", u"10", u"100", u"б/н"])
+
+
+class KeysetPaginationTest(TestCase):
+    def walk(self, qs, per_page):
+        paginator = KeysetPaginator()
+        pages = []
+        params = QueryDict("", mutable=True)
+        objects, number_of_pages, extra = paginator.paginate_objects(qs, per_page, 1, params)
+        pages.append(objects)
+        for page in range(2, number_of_pages + 1):
+            params = QueryDict("after=%s" % extra["next_cursor"], mutable=True)
+            objects, number_of_pages, extra = paginator.paginate_objects(qs, per_page, page, params)
+            self.assertFalse("after" in params)
+            pages.append(objects)
+        # Обратно по ссылкам "назад".
+        for page in range(number_of_pages - 1, 0, -1):
+            params = QueryDict("before=%s" % extra["previous_cursor"], mutable=True)
+            objects, number_of_pages, extra = paginator.paginate_objects(qs, per_page, page, params)
+            self.assertEqual(objects, pages[page - 1])
+        return pages
+
+    def test_keyset_pages(self):
+        for i, (ln, fn) in enumerate([(u"Иванов", u"Петр"), (u"Иванов", u""), (u"Петров", u"Иван"),
+                                      (u"Петров", u"Иван"), (u"Сидоров", u"Олег"), (u"Агеев", u"Иван"),
+                                      (u"Иванов", u"Петр")]):
+            death_date = i % 3 and datetime.date(2000, 1, i + 1) or None
+            Person(last_name=ln, first_name=fn, death_date=death_date).save()
+        for ordering in [("last_name", "first_name"), ("-last_name", "first_name"),
+                         ("death_date",), ("-death_date", "last_name")]:
+            qs = Person.objects.order_by(*ordering)
+            expected = list(qs.order_by(*(ordering + ("pk", ))))
+            pages = self.walk(qs, 3)
+            self.assertEqual([len(page) for page in pages], [3, 3, 1])
+            self.assertEqual(sum(pages, []), expected)
+            # Последняя страница по номеру читается с конца списка.
+            objects = KeysetPaginator().paginate_objects(qs, 3, 3, QueryDict("", mutable=True))[0]
+            self.assertEqual(objects, expected[6:])
+
+
+class SearchCountTest(TestCase):
+    def test_criteria_key(self):
+        key = counts.criteria_key({"fio": u" Петров ", "per_page": 10, "area": u"", "trash": False})
+        self.assertEqual(key, counts.criteria_key({"fio": u"петров", "records_order_by": u"date_fact"}))
+        self.assertNotEqual(key, counts.criteria_key({"fio": u"петров", "trash": True}))
+
+    def test_cached_count(self):
+        Person(last_name=u"Петров").save()
+        criteria = {"fio": u"Петров"}
+        self.assertEqual(counts.cached_count(Person.objects.all(), criteria), 1)
+        Person.objects.all().delete()
+        # Удаление через QuerySet шлет post_delete, кэш сбрасывается.
+        self.assertEqual(counts.cached_count(Person.objects.all(), criteria), 0)
+
+    def test_generation_survives_cache(self):
+        key = counts.criteria_key({"fio": u"Петров"})
+        counts.invalidate()
+        # Поколение хранится в базе: очистка или истечение кэша не
+        # возвращает старые ключи.
+        cache.clear()
+        self.assertNotEqual(counts.criteria_key({"fio": u"Петров"}), key)
+
+
+class BurialTestCase(TestCase):
+    """
+    Кладбище, место и все, что нужно для создания захоронений.
+    """
+    def setUp(self):
+        self.creator = Soul.objects.create()
+        org = Organization.objects.create(name=u"Ритуал")
+        self.cemetery = Cemetery.objects.create(organization=org, name=u"Северное", creator=self.creator)
+        self.p_type = ProductType.objects.create(name=u"Место")
+        self.operation = Operation.objects.create(op_type=u"Захоронение")
+
+    def make_burial(self, last_name, area=u"1", account_book_n=u"1"):
+        place = Place(soul=self.creator, name=u"место", p_type=self.p_type, cemetery=self.cemetery,
+                      area=area, row=u"2", seat=unicode(Place.objects.count() + 1), creator=self.creator)
+        place.save()
+        person = Person(last_name=last_name)
+        person.save()
+        customer = Person(last_name=u"Заказчиков")
+        customer.save()
+        burial = Burial(person=person, account_book_n=account_book_n, responsible=self.creator,
+                        customer=customer, product=place, operation=self.operation, creator=self.creator)
+        burial.save()
+        return burial
+
+
+class ChangeLogTest(BurialTestCase):
+    def test_changes(self):
+        burial = self.make_burial(u"Петров")
+        other = self.make_burial(u"Сидоров")
+        seq = ChangeLog.objects.last_seq()
+        self.assertEqual(list(ChangeLog.objects.changed_burials(0, seq).order_by("pk")),
+                         sorted([burial, other], key=lambda b: b.pk))
+        # Новые люди и места в журнал не попадают.
+        self.assertEqual(ChangeLog.objects.filter(entity__in=[ChangeLog.PERSON, ChangeLog.PLACE]).count(), 0)
+
+        # Одна запись на изменение, захоронения не переписываются.
+        person = burial.person
+        person.last_name = u"Иванов"
+        person.save()
+        self.assertEqual(ChangeLog.objects.last_seq(), seq + 1)
+        self.assertEqual(list(ChangeLog.objects.changed_burials(seq)), [burial])
+        place = other.product.place
+        place.gps_x = 1.5
+        place.save()
+        self.assertEqual(ChangeLog.objects.changed_burials(seq).count(), 2)
+
+        seq = ChangeLog.objects.last_seq()
+        self.assertEqual(ChangeLog.objects.changed_cemeteries(seq).count(), 0)
+        location = Location.objects.create()
+        self.cemetery.location = location
+        self.cemetery.save()
+        Phone.objects.create(soul=burial.customer, f_number=u"123")
+        self.assertEqual(ChangeLog.objects.last_seq(), seq + 1)
+        seq = ChangeLog.objects.last_seq()
+        location.house = u"5"
+        location.save()
+        Phone.objects.create(soul=self.cemetery.organization, f_number=u"456")
+        self.assertEqual([c.pk for c in ChangeLog.objects.changed_cemeteries(seq)], [self.cemetery.pk])
+        self.assertEqual(ChangeLog.objects.between(seq).count(), 2)
+
+
+class ExportChangesTest(BurialTestCase):
+    def setUp(self):
+        super(ExportChangesTest, self).setUp()
+        Env.objects.create()
+        self.outbox, settings.OUTBOX_DIR = settings.OUTBOX_DIR, tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.OUTBOX_DIR)
+        settings.OUTBOX_DIR = self.outbox
+        super(ExportChangesTest, self).tearDown()
+
+    def export(self, **options):
+        before = set(os.listdir(settings.OUTBOX_DIR))
+        call_command("export_changes", verbosity=0, **options)
+        names = sorted(set(os.listdir(settings.OUTBOX_DIR)) - before)
+        if not names:
+            return None
+        self.assertEqual(len(names), 1)
+        path = os.path.join(settings.OUTBOX_DIR, names[0])
+        f = names[0].endswith(".gz") and gzip.open(path, "rb") or open(path, "rb")
+        try:
+            return [simplejson.loads(line) for line in f]
+        finally:
+            f.close()
+
+    def test_export(self):
+        burial = self.make_burial(u"Петров")
+        self.make_burial(u"Сидоров")
+        records = self.export(chunk=1)
+        self.assertEqual([r["model"] for r in records], ["common.impcem"] + ["common.impbur"] * 2)
+        self.assertEqual(records[0]["fields"]["name"], u"Северное")
+        petrov = [r for r in records[1:] if r["fields"]["last_name"] == u"Петров"][0]
+        self.assertEqual((petrov["pk"], petrov["fields"]["bur_pk"], petrov["fields"]["cemetery"]),
+                         (burial.person_id, burial.pk, self.cemetery.pk))
+        self.assertEqual(SyncState.objects.seq("outbox"), ChangeLog.objects.last_seq())
+
+        # Следующая выгрузка - только новые изменения.
+        self.assertEqual(self.export(), None)
+        person = burial.person
+        person.first_name = u"Иван"
+        person.save()
+        records = self.export(gzip=True)
+        self.assertEqual([(r["model"], r["fields"]["first_name"]) for r in records], [("common.impbur", u"Иван")])
+
+        # Время изменения - по журналу, а не время выгрузки: полная
+        # выгрузка не делает старые записи новыми.
+        ChangeLog.objects.update(date_of_creation=datetime.datetime(2012, 1, 1))
+        ChangeLog.objects.filter(entity=ChangeLog.PERSON).update(date_of_creation=datetime.datetime(2012, 1, 2))
+        records = self.export(full=True)
+        self.assertEqual(sorted([(r["fields"].get("last_name"), r["fields"]["date_of_change"]) for r in records]),
+                         [(None, "2012-01-01 00:00:00"), (u"Петров", "2012-01-02 00:00:00"),
+                          (u"Сидоров", "2012-01-01 00:00:00")])
+        self.assertFalse([name for name in os.listdir(settings.OUTBOX_DIR) if name.endswith(".partial")])
+
+
+def is_postgresql():
+    return connection.settings_dict["ENGINE"].endswith("postgresql_psycopg2")
+
+
+class ExportChangesConcurrencyTest(TransactionTestCase):
+    """
+    Выгрузка при незакоммиченной записи журнала с меньшим номером.
+    """
+    def setUp(self):
+        Env.objects.create()
+        creator = Soul.objects.create()
+        org = Organization.objects.create(name=u"Ритуал")
+        self.first = Cemetery.objects.create(organization=org, name=u"Северное", creator=creator)
+        self.second = Cemetery.objects.create(organization=org, name=u"Южное", creator=creator)
+        self.outbox, settings.OUTBOX_DIR = settings.OUTBOX_DIR, tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.OUTBOX_DIR)
+        settings.OUTBOX_DIR = self.outbox
+
+    @unittest.skipUnless(is_postgresql(), "needs concurrent transactions (PostgreSQL)")
+    def test_in_flight_writer(self):
+        call_command("export_changes", verbosity=0)
+        for name in os.listdir(settings.OUTBOX_DIR):
+            os.remove(os.path.join(settings.OUTBOX_DIR, name))
+        logged, release = threading.Event(), threading.Event()
+
+        def writer():
+            # Своя транзакция в своем соединении: запись N без коммита.
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                ChangeLog.objects.log(ChangeLog.CEMETERY, self.first.pk)
+                logged.set()
+                release.wait(10)
+                transaction.commit()
+            finally:
+                transaction.leave_transaction_management()
+                connection.close()
+
+        def exporter():
+            try:
+                call_command("export_changes", verbosity=0)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer)]
+        threads[0].start()
+        logged.wait(10)
+        # Запись N+1 коммитится раньше N.
+        ChangeLog.objects.log(ChangeLog.CEMETERY, self.second.pk)
+        threads.append(threading.Thread(target=exporter))
+        threads[1].start()
+        time.sleep(0.5)
+        # Выгрузка ждет незакоммиченную запись, а не проходит мимо нее.
+        self.assertTrue(threads[1].isAlive())
+        release.set()
+        for thread in threads:
+            thread.join(10)
+        names = os.listdir(settings.OUTBOX_DIR)
+        self.assertEqual(len(names), 1)
+        records = [simplejson.loads(line) for line in open(os.path.join(settings.OUTBOX_DIR, names[0]))]
+        self.assertEqual(sorted([record["pk"] for record in records]), sorted([self.first.pk, self.second.pk]))
+        self.assertEqual(SyncState.objects.seq("outbox"), ChangeLog.objects.last_seq())
+
+    @unittest.skipUnless(is_postgresql(), "needs concurrent transactions (PostgreSQL)")
+    def test_busy_log(self):
+        call_command("export_changes", verbosity=0)
+        for name in os.listdir(settings.OUTBOX_DIR):
+            os.remove(os.path.join(settings.OUTBOX_DIR, name))
+        seq = SyncState.objects.seq("outbox")
+        logged, release = threading.Event(), threading.Event()
+
+        def writer():
+            # Долгая транзакция, которая пишет журнал.
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                ChangeLog.objects.log(ChangeLog.CEMETERY, self.first.pk)
+                logged.set()
+                release.wait(10)
+                transaction.commit()
+            finally:
+                transaction.leave_transaction_management()
+                connection.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        logged.wait(10)
+        attempts, models.CHANGE_LOG_LOCK_ATTEMPTS = models.CHANGE_LOG_LOCK_ATTEMPTS, 2
+        try:
+            started = time.time()
+            call_command("export_changes", verbosity=0)
+            # Выгрузка не ждет в очереди за транзакцией, а пропускает запуск.
+            self.assertTrue(time.time() - started < 5)
+        finally:
+            models.CHANGE_LOG_LOCK_ATTEMPTS = attempts
+            release.set()
+            thread.join(10)
+        self.assertEqual(os.listdir(settings.OUTBOX_DIR), [])
+        self.assertEqual(SyncState.objects.seq("outbox"), seq)
+
+
+class InboxApplierTest(BurialTestCase):
+    SOURCE = "11111111-2222-3333-4444-555555555555"
+
+    def setUp(self):
+        super(InboxApplierTest, self).setUp()
+        self.inbox = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.inbox)
+        super(InboxApplierTest, self).tearDown()
+
+    def write(self, after, upto, records, date="20120101120000"):
+        name = "%s.host.%s.%d-%d.ndjson" % (date, self.SOURCE, after, upto)
+        f = open(os.path.join(self.inbox, name), "wb")
+        for record in records:
+            f.write(simplejson.dumps(record) + "\n")
+        f.close()
+
+    def burial(self, last_name, date_of_change):
+        return {"model": "common.impbur", "pk": "d1", "fields": {
+            "bur_pk": "b1", "last_name": last_name, "first_name": u"Иван", "patronymic": None,
+            "birth_date": None, "death_date": "2011-05-01", "burial_date": "2011-05-03",
+            "cemetery": "c1", "area": "1", "row": "2", "seat": "3", "gps_x": 1.5, "gps_y": None,
+            "gps_z": None, "date_of_change": date_of_change, "unknown": 1}}
+
+    def apply(self, chunk=500):
+        applier = InboxApplier(self.inbox, chunk=chunk)
+        applier.run()
+        return applier.applied, applier.skipped, applier.waiting, applier.changed, applier.stale
+
+    def test_apply(self):
+        self.write(0, 2, [self.burial(u"Петров", "2012-01-01 12:00:00"),
+                          {"model": "common.impcem", "pk": "c1",
+                           "fields": {"name": u"Северное", "date_of_change": "2012-01-01 12:00:00"}}])
+        self.assertEqual(self.apply(chunk=1), (1, 0, 0, 2, 0))
+        burial = ImpBur.objects.get(pk="d1")
+        self.assertEqual((burial.last_name, burial.patronymic, burial.cemetery.name, burial.gps_x),
+                         (u"Петров", u"", u"Северное", 1.5))
+        self.assertEqual(burial.death_date, datetime.date(2011, 5, 1))
+        self.assertEqual(SyncState.objects.seq(source_state(self.SOURCE)), 2)
+        self.assertEqual(os.listdir(os.path.join(self.inbox, "applied")),
+                         ["20120101120000.host.%s.0-2.ndjson" % self.SOURCE])
+
+        # Повторная доставка пропускается, более старая версия не побеждает.
+        self.write(0, 2, [self.burial(u"Сидоров", "2012-01-02 12:00:00")], date="20120102120000")
+        self.write(2, 3, [self.burial(u"Иванов", "2011-12-31 12:00:00")])
+        self.assertEqual(self.apply(), (1, 1, 0, 0, 1))
+        self.assertEqual(ImpBur.objects.get(pk="d1").last_name, u"Петров")
+
+        self.write(3, 5, [self.burial(u"Сидоров", "2012-01-03 12:00:00")], date="20120103120000")
+        self.assertEqual(self.apply(), (1, 0, 0, 1, 0))
+        self.assertEqual(ImpBur.objects.get(pk="d1").last_name, u"Сидоров")
+        self.assertEqual(SyncState.objects.seq(source_state(self.SOURCE)), 5)
+
+    def test_chunk_queries(self):
+        def burials(count, last_name, date_of_change):
+            records = []
+            for i in range(count):
+                record = self.burial(last_name, date_of_change)
+                record["pk"] = "d%d" % i
+                records.append(record)
+            return records
+
+        self.write(0, 1, burials(10, u"Петров", "2012-01-01 12:00:00"))
+        self.apply()
+        # Существующие строки перезаписываются одним запросом, а не по
+        # UPDATE на строку.
+        self.write(1, 2, burials(20, u"Сидоров", "2012-01-02 12:00:00"))
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            self.assertEqual(self.apply(), (1, 0, 0, 20, 0))
+            writes = [q["sql"] for q in connection.queries if q["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+                      and "common_impbur" in q["sql"]]
+            self.assertEqual([sql.split()[0] for sql in writes], ["DELETE", "INSERT"])
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual(ImpBur.objects.filter(last_name=u"Сидоров").count(), 20)
+        self.assertEqual(ImpBur.objects.get(pk="d0").gps_x, 1.5)
+
+    def test_gap(self):
+        # Следующий файл пришел раньше предыдущего: ждет, пока не придет
+        # недостающий.
+        self.write(2, 3, [self.burial(u"Сидоров", "2012-01-02 12:00:00")], date="20120102120000")
+        self.assertEqual(self.apply(), (0, 0, 1, 0, 0))
+        self.assertEqual(SyncState.objects.seq(source_state(self.SOURCE)), 0)
+        self.assertFalse(ImpBur.objects.exists())
+        self.write(0, 2, [self.burial(u"Петров", "2012-01-01 12:00:00")])
+        self.assertEqual(self.apply(), (2, 0, 0, 2, 0))
+        self.assertEqual(ImpBur.objects.get(pk="d1").last_name, u"Сидоров")
+        self.assertEqual(SyncState.objects.seq(source_state(self.SOURCE)), 3)
+        self.assertEqual(len(os.listdir(os.path.join(self.inbox, "applied"))), 2)
+
+    def test_roundtrip(self):
+        Env.objects.create()
+        burial = self.make_burial(u"Петров")
+        outbox, settings.OUTBOX_DIR = settings.OUTBOX_DIR, self.inbox
+        try:
+            call_command("export_changes", verbosity=0, gzip=True)
+        finally:
+            settings.OUTBOX_DIR = outbox
+        self.assertEqual(self.apply(), (1, 0, 0, 2, 0))
+        row = ImpBur.objects.get(pk=burial.person_id)
+        self.assertEqual((row.bur_pk, row.last_name, row.cemetery_id), (burial.pk, u"Петров", self.cemetery.pk))
+        self.assertEqual(ImpCem.objects.get(pk=self.cemetery.pk).name, u"Северное")
+
+
+class ExportTerminalsTest(BurialTestCase):
+    def setUp(self):
+        super(ExportTerminalsTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.exports = settings.TERMINAL_EXPORTS
+        settings.TERMINAL_EXPORTS = (
+            {"path": os.path.join(self.dir, "export.csv")},
+            {"path": os.path.join(self.dir, "vost.csv"), "upper": True, "columns": ("last_name", "initials", "seat"),
+             "dialect": {"delimiter": " ", "quotechar": '"', "quoting": csv.QUOTE_ALL}},
+            {"path": os.path.join(self.dir, "other.csv"), "cemeteries": ["other"]},
+        )
+
+    def tearDown(self):
+        settings.TERMINAL_EXPORTS = self.exports
+        shutil.rmtree(self.dir)
+        super(ExportTerminalsTest, self).tearDown()
+
+    def read(self, name):
+        return open(os.path.join(self.dir, name), "rb").read().decode("cp1251")
+
+    def test_export(self):
+        burial = self.make_burial(u"Петров")
+        burial.date_fact = datetime.datetime(2011, 5, 3, 10, 0)
+        burial.save()
+        person = burial.person
+        person.first_name, person.patronymic = u"иван", u"Петрович"
+        person.save()
+        self.make_burial(u"Неизвестен")
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            call_command("export_terminals", verbosity=0)
+            self.assertEqual(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = debug
+        seat = burial.product.place.seat
+        self.assertEqual(self.read("export.csv"),
+                         u"%s\tПетров\tИ.П.\t03.05.2011\t1\t2\t%s\tСеверное\r\n" % (person.pk, seat))
+        self.assertEqual(self.read("vost.csv"), u'"ПЕТРОВ" "И.П." "%s"\r\n' % seat)
+        self.assertEqual(self.read("other.csv"), u"")
+        self.assertEqual(sorted(os.listdir(self.dir)), ["export.csv", "other.csv", "vost.csv"])
+
+
+class DirtyFieldsTest(BurialTestCase):
+    def queries(self, func):
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            func()
+        finally:
+            settings.DEBUG = debug
+        return [q["sql"] for q in connection.queries]
+
+    def test_save(self):
+        pk = self.make_burial(u"Петров").pk
+        Burial.objects.filter(pk=pk).update(date_fact=datetime.datetime(2010, 1, 2))
+        burial = Burial.objects.get(pk=pk)
+        person, place = burial.person, burial.product.place
+        seq = ChangeLog.objects.last_seq()
+        # Без изменений ничего не пишется.
+        # Дата из формы вместо даты и времени из базы - не изменение.
+        burial.date_fact = datetime.date(2010, 1, 2)
+        self.assertEqual(self.queries(lambda: (person.save(), burial.save(), place.save())), [])
+
+        person.first_name = u"Иван"
+        # Захоронения (last_sync_date) и душа не переписываются.
+        queries = [sql for sql in self.queries(person.save)
+                   if sql.startswith(('UPDATE "common_person"', 'UPDATE "common_soul"', 'UPDATE "common_burial"'))]
+        self.assertEqual(len(queries), 1)
+        self.assertTrue("common_person" in queries[0] and "first_name" in queries[0] and
+                        "last_name\"" not in queries[0])
+        self.assertEqual(person.changed_fields, set(["first_name", "first_name_key"]))
+        self.assertEqual(Person.objects.get(pk=person.pk).first_name, u"Иван")
+        self.assertEqual(BurialSearchRow.objects.get(burial=burial).first_name, u"Иван")
+        self.assertEqual(ChangeLog.objects.last_seq(), seq + 1)
+        self.assertEqual(self.queries(person.save), [])
+
+        # Поля души - в таблице common_soul; невыгружаемые поля журнал не трогают.
+        person.death_date = datetime.date(2010, 1, 2)
+        person.save()
+        self.assertEqual(Soul.objects.get(pk=person.pk).death_date, datetime.date(2010, 1, 2))
+        burial.customer.creator = self.creator
+        burial.customer.save()
+        self.assertEqual(ChangeLog.objects.last_seq(), seq + 2)
+
+
+class BurialSearchRowTest(BurialTestCase):
+    def test_row_maintained(self):
+        burial = self.make_burial(u"Петров", area=u"12а", account_book_n=u"7")
+        row = BurialSearchRow.objects.get(burial=burial)
+        self.assertEqual((row.last_name, row.last_name_key, row.area, row.area_number, row.abn_number),
+                         (u"Петров", u"петров", u"12а", 12.0, 7.0))
+        self.assertEqual((row.cemetery_name, row.op_type, row.customer_last_name),
+                         (u"Северное", u"Захоронение", u"Заказчиков"))
+
+        person = burial.person
+        person.last_name = u"Сидоров"
+        person.save()
+        Phone.objects.create(soul=burial.customer, f_number=u"123")
+        OrderFiles.objects.create(order=burial, ofile=u"ofiles/a.txt")
+        self.cemetery.name = u"Южное"
+        self.cemetery.save()
+        row = BurialSearchRow.objects.get(burial=burial)
+        self.assertEqual((row.last_name_key, row.customer_phones, row.has_files, row.cemetery_name),
+                         (u"сидоров", u"123", True, u"Южное"))
+
+        Phone.objects.all().delete()
+        self.assertEqual(BurialSearchRow.objects.get(burial=burial).customer_phones, u"")
+        burial.delete()
+        self.assertEqual(BurialSearchRow.objects.count(), 0)
+
+    def test_main_page(self):
+        self.make_burial(u"Петров", area=u"10")
+        self.make_burial(u"Петраков", area=u"9")
+        self.make_burial(u"Сидоров")
+        response = self.client.get("/", {"cemetery": "", "fio": u"петр", "records_order_by": "product__place__area",
+                                         "per_page": 10})
+        self.assertEqual([b.last_name for b in response.context["object_list"]], [u"Петраков", u"Петров"])
+        self.assertEqual(response.context["obj_nr"], 2)
+
+
+class PrefetchRelatedTest(BurialTestCase):
+    def count_queries(self, func):
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            result = func()
+        finally:
+            settings.DEBUG = debug
+        return len(connection.queries), result
+
+    def test_reverse_fk(self):
+        for name in (u"Петров", u"Сидоров", u"Иванов"):
+            burial = self.make_burial(name)
+            burial.add_comment(u"к %s" % name, self.creator)
+            burial.add_comment(u"еще", self.creator)
+            Phone.objects.create(soul=burial.customer, f_number=name)
+        def read():
+            rows = BurialSearchRow.objects.order_by("last_name").prefetch_related(
+                "burial__ordercomments_set", "burial__customer__phone_set")
+            return [([c.comment for c in row.burial.ordercomments_set.all()],
+                     row.burial.ordercomments_set.count(),
+                     [p.f_number for p in row.burial.customer.phone_set.all()]) for row in rows]
+        # Строки, захоронения, комментарии, заказчики, телефоны.
+        queries, result = self.count_queries(read)
+        self.assertEqual(queries, 5)
+        self.assertEqual(result[0], ([u"к Иванов", u"еще"], 2, [u"Иванов"]))
+        self.assertEqual(result[2], ([u"к Сидоров", u"еще"], 2, [u"Сидоров"]))
+
+    def test_many_to_many(self):
+        org = self.cemetery.organization
+        groups = [Group.objects.create(name=name) for name in ("a", "b", "c")]
+        for i in range(3):
+            role = Role.objects.create(organization=org, name=str(i), creator=self.creator)
+            role.djgroups.add(*groups[:i])
+        def read():
+            return [[g.name for g in role.djgroups.all()]
+                    for role in Role.objects.order_by("name").prefetch_related("djgroups")]
+        queries, result = self.count_queries(read)
+        self.assertEqual(queries, 2)
+        self.assertEqual(result, [[], ["a"], ["a", "b"]])
+        roles = [sorted([r.name for r in g.role_set.all()]) for g in
+                 Group.objects.order_by("name").prefetch_related("role_set")]
+        self.assertEqual(roles, [["1", "2"], ["2"], []])
+
+
+class BulkCreateTest(BurialTestCase):
+    def count_queries(self, func):
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            result = func()
+        finally:
+            settings.DEBUG = debug
+        return len(connection.queries), result
+
+    def test_inherited(self):
+        persons = [Person(last_name=name, creator=self.creator) for name in (u"Петров", u"Сидоров", u"Иванов")]
+        # Одна вставка в таблицу Soul и одна в таблицу Person.
+        queries, result = self.count_queries(lambda: Person.objects.bulk_create(persons))
+        self.assertEqual(queries, 2)
+        self.assertEqual(result, persons)
+        self.assertTrue(persons[0].pk and persons[0].soul_ptr_id == persons[0].pk)
+        self.assertEqual(len(set([p.pk for p in persons])), 3)
+        self.assertEqual(sorted(Person.objects.filter(pk__in=[p.pk for p in persons])
+                                .values_list("last_name", flat=True)), [u"Иванов", u"Петров", u"Сидоров"])
+        self.assertEqual(Soul.objects.filter(pk=persons[1].pk, date_of_creation__isnull=False).count(), 1)
+
+    def test_batches_and_raw(self):
+        queries, result = self.count_queries(lambda: Phone.objects.bulk_create(
+            [Phone(soul=self.creator, f_number=str(i)) for i in range(5)], batch_size=2))
+        self.assertEqual(queries, 3)
+        self.assertEqual(Phone.objects.filter(soul=self.creator).count(), 5)
+        self.assertEqual(Phone.objects.bulk_create([]), [])
+
+        soul = Soul(uuid=u"00000000-0000-0000-0000-000000000001", date_of_creation=datetime.datetime(2001, 2, 3))
+        Soul.objects.bulk_create([soul], raw=True)
+        self.assertEqual(Soul.objects.get(pk=soul.pk).date_of_creation.year, 2001)
+
+
+class CsvExportTest(BurialTestCase):
+    def test_export(self):
+        country = GeoCountry.objects.create(name=u"Беларусь")
+        region = GeoRegion.objects.create(country=country, name=u"Минская")
+        city = GeoCity.objects.create(country=country, region=region, name=u"Минск")
+        street = Street.objects.create(city=city, name=u"Ленина")
+        first = self.make_burial(u"Петров", account_book_n=u"1")
+        first.date_fact = datetime.datetime(2010, 1, 2)
+        first.save()
+        first.add_comment(u"а\tб", self.creator)
+        customer = first.customer
+        customer.location = Location.objects.create(street=street, house=u"5")
+        customer.save()
+        Phone.objects.create(soul=customer, f_number=u"123")
+        for i in range(4):
+            self.make_burial(u"Иванов", account_book_n=unicode(i + 2))
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            chunks = list(export_csv(BurialSearchRow.objects.all(), chunk=2))
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = debug
+        # Три порции по четыре запроса; неполная последняя порция
+        # заканчивает выборку без лишнего запроса.
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(queries, 3 * 4)
+        lines = "".join(chunks).decode(settings.CSV_ENCODING).splitlines()
+        self.assertEqual(len(lines), 5)
+        fields = lines[-1].split(u'","')
+        self.assertEqual(fields[1:4], [u"1", u"Петров", u""])
+        self.assertEqual(fields[6], u"2010-01-02 00:00:00")
+        self.assertEqual(fields[14:17], [u"Минск", u"Ленина", u"5"])
+        self.assertEqual(fields[19].split(u"~")[1], u"а б")
+        self.assertEqual(fields[20:23], [u"Беларусь", u"Минская", u"123"])
+        self.assertEqual(fields[27], u"Захоронение\"")
+        response = self.client.get("/", {"cemetery": "", "fio": u"Петров", "export_csv": "1"})
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response.content.decode(settings.CSV_ENCODING).splitlines(), lines[-1:])
+
+
+class PrintTest(BurialTestCase):
+    def setUp(self):
+        super(PrintTest, self).setUp()
+        self.max_rows = settings.PRINT_MAX_ROWS
+        settings.PRINT_MAX_ROWS = 3
+
+    def tearDown(self):
+        settings.PRINT_MAX_ROWS = self.max_rows
+
+    def test_continue(self):
+        for name in (u"Агеев", u"Борисов", u"Васильев", u"Горин", u"Дроздов"):
+            self.make_burial(name)
+        rows = BurialSearchRow.objects.order_by("last_name").prefetch_related("burial__ordercomments_set")
+        html = u"".join(print_burials(rows, 5, QueryDict("print=1")))
+        self.assertTrue(u"Васильев" in html)
+        self.assertFalse(u"Горин" in html)
+        self.assertTrue(u"Напечатано записей: 3" in html)
+        url = html.split(u'href="')[1].split(u'"')[0].replace(u"&amp;", u"&")
+        html = u"".join(print_burials(rows, 5, QueryDict(url[1:])))
+        self.assertFalse(u"Васильев" in html)
+        self.assertTrue(u"Горин" in html and u"Дроздов" in html)
+        self.assertFalse(u"Продолжить" in html)
+
+
+class PrincipalTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="clerk")
+        self.user.groups.add(Group.objects.create(name="journal"))
+        person = Person.objects.create(last_name=u"Петров", patronymic=u"Иванович")
+        UserProfile.objects.create(user=self.user, soul=person)
+
+    def queries(self, func):
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            result = func()
+        finally:
+            settings.DEBUG = debug
+        return len(connection.queries), result
+
+    def test_groups_cached_in_session(self):
+        session = {}
+        principal = Principal(self.user, session)
+        self.assertEqual(self.queries(lambda: (principal.in_group("journal"),
+                                               principal.in_group("JOURNAL", ignore_case=True),
+                                               principal.in_group("edit_burial"))),
+                         (2, (True, True, False)))
+        # Следующий запрос той же сессии - только чтение версии групп.
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(self.queries(lambda: Principal(user, session).in_group("journal")), (1, True))
+        # Изменение групп сбрасывает сохраненное в сессии.
+        user.groups.add(Group.objects.create(name="edit_burial"))
+        self.assertEqual(self.queries(lambda: Principal(user, session).in_group("edit_burial")), (2, True))
+
+    def test_revoked_group(self):
+        session = {}
+        self.assertTrue(Principal(self.user, session).in_group("journal"))
+        self.user.groups.clear()
+        # Версия хранится в базе: ее видят все процессы, и она не
+        # возвращается к значению, сохраненному в сессии.
+        self.assertFalse(Principal(User.objects.get(pk=self.user.pk), session).in_group("journal"))
+        self.assertTrue(session[SESSION_KEY][0] > 0)
+
+    def test_profile(self):
+        user = User.objects.get(pk=self.user.pk)
+        principal = Principal(user)
+        self.assertEqual(self.queries(lambda: principal.person.patronymic), (2, u"Иванович"))
+        self.assertEqual(self.queries(lambda: (principal.person.patronymic,
+                                               user.userprofile.soul.pk)),
+                         (0, (u"Иванович", principal.soul.pk)))
+
+
+class AutocompleteTest(BurialTestCase):
+    def test_prefix_index(self):
+        index = autocomplete.PrefixIndex([u"Петров", u"Пётр", u"петров", u"Иванов", u"Петров", u""])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup(u"пет"), [u"Пётр", u"Петров", u"петров"])
+        self.assertEqual(index.lookup(u"ПЁТРО"), [u"Петров", u"петров"])
+        self.assertEqual(index.lookup(u"пе", limit=1), [u"Пётр"])
+        self.assertEqual(index.lookup(u"Сидоров"), [])
+
+    def test_lookup_follows_changes(self):
+        self.make_burial(u"Петров")
+        completer = ProcessCache(ChangeCounter.AUTOCOMPLETE, autocomplete.build_indexes)
+        completer.refresh(force=True)
+        self.assertEqual(completer.get()[autocomplete.DEADMEN].lookup(u"пет"), [u"Петров  "])
+        self.assertEqual(completer.get()[autocomplete.CUSTOMERS].lookup(u"зак"), [u"Заказчиков"])
+
+        version = ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE)
+        burial = self.make_burial(u"Петренко")
+        self.assertTrue(ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE) > version)
+        # До истечения интервала проверки - старый индекс и ни одного запроса.
+        interval = settings.AUTOCOMPLETE_CHECK_INTERVAL
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            self.assertEqual(completer.get()[autocomplete.DEADMEN].lookup(u"пет"), [u"Петров  "])
+            self.assertEqual(len(connection.queries), 0)
+            settings.AUTOCOMPLETE_CHECK_INTERVAL = 0
+            self.assertEqual(completer.get()[autocomplete.DEADMEN].lookup(u"пет"),
+                             [u"Петренко  ", u"Петров  "])
+        finally:
+            settings.DEBUG = debug
+            settings.AUTOCOMPLETE_CHECK_INTERVAL = interval
+
+    def test_bump_on_name_changes(self):
+        burial = self.make_burial(u"Петров")
+        version = ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE)
+        # Изменения не в ФИО индексов не трогают.
+        burial = Burial.objects.get(pk=burial.pk)
+        burial.account_book_n = u"2"
+        burial.save()
+        person = Person.objects.get(pk=burial.person_id)
+        person.birth_date = datetime.date(1950, 1, 2)
+        person.save()
+        Person(last_name=u"Сидоров").save()
+        self.assertEqual(ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE), version)
+        person.last_name = u"Петренко"
+        person.save()
+        self.assertEqual(ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE), version + 1)
+        burial.customer = person
+        burial.save()
+        self.assertEqual(ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE), version + 2)
+        burial.delete()
+        self.assertTrue(ChangeCounter.objects.value(ChangeCounter.AUTOCOMPLETE) > version + 2)
+
+    def test_background_rebuild(self):
+        builds, release = [], threading.Event()
+
+        def build():
+            if builds:
+                release.wait(10)
+            builds.append(len(builds))
+            return builds[-1]
+
+        completer = ProcessCache(ChangeCounter.AUTOCOMPLETE, build, background=True)
+        self.assertEqual(completer.get(), 0)
+        ChangeCounter.objects.bump(ChangeCounter.AUTOCOMPLETE)
+        interval, settings.AUTOCOMPLETE_CHECK_INTERVAL = settings.AUTOCOMPLETE_CHECK_INTERVAL, 0
+        try:
+            # Запрос не ждет построения: старые данные, пока строятся новые.
+            self.assertEqual(completer.get(), 0)
+            self.assertEqual(completer.get(), 0)
+            release.set()
+            completer.builder.join(10)
+            self.assertEqual(completer.get(), 1)
+            self.assertEqual(builds, [0, 1])
+        finally:
+            settings.AUTOCOMPLETE_CHECK_INTERVAL = interval
+
+
+class GeoTestCase(TestCase):
+    """
+    Страна, регион, нас. пункт и улица.
+    """
+    def setUp(self):
+        geocache.reset()
+        self.country = GeoCountry.objects.create(name=u"Беларусь")
+        self.region = GeoRegion.objects.create(country=self.country, name=u"Минская")
+        self.city = GeoCity.objects.create(country=self.country, region=self.region, name=u"Минск")
+        self.street = Street.objects.create(city=self.city, name=u"Ленина")
+
+
+class GeoCacheTest(GeoTestCase):
+    def test_resolve(self):
+        country = geocache.get_country(u"Беларусь")
+        region = geocache.get_region(country, u"Минская")
+        city = geocache.get_city(region, u"Минск")
+        street = geocache.get_street(city, u"Ленина")
+        self.assertEqual((country.pk, region.pk, city.pk, street.pk),
+                         (self.country.pk, self.region.pk, self.city.pk, self.street.pk))
+        self.assertEqual(city.country_id, self.country.pk)
+        self.assertEqual(geocache.get_street(city, u"Мира"), None)
+        self.assertEqual(geocache.get_city(None, u"Минск"), None)
+
+    def test_endpoints(self):
+        geocache.tree()
+        # Созданная в этом процессе улица попадает в дерево сразу.
+        Street.objects.create(city=self.city, name=u"Лесная")
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            response = self.client.get("/getstreets/", {"term": u"ле"})
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual(simplejson.loads(response.content),
+                         [u"Ленина/Минск/Минская/Беларусь", u"Лесная/Минск/Минская/Беларусь"])
+        self.assertEqual(queries, 0)
+        response = self.client.get("/getcities/", {"term": u"мин"})
+        self.assertEqual(simplejson.loads(response.content), [u"Минск/Минская/Беларусь"])
+        response = self.client.get("/getregions/", {"term": u"мин"})
+        self.assertEqual(simplejson.loads(response.content), [u"Минская/Беларусь"])
+        response = self.client.get("/getcountries/", {"term": u"бел"})
+        self.assertEqual(simplejson.loads(response.content), [u"Беларусь"])
+
+
+class AddressResolverTest(GeoTestCase):
+    def test_resolve(self):
+        resolver = AddressResolver()
+        street = resolver.resolve(u"Беларусь", u"Минская", u"Минск", u"мира")
+        self.assertEqual((street.name, street.city_id), (u"Мира", self.city.pk))
+        self.assertEqual(Street.objects.filter(city=self.city).count(), 2)
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            again = resolver.resolve(u"Беларусь", u"Минская", u"Минск", u"мира")
+            self.assertEqual(len(connection.queries), 0)
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual(again.pk, street.pk)
+
+        street = resolver.resolve(u"Россия", u"Московская", u"Москва", u"Тверская")
+        city = GeoCity.objects.get(pk=street.city_id)
+        self.assertEqual((city.region.name, city.country.name), (u"Московская", u"Россия"))
+
+    def test_rollback(self):
+        resolver = AddressResolver(capitalize=False)
+        street = resolver.street(self.city, u"Садовая")
+        street.delete()
+        resolver.rollback()
+        self.assertNotEqual(resolver.street(self.city, u"Садовая").pk, street.pk)
+
+
+class ImportTestCase(BurialTestCase):
+    """
+    Операции и тип места с uuid из настроек, строки файла импорта.
+    """
+    def setUp(self):
+        super(ImportTestCase, self).setUp()
+        geocache.reset()
+        # UUIDField создает новый uuid при вставке, поэтому известные uuid - через update().
+        for name in ("OPER_1", "OPER_2", "OPER_3", "OPER_4", "OPER_5", "OPER_6"):
+            operation = Operation.objects.create(op_type=name)
+            Operation.objects.filter(pk=operation.pk).update(uuid=getattr(settings, name))
+        ProductType.objects.filter(pk=self.p_type.pk).update(uuid=settings.PLACE_PRODUCTTYPE_ID)
+
+    def line(self, last_name, seat, date=u"2010-01-02", comment=u"N", op_type=u""):
+        values = [u"1", u"7", last_name, u"Иван", u"Иванович", u"", date, u"1", u"2", seat,
+                  u"Заказчиков", u"Петр", u"N", u"", u"Минск", u"Ленина", u"5", u"N", u"N", comment,
+                  u"Беларусь", u"Минская", u"123\n456", u"", u"", u"", u"", op_type]
+        return [v.encode(settings.CSV_ENCODING) for v in values]
+
+
+class ImportTest(ImportTestCase):
+    def test_import(self):
+        lines = [self.line(u"петров", u"1", comment=u"2011-02-03T04:05:06.000000~первый\tвторой",
+                           op_type=u"Урна"),
+                 self.line(u"сидоров", u"1"),
+                 self.line(u"иванов", u"2", date=u"вчера")]
+        importer = CsvImporter(self.cemetery, self.creator, chunk=2)
+        importer.run(lines)
+        self.assertEqual((importer.good_nr, importer.bad_nr), (2, 1))
+        self.assertEqual(importer.bad_lines, lines[2:])
+
+        burial = Burial.objects.get(person__last_name=u"Петров")
+        self.assertEqual(burial.operation_id, settings.OPER_5)
+        self.assertEqual([(c.comment, c.date_of_creation.year) for c in burial.ordercomments_set.all()][0],
+                         (u"первый", 2011))
+        self.assertEqual(burial.customer.phone_set.count(), 2)
+        self.assertEqual(burial.customer.location.street.city.region.name, u"Минская")
+        # Одно место на два захоронения, одна улица на всех заказчиков.
+        self.assertEqual(Burial.objects.filter(product=burial.product).count(), 2)
+        self.assertEqual(Street.objects.count(), 1)
+        self.assertEqual(BurialSearchRow.objects.filter(last_name=u"Сидоров").count(), 1)
+        self.assertEqual(BurialSearchRow.objects.get(last_name=u"Петров").customer_phones, u"123\n456")
+        self.assertTrue(SearchGram.objects.filter(kind=SearchGram.COMMENT, gram=u"пер").exists())
+        self.assertEqual(ChangeLog.objects.changed_burials(0).count(), 2)
+
+    def test_chunk_queries(self):
+        def run(n):
+            importer = CsvImporter(self.cemetery, self.creator)
+            importer.prepare([])
+            lines = [self.line(u"петров", u"1", comment=u"первый\tвторой") for i in range(n)]
+            debug, settings.DEBUG = settings.DEBUG, True
+            connection.queries = []
+            try:
+                importer.run(lines)
+            finally:
+                settings.DEBUG = debug
+            self.assertEqual(importer.good_nr, n)
+            return len(connection.queries)
+        # Адрес и места создаются первой порцией, дальше число запросов на
+        # порцию не зависит от числа строк в ней.
+        run(1)
+        self.assertEqual(run(2), run(10))
+
+    def test_chunk_fallback(self):
+        class FailingImporter(CsvImporter):
+            def save_chunk(self, rows):
+                if [values for values in rows if values["last_name"] == u"Сидоров"]:
+                    raise ValueError("bad chunk")
+                return super(FailingImporter, self).save_chunk(rows)
+
+            def save_row(self, values):
+                if values["last_name"] == u"Сидоров":
+                    raise ValueError("bad row")
+                return super(FailingImporter, self).save_row(values)
+        lines = [self.line(u"петров", u"1"), self.line(u"сидоров", u"2"), self.line(u"иванов", u"3")]
+        importer = FailingImporter(self.cemetery, self.creator)
+        importer.run(lines)
+        self.assertEqual((importer.good_nr, importer.bad_nr), (2, 1))
+        self.assertEqual(importer.bad_lines, [lines[1]])
+        self.assertEqual([str(error) for error in importer.errors], ["bad row"])
+
+
+class CsvValidatorTest(ImportTestCase):
+    def test_validate(self):
+        self.make_burial(u"Сидоров", account_book_n=u"50")
+        lines = [self.line(u"петров", u"1"), self.line(u"иванов", u"2", date=u"вчера"), [u"1"],
+                 self.line(u"козлов", u"3", op_type=u"кремация"), self.line(u"попов", u"1234567890"),
+                 self.line(u"лебедев", u"4"), self.line(u"орлов", u"5")]
+        for i, line in enumerate(lines):
+            if len(line) > 1:
+                line[1] = str(i + 1)
+        lines[3][2] = u"Козлов".encode("cp1251")
+        lines[5][1] = "1"
+        lines[6][1] = "50"
+        count = Burial.objects.count()
+        validator = CsvValidator(self.cemetery)
+        validator.run(lines)
+        self.assertEqual(Burial.objects.count(), count)
+        self.assertEqual((validator.good_nr, validator.bad_nr), (1, 6))
+        self.assertEqual(validator.bad_lines, lines[1:])
+        self.assertTrue(validator.errors[0].startswith("time data"))
+        self.assertEqual(validator.errors[1:], [
+            "Wrong number of columns: 1",
+            # Ошибка кодировки не мешает найти остальные.
+            "ln: not in utf8",
+            "seat: value is longer than 9 characters.",
+            "account_book_n: same as in line 1",
+            "account_book_n: already used in the cemetery"])
+        lines[3][2] = u"Козлов".encode("utf8")
+        validator = CsvValidator(self.cemetery)
+        validator.run(lines[3:4])
+        self.assertEqual(validator.errors, [u"op_type: unknown operation type кремация".encode("utf8")])
+
+
+class ParallelImportTest(ImportTestCase):
+    def test_partitions(self):
+        lines = [self.line(u"петров", u"1"), self.line(u"сидоров", u"2", date=u"вчера"),
+                 self.line(u"иванов", u"1"), self.line(u"козлов", u"3"), [u"1"], self.line(u"попов", u"4"),
+                 self.line(u"лебедев", u"5", date=u"завтра")]
+        # На SQLite части импортируются в этом же процессе.
+        importer = ParallelImporter(self.cemetery, self.creator, processes=2, chunk=2)
+        importer.run(lines)
+        self.assertEqual((importer.good_nr, importer.bad_nr), (4, 3))
+        # Отчет - в порядке строк файла.
+        self.assertEqual(importer.bad_lines, [lines[1], lines[4], lines[6]])
+        self.assertEqual(len(importer.errors), 3)
+        self.assertEqual(Place.objects.filter(cemetery=self.cemetery).count(), 3)
+        self.assertEqual(Street.objects.count(), 1)
+        self.assertEqual(BurialSearchRow.objects.filter(seat=u"1").count(), 2)
+
+    def test_place_case(self):
+        place = Place.objects.create(soul=self.creator, name=u"место", p_type=self.p_type, cemetery=self.cemetery,
+                                     area=u"1", row=u"2", seat=u"12А", creator=self.creator)
+        importer = CsvImporter(self.cemetery, self.creator)
+        importer.run([self.line(u"петров", u"12А"), self.line(u"сидоров", u"12а")])
+        self.assertEqual(importer.good_nr, 2)
+        # Значение из файла ищется так, как место сохранено (в нижнем регистре).
+        self.assertEqual(list(Place.objects.filter(cemetery=self.cemetery).values_list("pk", flat=True)),
+                         [place.pk])
+
+    def test_place_prefetch(self):
+        for area, row, seat in ((u"1", u"2", u"5"), (u"1", u"2", u"999"), (u"2", u"2", u"5")):
+            Place.objects.create(soul=self.creator, name=u"место", p_type=self.p_type, cemetery=self.cemetery,
+                                 area=area, row=row, seat=seat, creator=self.creator)
+        # Больше 999 ключей (предел параметров SQLite), запросы - порциями.
+        keys = [(u"1", u"2", unicode(i)) for i in range(1000)] + [(u"2", u"3", u"0")]
+        places = PlaceCache(self.cemetery, self.creator)
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            places.prefetch(keys)
+            self.assertEqual(len(connection.queries), 4)
+        finally:
+            settings.DEBUG = debug
+        # Только точные ключи, без перекрестных сочетаний участка/ряда/места.
+        self.assertEqual(sorted(places.places), [(u"1", u"2", u"5"), (u"1", u"2", u"999")])
+
+
+class PgCopyImportTest(ImportTestCase):
+    def test_stage_stream(self):
+        old = self.line(u"петров", u"1", comment=u"первый\tвторой")[:20]
+        lines = [old, [], [u"1"], self.line(u"сидоров", u"2"), [u"я".encode("cp1251")] * 20]
+        rejected = []
+        stream = StageStream(lines, rejected)
+        # Буфер copy_from меньше строки.
+        data = "".join(iter(lambda: stream.read(7), ""))
+        rows = [line.split("\t") for line in data.splitlines()]
+        self.assertEqual([(row[0], len(row)) for row in rows], [("0", 29), ("3", 29)])
+        self.assertEqual(rows[0][3].decode("utf8"), u"петров")
+        # Табуляция и перевод строки внутри значения экранируются,
+        # недостающие колонки старого формата - пустые.
+        self.assertEqual(rows[0][20].decode("utf8"), u"первый\\tвторой")
+        self.assertEqual(rows[0][21:], [""] * 8)
+        self.assertEqual(rows[1][23], "123\\n456")
+        self.assertEqual([(line_no, line) for line_no, line, error in rejected], [(2, lines[2]), (4, lines[4])])
+
+    def test_fallback(self):
+        # На SQLite импортирует ORM.
+        importer = make_importer(self.cemetery, self.creator, backend="copy")
+        self.assertTrue(isinstance(importer, CsvImporter))
+
+    def snapshot(self, cemetery):
+        """
+        Все, что импорт записал для захоронений кладбища, без uuid.
+        """
+        rows = []
+        for burial in Burial.objects.filter(product__place__cemetery=cemetery):
+            place, customer = burial.product.place, burial.customer.person
+            search_row = BurialSearchRow.objects.get(burial=burial)
+            rows.append((burial.account_book_n, burial.person.last_name, burial.person.first_name,
+                         burial.person.patronymic, burial.date_fact, burial.operation_id,
+                         place.area, place.row, place.seat, place.name,
+                         customer.last_name, customer.first_name, customer.patronymic,
+                         customer.location and (customer.location.street.name, customer.location.house),
+                         sorted(customer.phone_set.values_list("f_number", flat=True)),
+                         sorted(burial.ordercomments_set.values_list("comment", flat=True)),
+                         (search_row.last_name, search_row.seat, search_row.customer_phones),
+                         ChangeLog.objects.filter(entity=ChangeLog.BURIAL, obj_id=burial.pk).count()))
+        return sorted(rows)
+
+    @unittest.skipUnless(is_postgresql(), "COPY import needs PostgreSQL")
+    def test_backends_match(self):
+        # Название места длиннее поля - обрезается одинаково.
+        name = u"Северное кладбище имени очень длинного названия"
+        orm, copy = [Cemetery.objects.create(organization=self.cemetery.organization, name=name,
+                                             creator=self.creator) for i in range(2)]
+        lines = [self.line(u"петров", u"1", comment=u"первый\tвторой", op_type=u"Урна"),
+                 self.line(u"сидоров", u"1"), self.line(u"иванов", u"2", date=u"вчера"), [u"1"],
+                 self.line(u"козлов", u"3"), self.line(u"орлов", u"12А")]
+        for i, line in enumerate(lines):
+            if len(line) > 1:
+                line[1] = str(i + 1)
+        orm_importer = CsvImporter(orm, self.creator)
+        orm_importer.run(lines)
+        copy_importer = PgCopyImporter(copy, self.creator)
+        copy_importer.run(lines)
+        self.assertEqual((copy_importer.good_nr, copy_importer.bad_nr, copy_importer.bad_lines),
+                         (orm_importer.good_nr, orm_importer.bad_nr, orm_importer.bad_lines))
+        self.assertEqual(self.snapshot(copy), self.snapshot(orm))
+        self.assertEqual(len(self.snapshot(orm)), 4)
+        # Место - в нижнем регистре, как его сохраняет Place.save().
+        self.assertEqual(Place.objects.filter(cemetery=copy, seat=u"12а").count(), 1)
+
+
+class ImportJobTest(ImportTestCase):
+    def setUp(self):
+        super(ImportJobTest, self).setUp()
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        UserProfile.objects.create(user=self.user, soul=self.creator)
+        # Загрузки и отчеты - во временный каталог, а не в IMPORT_ROOT.
+        self.import_root, import_storage.location = import_storage.location, tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(import_storage.location)
+        import_storage.location = self.import_root
+
+    def csv_file(self, lines):
+        io = StringIO()
+        writer = csv.writer(io, "4mysql")
+        for line in lines:
+            writer.writerow(line)
+        return io.getvalue()
+
+    def test_run_job(self):
+        lines = [self.line(u"петров", u"1"), self.line(u"иванов", u"2", date=u"вчера")]
+        job = ImportJob(cemetery=self.cemetery, creator=self.creator, user=self.user)
+        job.csv_file.save("burials.csv", ContentFile(self.csv_file(lines)), save=False)
+        job.save()
+        self.assertEqual(ImportJob.objects.claim().pk, job.pk)
+        self.assertEqual(ImportJob.objects.claim(), None)
+
+        run_job(ImportJob.objects.get(pk=job.pk))
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.rows_done, job.good_nr, job.bad_nr), (ImportJob.DONE, 2, 1, 1))
+        self.assertTrue(job.finished and job.as_dict()["has_report"])
+        job.report.open("rb")
+        report = job.report.read()
+        job.report.close()
+        self.assertTrue("1/1" in report and self.csv_file(lines[1:]) in report)
+
+    def test_fail_dead(self):
+        # pid завершившегося процесса.
+        child = subprocess.Popen(["true"])
+        child.wait()
+        host = socket.gethostname()
+        jobs = []
+        for worker in ("%s:%d" % (host, child.pid), "%s:%d" % (host, os.getpid()), "other-host:%d" % child.pid):
+            job = ImportJob(cemetery=self.cemetery, creator=self.creator, user=self.user,
+                            status=ImportJob.RUNNING, worker=worker)
+            job.csv_file.save("burials.csv", ContentFile(""), save=False)
+            job.save()
+            jobs.append(job)
+        self.assertEqual(ImportJob.objects.fail_dead(), 1)
+        self.assertEqual([ImportJob.objects.get(pk=job.pk).status for job in jobs],
+                         [ImportJob.FAILED, ImportJob.RUNNING, ImportJob.RUNNING])
+        self.assertTrue(ImportJob.objects.get(pk=jobs[0].pk).as_dict()["finished"])
+        # Забранное задание помечено этим процессом.
+        for job in jobs[1:]:
+            ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.DONE)
+        ImportJob.objects.filter(pk=jobs[0].pk).update(status=ImportJob.QUEUED)
+        self.assertEqual(ImportJob.objects.claim().worker, "%s:%d" % (host, os.getpid()))
+
+    def test_views(self):
+        self.client.login(username="admin", password="admin")
+        upload = ContentFile(self.csv_file([self.line(u"петров", u"1")]))
+        upload.name = "burials.csv"
+        response = self.client.post("/management/import/", {"creator": self.user.pk, "cemetery": self.cemetery.pk,
+                                                             "csv_file": upload})
+        job = ImportJob.objects.get()
+        self.assertEqual((job.status, job.user_id, job.creator_id), (ImportJob.QUEUED, self.user.pk, self.creator.pk))
+        self.assertTrue(response["Location"].endswith("/management/import/%s/" % job.pk))
+        self.assertEqual(self.client.get("/management/import/%s/" % job.pk).status_code, 200)
+        status = simplejson.loads(self.client.get("/management/import/%s/status/" % job.pk).content)
+        self.assertEqual((status["status"], status["rows_done"], status["finished"], status["has_report"]),
+                         (ImportJob.QUEUED, 0, False, False))
+
+        # Только проверка: отчет сразу, задание не создается.
+        upload = ContentFile(self.csv_file([self.line(u"иванов", u"2", date=u"вчера")]))
+        upload.name = "burials.csv"
+        response = self.client.post("/management/import/", {"creator": self.user.pk, "cemetery": self.cemetery.pk,
+                                                             "csv_file": upload, "validate_only": "on"})
+        self.assertEqual(ImportJob.objects.count(), 1)
+        self.assertTrue("1/0/1" in response.content)
+
+
+class PgCopyJobTest(TransactionTestCase):
+    """
+    Задание импорта через COPY: progress задания коммитит по-настоящему.
+    """
+    line = ImportTestCase.__dict__["line"]
+
+    def setUp(self):
+        self.creator = Soul.objects.create()
+        org = Organization.objects.create(name=u"Ритуал")
+        self.cemetery = Cemetery.objects.create(organization=org, name=u"Северное", creator=self.creator)
+        p_type = ProductType.objects.create(name=u"Место")
+        ProductType.objects.filter(pk=p_type.pk).update(uuid=settings.PLACE_PRODUCTTYPE_ID)
+        operation = Operation.objects.create(op_type=u"OPER_1")
+        Operation.objects.filter(pk=operation.pk).update(uuid=settings.OPER_1)
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        geocache.reset()
+        self.import_root, import_storage.location = import_storage.location, tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(import_storage.location)
+        import_storage.location = self.import_root
+
+    @unittest.skipUnless(is_postgresql(), "COPY import needs PostgreSQL")
+    def test_run_job(self):
+        lines = [self.line(u"петров", u"1"), self.line(u"иванов", u"2", date=u"вчера")]
+        io = StringIO()
+        writer = csv.writer(io, "4mysql")
+        for line in lines:
+            writer.writerow(line)
+        job = ImportJob(cemetery=self.cemetery, creator=self.creator, user=self.user)
+        job.csv_file.save("burials.csv", ContentFile(io.getvalue()), save=False)
+        job.save()
+        job = ImportJob.objects.claim()
+        transaction.commit_manually(run_job)(job, backend="copy")
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.message), (ImportJob.DONE, u""))
+        self.assertEqual((job.rows_done, job.good_nr, job.bad_nr), (2, 1, 1))
+        self.assertEqual(Burial.objects.filter(product__place__cemetery=self.cemetery).count(), 1)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+def pk_chunks(qs, chunk):
+    """
+    Идем по values_list() порциями по первичному ключу (он должен быть первым
+    полем), чтобы не держать открытый курсор между коммитами.
+    """
+    last_pk = u""
+    while True:
+        rows = list(qs.filter(pk__gt=last_pk).order_by("pk")[:chunk])
+        if not rows:
+            break
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def iter_rows(qs, chunk=2000):
+    """
+    Строки values_list() одним запросом, не загружая результат в память:
+    на PostgreSQL - через именованный (серверный) курсор порциями по chunk,
+    на других базах - обычным iterator(). Вызывать внутри транзакции.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    if not connection.settings_dict["ENGINE"].endswith("postgresql_psycopg2"):
+        for row in qs.iterator():
+            yield row
+        return
+    sql, params = qs.query.get_compiler(DEFAULT_DB_ALIAS).as_sql()
+    connection.cursor()  # Открывает соединение, если его еще нет.
+    cursor = connection.connection.cursor(name="iter_rows_%d" % id(qs))
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+class ProcessCache(object):
+    """
+    Данные в памяти процесса: строятся функцией build и перестраиваются,
+    когда меняется счетчик изменений ChangeCounter с именем counter.
+    Счетчик проверяется не чаще раза в settings.AUTOCOMPLETE_CHECK_INTERVAL
+    секунд; изменения, сделанные в этом же процессе, сбрасывают данные
+    сразу (reset). С background=True устаревшие данные перестраиваются в
+    отдельном потоке, а до конца построения отдаются старые: запрос не
+    ждет построения (если данных нет совсем, они строятся сразу).
+    """
+    def __init__(self, counter, build, background=False):
+        self.counter = counter
+        self.build = build
+        self.background = background
+        self.data = None
+        self.version = None
+        self.checked = 0
+        self.builder = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        self.refresh()
+        return self.data
+
+    def refresh(self, force=False):
+        from models import ChangeCounter
+        now = time.time()
+        if not force and self.data is not None and \
+                now - self.checked < settings.AUTOCOMPLETE_CHECK_INTERVAL:
+            return
+        self.lock.acquire()
+        try:
+            if self.builder is not None and self.builder.isAlive() and not force:
+                return
+            # Версия читается до построения: изменения, сделанные во время
+            # построения, приведут к еще одному перестроению.
+            version = ChangeCounter.objects.value(self.counter)
+            if force or self.data is None:
+                self.data = self.build()
+                self.version = version
+            elif version != self.version:
+                if self.background:
+                    self.builder = threading.Thread(target=self.rebuild, args=(version, ))
+                    self.builder.setDaemon(True)
+                    self.builder.start()
+                else:
+                    self.data = self.build()
+                    self.version = version
+            self.checked = now
+        finally:
+            self.lock.release()
+
+    def rebuild(self, version):
+        """
+        Построение в отдельном потоке (со своим соединением с базой).
+        """
+        try:
+            data = self.build()
+            self.lock.acquire()
+            try:
+                # Пока строили, данные могли сбросить или построить заново.
+                if self.data is not None and self.version < version:
+                    self.data = data
+                    self.version = version
+            finally:
+                self.lock.release()
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def reset(self):
+        self.data = None
@@ -15,10 +15,18 @@ from django.utils.simplejson.encoder import JSONEncoder
 from forms import SearchForm, NewUserForm, EditUserForm, ImportForm, OrderFileCommentForm
 from forms import CemeteryForm, JournalForm, EditBurialForm, InitalForm, OrderCommentForm
 from django.forms.models import modelformset_factory
-from models import Soul, Person, PersonRole, UserProfile, Burial, Burial1, Organization, OrderComments
-from models import Cemetery, GeoCountry, GeoRegion, GeoCity, Street, Location, Operation
+from models import Soul, Person, PersonRole, UserProfile, Burial, Organization, OrderComments
+from models import Cemetery, GeoRegion, GeoCity, Location, Operation
 from models import OrderFiles, Phone, Place, ProductType, SoulProducttypeOperation, Role
-from models import Env, ProductComments
+from models import Env, ProductComments, SearchGram, BurialSearchRow, ImportJob
+from counts import cached_count, estimated_count
+from csvexport import export_csv
+from importer import CsvValidator, write_report
+from printing import print_burials
+from principal import get_principal
+import autocomplete
+import geocache
+from search import name_lookups, infix_grams, comment_key, ngrams, phonetic_key, natural_key
 from django import db
 
 from simplepagination import paginate
@@ -29,14 +37,26 @@ import datetime
 import time
 import csv
 from common.forms import UserProfileForm
-from cStringIO import StringIO
 #from django.utils import datetime_safe
 
 
 csv.register_dialect("4mysqlout", escapechar="\\", quoting=csv.QUOTE_NONE)
 csv.register_dialect("4mysql", escapechar="\\", quoting=csv.QUOTE_ALL, doublequote=False)
 
-DT_TEMPLATE = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Поля сортировки главной страницы (ORDER_BY_VALUES) -> поля строки поиска.
+# Номер, участок, ряд и место сортируются по ключам natural_key.
+ORDER_FIELDS = {
+    "person__last_name": ("last_name", ),
+    "person__first_name": ("first_name", ),
+    "person__patronymic": ("patronymic", ),
+    "date_fact": ("date_fact", ),
+    "account_book_n": ("abn_prefix", "abn_number", "abn_suffix"),
+    "product__place__area": ("area_prefix", "area_number", "area_suffix"),
+    "product__place__row": ("row_prefix", "row_number", "row_suffix"),
+    "product__place__seat": ("seat_prefix", "seat_number", "seat_suffix"),
+    "product__place__cemetery": ("cemetery_name", ),
+}
 
 def is_in_group(group_name):
     """
@@ -44,12 +64,9 @@ def is_in_group(group_name):
     """
     def _dec(f):
         def _check_group(request, *args, **kwargs):
-            try:
-                group = request.user.groups.get(name=group_name)
-            except ObjectDoesNotExist:
+            if not get_principal(request.user).in_group(group_name):
                 return HttpResponseForbidden("Forbidden")
-            else:
-                return f(request, *args, **kwargs)
+            return f(request, *args, **kwargs)
         return _check_group
     return _dec
 
@@ -80,7 +97,7 @@ def ulogout(request):
     return redirect(next_url)
 
 @render_to()
-@paginate(style='digg')
+@paginate(style='keyset')
 def main_page(request):
     """
     Главная страница.
@@ -90,16 +107,17 @@ def main_page(request):
     trash = bool(request.GET.get("trash", False))
     if request.GET.has_key("cemetery") or trash:
         first = False
-        burials = Burial1.objects.filter(is_trash=trash).order_by("person__last_name",
-                                                                  "person__first_name",
-                                                                  "person__patronymic")
+        burials = BurialSearchRow.objects.filter(is_trash=trash).order_by("last_name", "first_name",
+                                                                          "patronymic")
     else:
         first = True
-        burials_nr = Burial1.objects.filter(is_trash=trash).count()
-        burials = Burial1.objects.none()
+        burials = BurialSearchRow.objects.none()
     pp = None
+    # Условия поиска для кэша количества записей (см. common.counts).
+    criteria = {"trash": trash}
     if form.is_valid():
         cd = form.cleaned_data
+        criteria.update(cd)
         # Обновляем профиль пользователя.
         #if request.user.is_authenticated() and not request.user.is_superuser:
         if request.user.is_authenticated():
@@ -109,83 +127,34 @@ def main_page(request):
                     request.user.userprofile.records_per_page = cd["per_page"]
                     request.user.userprofile.save()
         if cd.get("records_order_by", ""):
-            if cd["records_order_by"] == u'account_book_n':
-                burials = burials.order_by('s1', 's2', 's3')
-            elif cd["records_order_by"] == u'-account_book_n':
-                burials = burials.order_by('-s1', '-s2', '-s3')
-            elif cd["records_order_by"] == u'product__place__area':
-                burials = burials.order_by('product__place1__s1', 'product__place1__s2',
-                                           'product__place1__s3')
-            elif cd["records_order_by"] == u'-product__place__area':
-                burials = burials.order_by('-product__place1__s1', '-product__place1__s2',
-                                           '-product__place1__s3')
-            elif cd["records_order_by"] == u'product__place__row':
-                burials = burials.order_by('product__place1__s4', 'product__place1__s5',
-                                           'product__place1__s6')
-            elif cd["records_order_by"] == u'-product__place__row':
-                burials = burials.order_by('-product__place1__s4', '-product__place1__s5',
-                                           '-product__place1__s6')
-            elif cd["records_order_by"] == u'product__place__seat':
-                burials = burials.order_by('product__place1__s7', 'product__place1__s8',
-                                           'product__place1__s9')
-            elif cd["records_order_by"] == u'-product__place__seat':
-                burials = burials.order_by('-product__place1__s7', '-product__place1__s8',
-                                           '-product__place1__s9')
-            else:
-                burials = burials.order_by(cd["records_order_by"])
+            field = cd["records_order_by"].lstrip("-")
+            if field in ORDER_FIELDS:
+                desc = cd["records_order_by"].startswith("-") and "-" or ""
+                burials = burials.order_by(*["%s%s" % (desc, f) for f in ORDER_FIELDS[field]])
         if cd.get("fio", ""):
             text = re.sub(r"\.", " ", cd["fio"])
             parts = text.split()
-            fname = ""
-            patr = ""
+            # Поиск по нормализованным ключам (см. common.search), регистр
+            # и "ё" значения не имеют.
             lname = parts[0].strip(",")
-            lname = lname.capitalize()  # //rd-- patch to not working iregex
+            if cd.get("fio_phonetic", False):
+                # "Похожие по звучанию": равенство по фонетическому ключу.
+                burials = burials.filter(last_name_phonetic=phonetic_key(lname))
+            else:
+                burials = burials.filter(**name_lookups("last_name_key", lname))
+                # Шаблон с подстановкой в начале ("*етер") - через n-граммный индекс.
+                person_ids = SearchGram.objects.matching(SearchGram.LAST_NAME, infix_grams(lname))
+                if person_ids is not None:
+                    burials = burials.filter(person__in=person_ids)
             if len(parts) > 1:
-                fname = parts[1].strip(",")
-#                if not fname[-1].isalpha():
-#                    fname = "%s*" % fname
-                fname = fname.capitalize()# //rd-- patch to not working iregex
+                burials = burials.filter(**name_lookups("first_name_key", parts[1].strip(","),
+                                                        anchor_end=False))
             if len(parts) > 2:
-                patr = parts[2].strip(",")
-                patr = patr.capitalize()# //rd-- patch to not working iregex
-
-# //rd-- fio search field regex rules            
-# ".етер"   # ^
-# "етер"    # ^
-# "етер.*"  # ^
-# ".етер.*" # ^
-# "етер."   # ^$
-# ".*етер"  # $
-# ".*етер." # $
-
-            regex = re.sub(r'\?', r'.', lname)
-            regex = re.sub(r'\*', r'.*', regex)
-            if not regex.startswith(".*"):
-                regex = u"^%s" % regex
-                if regex.endswith("."):
-                    regex = u"%s$" % regex
-            else:
-                regex = u"%s$" % regex
-            burials = burials.filter(person__last_name__iregex=regex)
-            if fname:
-                regex = re.sub(r'\?', r'.', fname)
-                regex = re.sub(r'\*', r'.*', regex)
-                if not regex.startswith("."):
-                    regex = u"^%s" % regex
-#                if not (regex.endswith(".") or regex.endswith("*")):
-#                    regex = u"%s$" % regex
-                burials = burials.filter(person__first_name__iregex=regex)
-            if patr:
-                regex = re.sub(r'\?', r'.', patr)
-                regex = re.sub(r'\*', r'.*', regex)
-                if not regex.startswith("."):
-                    regex = u"^%s" % regex
-#                if not (regex.endswith(".") or regex.endswith("*")):
-#                    regex = u"%s$" % regex
-                burials = burials.filter(person__patronymic__iregex=regex)
+                burials = burials.filter(**name_lookups("patronymic_key", parts[2].strip(","),
+                                                        anchor_end=False))
 
         if cd["cemetery"]:
-            burials = burials.filter(product__place__cemetery=cd["cemetery"])
+            burials = burials.filter(cemetery=cd["cemetery"])
 #        if cd["birth_date_from"]:
 #            burials = burials.filter(person__birth_date__gte=cd["birth_date_from"])
 #        if cd["birth_date_to"]:
@@ -220,45 +189,38 @@ def main_page(request):
             if not cd["account_book_n_to"]:
                 burials = burials.filter(account_book_n__iexact=cd["account_book_n_from"])
             else:   # account_n_book_to is true
-                burials = burials.filter(s2__gte=cd["account_book_n_from"])
-                burials = burials.filter(s2__lte=cd["account_book_n_to"])
+                burials = burials.filter(abn_number__gte=natural_key(cd["account_book_n_from"])[1])
+                burials = burials.filter(abn_number__lte=natural_key(cd["account_book_n_to"])[1])
         else:
             if cd["account_book_n_to"]:
                 burials = burials.filter(account_book_n__iexact=cd["account_book_n_to"])
         if cd["customer"]:
-            custname = cd["customer"]
-            custname = custname.capitalize()# //rd-- patch to not working iregex
-            regex = re.sub(r'\?', r'.', custname)
-            regex = re.sub(r'\*', r'.*', regex)
-            if not regex.startswith(".*"):
-                regex = u"^%s" % regex
-                if regex.endswith("."):
-                    regex = u"%s$" % regex
-            else:
-                regex = u"%s$" % regex
-#            regex = re.sub(r'\?', r'.', cd["customer"])
-#            regex = re.sub(r'\*', r'.*', regex)
-#            if not regex.startswith("."):
-#                regex = u"^%s" % regex
-#            if not (regex.endswith(".") or regex.endswith("*")):
-#                regex = u"%s$" % regex
-            burials = burials.filter(customer__person__last_name__iregex=regex)
+            burials = burials.filter(**name_lookups("customer_last_name_key", cd["customer"]))
+            customer_ids = SearchGram.objects.matching(SearchGram.LAST_NAME, infix_grams(cd["customer"]))
+            if customer_ids is not None:
+                burials = burials.filter(customer__in=customer_ids)
         if cd["owner"]:
             burials = burials.filter(creator=cd["owner"].userprofile.soul)
         if cd["area"]:
-            burials = burials.filter(product__place__area=cd["area"])
+            burials = burials.filter(area=cd["area"])
         if cd["row"]:
-            burials = burials.filter(product__place__row=cd["row"])
+            burials = burials.filter(row=cd["row"])
         if cd["seat"]:
-            burials = burials.filter(product__place__seat=cd["seat"])
+            burials = burials.filter(seat=cd["seat"])
         if cd["gps_x"]:
-            burials = burials.filter(product__place__gps_x=cd["gps_x"])
+            burials = burials.filter(gps_x=cd["gps_x"])
         if cd["gps_y"]:
-            burials = burials.filter(product__place__gps_y=cd["gps_y"])
+            burials = burials.filter(gps_y=cd["gps_y"])
         if cd["gps_z"]:
-            burials = burials.filter(product__place__gps_z=cd["gps_z"])
+            burials = burials.filter(gps_z=cd["gps_z"])
         if cd["comment"]:
-            burials = burials.filter(ordercomments__comment__icontains=cd["comment"])
+            comment_ids = SearchGram.objects.matching(SearchGram.COMMENT, ngrams(comment_key(cd["comment"])))
+            if comment_ids is not None:
+                # Оба условия в одном filter(), чтобы они относились к одному комментарию.
+                burials = burials.filter(burial__ordercomments__in=comment_ids,
+                                         burial__ordercomments__comment__icontains=cd["comment"])
+            else:
+                burials = burials.filter(burial__ordercomments__comment__icontains=cd["comment"])
     else:
         #if request.user.is_authenticated() and not request.user.is_superuser and not form_data:
         if request.user.is_authenticated() and not form_data:
@@ -272,93 +234,32 @@ def main_page(request):
             return redirect(redirect_str)
 
     if request.GET.get('export_csv'):
-        io = StringIO()
-        csv_export_dialect = csv.get_dialect("4mysql")
-        writer = csv.writer(io, csv_export_dialect)
-        # Это почистит предыдущий order_by
-        burials = burials.order_by('date_fact')
-        for b in burials:
-            b0 = Burial.objects.get(pk=b.pk)
-            comments = u'\t'.join([
-                u"%s~%s" % (
-                    oc.date_of_creation.strftime(DT_TEMPLATE),
-                    re.sub(r'\t', ' ', oc.comment),
-                    ) \
-                for oc in b0.ordercomments_set.all()
-            ])
-            phones = u'\n'.join([phone.f_number for phone in b0.customer.phone_set.all()])
-            files = u'\n'.join([file_.ofile.name for file_ in b0.orderfiles_set.all()])
-            file_comments = u'\t'.join([file_.comment for file_ in b0.orderfiles_set.all()])
-            row = [
-                u"",
-                u"%s" % (b0.account_book_n, ),
-                u"%s" % (b0.person.last_name or '', ),
-                u"%s" % (b0.person.first_name or '', ),
-                u"%s" % (b0.person.patronymic or '', ),
-                u"",
-                u"%s" % (b0.date_fact, ),
-                u"%s" % (b0.product.place.area or '', ),
-                u"%s" % (b0.product.place.row or '', ),
-                u"%s" % (b0.product.place.seat or '', ),
-                u"%s" % (b0.customer.person.last_name or '', ),
-                u"%s" % (b0.customer.person.first_name or '', ),
-                u"%s" % (b0.customer.person.patronymic or '', ),
-                u"",
-                u"%s" % (b0.customer.location and b0.customer.location.street and b0.customer.location.street.city or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.street or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.house or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.block or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.flat or '', ),
-                u"%s" % (comments or '', ),
-                # в дополнение к "старому" формату экспорта
-                u"%s" % (b0.customer.location and b0.customer.location.street and b0.customer.location.street.city and b0.customer.location.street.city.country or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.street and b0.customer.location.street.city and b0.customer.location.street.city.region or '', ),
-                u"%s" % (phones or '', ),
-                u"%s" % (files or '', ),
-                u"%s" % (file_comments or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.post_index or '', ),
-                u"%s" % (b0.customer.location and b0.customer.location.building or '', ),
-                u"%s" % (b0.operation or '', ),
-            ]
-
-            # Из документации по Python 2, https://docs.python.org/2/library/csv.html :
-            # Dialect.escapechar
-            #   A one-character string used by the writer to escape the delimiter
-            #   if quoting is set to QUOTE_NONE and the quotechar if doublequote is False.
-            #   On reading, the escapechar removes any special meaning from the following character.
-            #   It defaults to None, which disables escaping.
-            # Т.е. escapechar экранирует (1) разделитель между полями, (2) кавычку.
-            # Сам себя escapechar, согласно документации, при записи экранировать не обязан.
-            # А вот при чтении '123\45' преобразуется в 12345, т.е. теряется символ,
-            # но самое страшное, '"поле1\","поле2"' (escapechar '\' завершает поле1)
-            # становится 'поле1",поле2', т.е. теряется поле
-            # Python 3 ведет себя аналогично.
-
-            if csv_export_dialect.escapechar:
-                for i in range(len(row)):
-                    row[i] = row[i].replace(csv_export_dialect.escapechar, csv_export_dialect.escapechar * 2)
-
-            writer.writerow(map(lambda u: u.encode(settings.CSV_ENCODING), row))
-        result = HttpResponse(io.getvalue(), mimetype='text/csv')
+        result = HttpResponse(export_csv(burials), mimetype='text/csv')
         result['Content-Disposition'] = 'attachment; filename="export.csv"'
         return result
 
+    # Комментарии всех строк страницы - одним запросом.
+    burials = burials.prefetch_related("burial__ordercomments_set")
     to_print = request.GET.get("print", "")
     if to_print == u"1":
-        result = {"form": form,
-                  "object_list": burials,
-                  "obj_nr": len(burials),
-                  "TEMPLATE": "burials_print.html",
-                  }
+        return HttpResponse(print_burials(burials, cached_count(burials, criteria), request.GET))
     else:
         result = {"form": form,
                   "object_list": burials,
                   "TEMPLATE": "burials.html",
                   }
         if first:
-            result["obj_nr"] = burials_nr
+            # Первый заход: все записи, для больших таблиц - оценка.
+            estimate = estimated_count(BurialSearchRow)
+            if estimate is not None and estimate > settings.SEARCH_COUNT_ESTIMATE_THRESHOLD:
+                result["obj_nr"] = estimate
+                result["obj_nr_estimated"] = True
+            else:
+                result["obj_nr"] = cached_count(BurialSearchRow.objects.filter(is_trash=trash), criteria)
         else:
-            result["obj_nr"] = burials.count()
+            result["obj_nr"] = cached_count(burials, criteria)
+            # Пэйджинатору не нужно считать записи еще раз.
+            result["object_list_count"] = result["obj_nr"]
         if pp:
             result["per_page"] = pp
 
@@ -411,30 +312,8 @@ def journal(request):
             if cd.get("post_index", ""):
                 new_location.post_index = cd["post_index"]
             if cd.get("country", ""):
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=cd["country"])
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=cd["country"].capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(country=country, name__exact=cd["region"])
-                except ObjectDoesNotExist:
-                    region = GeoRegion(country=country, name=cd["region"].capitalize())
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(region=region, name__exact=cd["city"])
-                except ObjectDoesNotExist:
-                    city = GeoCity(country=country, region=region, name=cd["city"].capitalize())
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(city=city, name__exact=cd["street"])
-                except ObjectDoesNotExist:
-                    street = Street(city=city, name=cd["street"].capitalize())
-                    street.save()
+                # Страна, регион, нас. пункт, улица - уже найдены при проверке формы.
+                street = form.resolver.resolve(cd["country"], cd["region"], cd["city"], cd["street"])
                 # Сохраняем Location.
                 new_location.street = street
                 if cd.get("customer_house", ""):
@@ -508,7 +387,8 @@ def journal(request):
             oper = None
         form = JournalForm(cem=cem, oper=oper)
     today = datetime.date.today()
-    burials = Burial.objects.filter(is_trash=False, creator=request.user.userprofile.soul).order_by('-date_of_creation')[:20]
+    burials = Burial.objects.filter(is_trash=False, creator=request.user.userprofile.soul).order_by('-date_of_creation')
+    burials = burials.prefetch_related("customer__phone_set", "ordercomments_set")[:20]
     return direct_to_template(request, 'journal.html', {'form': form, 'object_list': burials, 'phoneset': phoneset})
 
 @login_required
@@ -584,30 +464,8 @@ def edit_burial(request, uuid):
                 raise Http404
             # Поля модели Location.
             if cd.get("country", ""):
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=cd["country"])
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=cd["country"].capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(country=country, name__exact=cd["region"])
-                except ObjectDoesNotExist:
-                    region = GeoRegion(country=country, name=cd["region"].capitalize())
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(region=region, name__exact=cd["city"])
-                except ObjectDoesNotExist:
-                    city = GeoCity(country=country, region=region, name=cd["city"].capitalize())
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(city=city, name__exact=cd["street"])
-                except ObjectDoesNotExist:
-                    street = Street(city=city, name=cd["street"].capitalize())
-                    street.save()
+                # Страна, регион, нас. пункт, улица - уже найдены при проверке формы.
+                street = form.resolver.resolve(cd["country"], cd["region"], cd["city"], cd["street"])
                 # Сохраняем Location.
                 location.street = street
             if cd.get("post_index", ""):
@@ -1043,32 +901,7 @@ def management_cemetery(request):
             location_post_index = cd.get("post_index", "")
             if location_street and location_city and location_region and location_country:
                 # Есть все для создания непустого Location.
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=location_country)
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=location_country.capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(name__exact=location_region,
-                                                   country=country)
-                except ObjectDoesNotExist:
-                    region = GeoRegion(name=location_region.capitalize(), country=country)
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(name__exact=location_city, region=region)
-                except ObjectDoesNotExist:
-                    city = GeoCity(name=location_city.capitalize(), country=country,
-                                   region=region)
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(name__exact=location_street, city=city)
-                except ObjectDoesNotExist:
-                    street = Street(name=location_street.capitalize(), city=city)
-                    street.save()
+                street = form.resolver.resolve(location_country, location_region, location_city, location_street)
                 # Продолжаем с Location.
                 location.street = street
                 if location_house:
@@ -1129,32 +962,7 @@ def management_edit_cemetery(request, uuid):
 #            location.save()
             if location_street and location_city and location_region and location_country:
                 # Есть все для создания непустого Location.
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=location_country)
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=location_country.capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(name__exact=location_region,
-                                                   country=country)
-                except ObjectDoesNotExist:
-                    region = GeoRegion(name=location_region.capitalize(), country=country)
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(name__exact=location_city, region=region)
-                except ObjectDoesNotExist:
-                    city = GeoCity(name=location_city.capitalize(), country=country,
-                                   region=region)
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(name__exact=location_street, city=city)
-                except ObjectDoesNotExist:
-                    street = Street(name=location_street.capitalize(), city=city)
-                    street.save()
+                street = form.resolver.resolve(location_country, location_region, location_city, location_street)
                 # Продолжаем с Location.
                 location.street = street
                 if location_house:
@@ -1237,32 +1045,8 @@ def init(request):
             org_location_post_index = cd.get("post_index", "")
             if org_location_country and org_location_region and org_location_city and org_location_street:
                 # Есть все для создания непустого Location.
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=org_location_country)
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=org_location_country.capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(name__exact=org_location_region,
-                                                   country=country)
-                except ObjectDoesNotExist:
-                    region = GeoRegion(name=org_location_region.capitalize(), country=country)
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(name__exact=org_location_city, region=region)
-                except ObjectDoesNotExist:
-                    city = GeoCity(name=org_location_city.capitalize(), country=country,
-                                   region=region)
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(name__exact=org_location_street, city=city)
-                except ObjectDoesNotExist:
-                    street = Street(name=org_location_street.capitalize(), city=city)
-                    street.save()
+                street = form.resolver.resolve(org_location_country, org_location_region,
+                                               org_location_city, org_location_street)
                 # Продолжаем с Location.
                 org_location.street = street
                 if org_location_house:
@@ -1293,32 +1077,8 @@ def init(request):
             cem_location_post_index = cd.get("cem_post_index", "")
             if cem_location_country and cem_location_region and cem_location_city and cem_location_street:
                 # Есть все для создания непустого Location.
-                # Страна.
-                try:
-                    country = GeoCountry.objects.get(name__exact=cem_location_country)
-                except ObjectDoesNotExist:
-                    country = GeoCountry(name=cem_location_country.capitalize())
-                    country.save()
-                # Регион.
-                try:
-                    region = GeoRegion.objects.get(name__exact=cem_location_region,
-                                                   country=country)
-                except ObjectDoesNotExist:
-                    region = GeoRegion(name=cem_location_region.capitalize(), country=country)
-                    region.save()
-                # Нас. пункт.
-                try:
-                    city = GeoCity.objects.get(name__exact=cem_location_city, region=region)
-                except ObjectDoesNotExist:
-                    city = GeoCity(name=cem_location_city.capitalize(), country=country,
-                                   region=region)
-                    city.save()
-                # Улица.
-                try:
-                    street = Street.objects.get(name__exact=cem_location_street, city=city)
-                except ObjectDoesNotExist:
-                    street = Street(name=cem_location_street.capitalize(), city=city)
-                    street.save()
+                street = form.resolver.resolve(cem_location_country, cem_location_region,
+                                               cem_location_city, cem_location_street)
                 # Продолжаем с Location.
                 cem_location.street = street
                 if cem_location_house:
@@ -1381,10 +1141,11 @@ def init(request):
 
 @login_required
 #@is_in_group("import_csv")
-@transaction.commit_manually
 def import_csv(request):
     """
-    Импорт захоронений из csv-файла.
+    Импорт захоронений из csv-файла: файл сохраняется, импорт выполняет
+    обработчик заданий (manage.py run_import_jobs). Если отмечено "только
+    проверить", файл сразу проверяется и возвращается отчет об ошибках.
     """
     user = request.user
     if not user.is_superuser:
@@ -1393,356 +1154,69 @@ def import_csv(request):
         form = ImportForm(request.POST, request.FILES)
         if form.is_valid():
             cd = form.cleaned_data
-            if cd["creator"]:
-                creator = cd["creator"].userprofile.soul
-            response = HttpResponse(mimetype='text/csv')
-            response['Content-Disposition'] = 'attachment; filename=import_result.csv'
-            temp_file = StringIO()
-#            writer = csv.writer(response, "4mysql")
-#            writer = csv.writer(temp_file, "4mysqlout")
-            writer = csv.writer(temp_file, "4mysql")
-            err_descrs = []
-            good_nr = 0
-            bad_nr = 0
-            s_time = datetime.datetime.now()
-            r = csv.reader(cd["csv_file"], "4mysql")
-            n_items = 20                                # Было в строке импорта раньше
-            n_itemps_plus = 8                           # Добавилось
-            for l in r:
-                db.reset_queries()
-                if l:
-                    try:
-                        (str_id,
-                        n,
-                        ln, fn, ptrc, initials,
-                        bur_date, area, row, seat,
-                        cust_ln, cust_fn, cust_ptrc, cust_initials,
-                        city, street, house, block, flat,
-                        comment) = l[0 : n_items]
-                        
-                        (country, region, phone,
-                         files, file_comments,
-                         post_index, building,
-                         op_type) = ["" for i in range(n_itemps_plus)]
-                        if len(l) > n_items:
-                           (country, region, phone,
-                            files, file_comments,
-                            post_index, building,
-                            op_type) = l[n_items : n_items + n_itemps_plus]
-                            
-                        # ID записи в таблице MySQL.
-                        try:
-                            str_id = int(str_id)
-                        except ValueError:
-                            pass
-                        # Номер в книге учета.
-                        n = n.decode(settings.CSV_ENCODING).strip().lower()
-                        # Фамилия захороненного.
-                        if ln == "N":
-                            ln = u""
-                        else:
-                            ln = ln.decode(settings.CSV_ENCODING).strip().capitalize()
-                            ln = re.sub(r'ё', r'е', ln)
-                            ln = re.sub(r'Ё', r'Е', ln)
-                        # Имя захороненного.
-                        if fn == "N":
-                            fn = u""
-                        else:
-                            fn = fn.decode(settings.CSV_ENCODING).strip().capitalize()
-                        # Отчество захороненного.
-                        if ptrc == "N":
-                            ptrc = u""
-                        else:
-                            ptrc = ptrc.decode(settings.CSV_ENCODING).strip().capitalize()
-                        # Инициалы захороненного.
-                        if initials == "N":
-                            initials = u""
-                        else:
-                            initials = initials.decode(settings.CSV_ENCODING).strip().upper()
-                        # Дата захоронения
-                        try:
-                            bur_date = datetime.datetime.strptime(bur_date[0:10], "%Y-%m-%d")
-                        except ValueError:
-                            bur_date = datetime.datetime.strptime(bur_date[0:10], "%d.%m.%Y")
-
-                        # Участок/ряд/место.
-                        if area == "N":
-                            area = u"0"
-                        else:
-                            area = area.decode(settings.CSV_ENCODING).strip()
-                        if row == "N":
-                            row = u"0"
-                        else:
-                            row = row.decode(settings.CSV_ENCODING).strip()
-                        if seat == "N":
-                            seat = u"0"
-                        else:
-                            seat = seat.decode(settings.CSV_ENCODING).strip()
-                        # Фамилия заказчика.
-                        if cust_ln == "N":
-                            cust_ln = u"НЕИЗВЕСТЕН"  # Если в базе был Null
-                        else:
-                            cust_ln = cust_ln.decode(settings.CSV_ENCODING).strip().capitalize()
-                            cust_ln = re.sub(r'ё', r'е', cust_ln)
-                            cust_ln = re.sub(r'Ё', r'Е', cust_ln)
-                        # Имя заказчика.
-                        if cust_fn == "N":
-                            cust_fn = u""
-                        else:
-                            cust_fn = cust_fn.decode(settings.CSV_ENCODING).strip().capitalize()
-                        # Отчество заказчика.
-                        if cust_ptrc == "N":
-                            cust_ptrc = u""
-                        else:
-                            cust_ptrc = cust_ptrc.decode(settings.CSV_ENCODING).strip().capitalize()
-                        # Инициалы заказчика.
-                        if cust_initials == "N":
-                            cust_initials = u""
-                        else:
-                            cust_initials = cust_initials.decode(settings.CSV_ENCODING).strip().upper()
-                        # Город.
-                        if city == "N":
-                            city = u"НЕИЗВЕСТЕН"  # Если в базе был Null.
-                        else:
-                            city = city.decode(settings.CSV_ENCODING).strip().capitalize()
-                        if not city:
-                            city = u"НЕИЗВЕСТЕН"  # Если в базе была пустая строка.
-                        if street == "N":
-                            street = u""
-                        else:
-                            street = street.decode(settings.CSV_ENCODING).strip().capitalize()
-                            street = re.sub(r'ё', r'е', street)
-                            street = re.sub(r'Ё', r'Е', street)
-                        if house == "N":
-                            house = u""
-                        else:
-                            house = house.decode(settings.CSV_ENCODING).strip().lower()
-                        if block == "N":
-                            block = u""
-                        else:
-                            block = block.decode(settings.CSV_ENCODING).strip().lower()
-                        if flat == "N":
-                            flat = u""
-                        else:
-                            flat = flat.decode(settings.CSV_ENCODING).strip().lower()
-
-                        post_index = post_index.decode(settings.CSV_ENCODING).strip().lower()
-                        building = building.decode(settings.CSV_ENCODING).strip().lower()
-                        
-                        # Захороненный.
-                        deadman = Person(creator=creator)
-                        deadman.last_name = ln
-                        if fn:
-                            deadman.first_name = fn
-                            if ptrc:
-                                deadman.patronymic = ptrc
-                        else:
-                            initials = re.sub(r"[\.\,]", " ", initials.strip()).split()
-                            if initials:
-                                deadman.first_name = initials[0]
-                                if len(initials) > 1:
-                                    deadman.patronymic = initials[1]
-                        deadman.save()
-
-                        # Заказчик.
-                        customer = Person(creator=creator)
-                        customer.last_name = cust_ln
-                        if cust_fn:
-                            customer.first_name = cust_fn
-                            if cust_ptrc:
-                                customer.patronymic = cust_ptrc
-                        else:
-                            cust_initials = re.sub(r"[\.\,]", " ", cust_initials).split()
-                            if cust_initials:
-                                customer.first_name = cust_initials[0]
-                                if len(cust_initials) > 1:
-                                    customer.patronymic = cust_initials[1]
-
-                        # Адрес заказчика.
-                        location = Location()
-                        if street:
-                            # Присутствуют город и улица - будем создавать Location.
-                            country = country.decode(settings.CSV_ENCODING).strip().capitalize()
-                            if country and not region:
-                               region = u"НЕИЗВЕСТЕН"
-                            region = region.decode(settings.CSV_ENCODING).strip().capitalize()
-                            if region and not country:
-                               country = u"НЕИЗВЕСТЕН"
-                            if country:
-                                # "новый" формат, есть область и страна
-                                countries = GeoCountry.objects.filter(name__exact=country)
-                                if countries:
-                                    cust_country = countries[0]
-                                else:
-                                    cust_country = GeoCountry(name=country)
-                                    cust_country.save()
-                                regions = GeoRegion.objects.filter(country=cust_country, name__exact=region)
-                                if regions:
-                                    cust_region = regions[0]
-                                else:
-                                    cust_region = GeoRegion(country=cust_country, name=region)
-                                    cust_region.save()
-                                cities = GeoCity.objects.filter(country=cust_country, region=cust_region, name__exact=city)
-                                if cities:
-                                    cust_city = cities[0]
-                                else:
-                                    cust_city = GeoCity(country=cust_country, region=cust_region, name=city)
-                                    cust_city.save()
-                            else:
-                                # "старый" формат, без страны, области
-                                cities = GeoCity.objects.filter(name__exact=city)
-                                if cities:
-                                    cust_city = cities[0]
-                                else:
-                                    cust_city = GeoCity()
-                                    cust_city.country = GeoCountry.objects.get(name__exact="НЕИЗВЕСТЕН")
-                                    cust_city.region = GeoRegion.objects.get(name__exact="НЕИЗВЕСТЕН")
-                                    cust_city.name = city
-                                    cust_city.save()
-                            try:
-                                cust_street = Street.objects.get(city=cust_city, name__exact=street)
-                            except ObjectDoesNotExist:
-                                cust_street = Street(city=cust_city, name=street)
-                                cust_street.save()
-                            location.street = cust_street
-                            if post_index:
-                                location.post_index = post_index
-                            if house:
-                                location.house = house
-                                if block:
-                                    location.block = block
-                                if building:
-                                    location.building = building
-                                if flat:
-                                    location.flat = flat
-                        location.save()
-                        customer.location = location
-                        customer.save()
-
-                        phones = phone.split("\n")
-                        for phone in phones:
-                            phone = phone.decode(settings.CSV_ENCODING).strip()
-                            if phone:
-                                cust_phone = Phone(soul=customer.soul_ptr, f_number=phone)
-                                cust_phone.save()
-
-                        # Место.
-                        cemetery = cd["cemetery"]
-                        try:
-                            place = Place.objects.get(cemetery=cemetery, area__exact=area, row__exact=row,
-                                                      seat__exact=seat)
-                        except ObjectDoesNotExist:
-                            place = Place(creator=creator)
-                            place.cemetery = cemetery
-                            place.area = area
-                            place.row = row
-                            place.seat = seat
-                            place.soul = cemetery.organization.soul_ptr
-                            place.name = u"%s.уч%sряд%sместо%s" % (place.cemetery.name, place.area, place.row, place.seat)
-                            place.p_type = ProductType.objects.get(uuid=settings.PLACE_PRODUCTTYPE_ID)
-                            place.save()
-
-                        # Захоронение.
-                        burial = Burial(creator=creator)
-                        burial.person = deadman
-                        burial.account_book_n = n
-                        burial.responsible = place.cemetery.organization.soul_ptr
-                        burial.customer = customer
-                        burial.doer = creator
-                        burial.date_fact = bur_date
-#                        try:
-#                            test_date = datetime.datetime.date(bur_date).strftime("%d.%m.%Y")
-                        burial.product = place.product_ptr
-                        
-                        operation = Operation.objects.get(uuid=settings.OPER_1) # Захоронение
-                        if op_type:
-                            op_type = op_type.decode(settings.CSV_ENCODING).strip().lower()
-                            if op_type == u"захоронение":
-                                pass
-                            elif op_type == u"урна":
-                                operation = Operation.objects.get(uuid=settings.OPER_5)
-                            elif op_type == u"захоронение детское":
-                                operation = Operation.objects.get(uuid=settings.OPER_6)
-                            elif op_type.startswith(u"захоронение в существ"):
-                                operation = Operation.objects.get(uuid=settings.OPER_3)
-                            elif op_type == u"почетное захоронение":
-                                operation = Operation.objects.get(uuid=settings.OPER_2)
-                            elif op_type.startswith(u"подзахоронен"):
-                                operation = Operation.objects.get(uuid=settings.OPER_4)
-                            
-                        if comment == "N":
-                            comment = u""
-                        else:
-                            comment = comment.decode(settings.CSV_ENCODING).strip()
-                            comment = re.sub(r'ё', r'е', comment)
-                            comment = re.sub(r'Ё', r'Е', comment)
-                            if not op_type:
-                                if u"захоронение детское" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_6)
-                                elif u"захоронение в существ" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_3)
-                                elif u"почетное захоронение" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_2)
-                                elif u"подзахоронение" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_4)
-                                elif u"захоронение" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_1)
-                                elif u"урна" in comment.lower():
-                                    operation = Operation.objects.get(uuid=settings.OPER_5)
-                        burial.operation = operation
-                        burial.save()
-                        if comment:
-                            for c in comment.split('\t'):
-                                try:
-                                    i_sep = c.index(u'~')
-                                    date_of_comment = datetime.datetime.strptime(c[:i_sep], DT_TEMPLATE)
-                                    comment = burial.add_comment(c[i_sep+1:], creator)
-                                    OrderComments.objects.filter(pk=comment.pk).update(
-                                        date_of_creation=date_of_comment,
-                                    )
-                                except ValueError:
-                                    burial.add_comment(c, creator)
-                            
-                        files = files.split("\n")
-                        file_comments = file_comments.split("\t")
-                        if len(file_comments) > len(files):
-                            file_comments = file_comments[0:len(files)]
-                        for i in range(len(files)):
-                            file_ = files[i].decode(settings.CSV_ENCODING).strip()
-                            file_comment = file_comments[i].decode(settings.CSV_ENCODING).strip()
-                            if file_:
-                                cust_file = OrderFiles(creator=creator)
-                                cust_file.order = burial.order_ptr
-                                cust_file.ofile.name = file_
-                                cust_file.comment = file_comment
-                                cust_file.save()
-
-                    except Exception, err_descr:
-                        # Откатываем транзакцию.
-                        transaction.rollback()
-                        # Сохраняем описание ошибки.
-                        err_descrs.append(err_descr)
-#                        # Пишем в выходной csv файл.
-                        writer.writerow(l)
-                        bad_nr += 1
-                    else:
-                        # Коммитим все.
-                        transaction.commit()
-                        good_nr += 1
-            myseparator = u'=== ОПИСАНИЕ ОШИБОК ==='
-            writer.writerow([myseparator.encode('utf8')])
-            for err in err_descrs:
-                writer.writerow((err,))
-            response.write("Начало/Конец: %s/%s\n" % (s_time, datetime.datetime.now()))
-            response.write("Всего/Удачно/Ошибок: %d/%d/%d\n" % (good_nr+bad_nr, good_nr, bad_nr))
-            response.write("=== СТРОКИ С ОШИБКАМИ ===\n")
-            response.write(temp_file.getvalue())
-            return response
-#            else:
-#                return redirect("/management/import/")
+            if cd["validate_only"]:
+                validator = CsvValidator(cd["cemetery"])
+                started = datetime.datetime.now()
+                validator.run(csv.reader(cd["csv_file"], "4mysql"))
+                response = HttpResponse(mimetype="text/csv")
+                response["Content-Disposition"] = "attachment; filename=import_check.csv"
+                write_report(response, validator, started, datetime.datetime.now())
+                return response
+            job = ImportJob(cemetery=cd["cemetery"], creator=cd["creator"].userprofile.soul, user=user)
+            job.csv_file.save(cd["csv_file"].name, cd["csv_file"], save=False)
+            job.save()
+            return redirect("/management/import/%s/" % job.pk)
     else:
         form = ImportForm()
-    return direct_to_template(request, "import.html", {"form": form})
+    jobs = ImportJob.objects.select_related("cemetery")[:20]
+    return direct_to_template(request, "import.html", {"form": form, "jobs": jobs})
+
+
+def get_import_job(request, uuid):
+    if not request.user.is_superuser:
+        return None
+    try:
+        return ImportJob.objects.select_related("cemetery").get(pk=uuid)
+    except ObjectDoesNotExist:
+        raise Http404
+
+
+@login_required
+def import_job(request, uuid):
+    """
+    Ход и итоги задания импорта.
+    """
+    job = get_import_job(request, uuid)
+    if job is None:
+        return HttpResponseForbidden("Forbidden")
+    return direct_to_template(request, "import_job.html", {"job": job})
+
+
+@login_required
+def import_job_status(request, uuid):
+    """
+    Ход задания импорта в JSON (для обновления страницы задания).
+    """
+    job = get_import_job(request, uuid)
+    if job is None:
+        return HttpResponseForbidden("Forbidden")
+    return HttpResponse(JSONEncoder().encode(job.as_dict()), mimetype="application/json")
+
+
+@login_required
+def import_job_report(request, uuid):
+    """
+    Отчет задания импорта: строки с ошибками и описания ошибок.
+    """
+    job = get_import_job(request, uuid)
+    if job is None:
+        return HttpResponseForbidden("Forbidden")
+    if not job.report:
+        raise Http404
+    job.report.open("rb")
+    response = HttpResponse(job.report.chunks(), mimetype="text/csv")
+    response["Content-Disposition"] = "attachment; filename=import_result.csv"
+    return response
 
 
 
@@ -1769,9 +1243,7 @@ def get_customer_ln(request):
     person_lns = []
     q = request.GET.get('q', None)
     if q is not None:
-        rezult = Person.objects.filter(ordr_customer__isnull=False,
-                                   last_name__istartswith=q).values("last_name").order_by("last_name").distinct()[:16]
-        person_lns = [item["last_name"] for item in rezult]
+        person_lns = autocomplete.lookup(autocomplete.CUSTOMERS, q)
     return direct_to_template(request, 'ajax.html', {'objects': person_lns,})
 
 
@@ -1782,9 +1254,7 @@ def get_deadman(request):
     persons = []
     q = request.GET.get('q', None)
     if q is not None:
-        rezult = Person.objects.filter(buried__isnull=False, last_name__istartswith=q).values("last_name",
-                          "first_name", "patronymic").order_by("last_name", "first_name", "patronymic").distinct()[:16]
-        persons = ["%s %s %s" % (item["last_name"], item["first_name"], item["patronymic"]) for item in rezult]
+        persons = autocomplete.lookup(autocomplete.DEADMEN, q)
     return direct_to_template(request, 'ajax.html', {'objects': persons,})
 
 
@@ -1815,10 +1285,7 @@ def get_street(request):
     streets = []
     q = request.GET.get('term', None)
     if q is not None:
-        rezult = Street.objects.filter(name__istartswith=q).order_by("name", "city__name", "city__region__name",
-                                                                     "city__region__country__name")[:24]
-        for s in rezult:
-            streets.append(u"%s/%s/%s/%s" % (s.name, s.city.name, s.city.region.name, s.city.region.country.name))
+        streets = geocache.tree().street_index.lookup(q, geocache.LIMIT)
     return HttpResponse(JSONEncoder().encode(streets))
 
 
@@ -1829,9 +1296,7 @@ def get_countries(request):
     countries = []
     q = request.GET.get('term', None)
     if q is not None:
-        rezult = GeoCountry.objects.filter(name__istartswith=q).order_by("name")[:8]
-        for s in rezult:
-            countries.append(s.name)
+        countries = geocache.tree().country_index.lookup(q, geocache.COUNTRIES_LIMIT)
     return HttpResponse(JSONEncoder().encode(countries))
 
 
@@ -1842,10 +1307,7 @@ def get_cities(request):
     cities = []
     q = request.GET.get('term', None)
     if q is not None:
-        rezult = GeoCity.objects.filter(name__istartswith=q).order_by("name", "region__name",
-                                                                      "region__country__name")[:24]
-        for s in rezult:
-            cities.append(u"%s/%s/%s" % (s.name, s.region.name, s.region.country.name))
+        cities = geocache.tree().city_index.lookup(q, geocache.LIMIT)
     return HttpResponse(JSONEncoder().encode(cities))
 
 
@@ -1856,8 +1318,6 @@ def get_regions(request):
     regions = []
     q = request.GET.get('term', None)
     if q is not None:
-        rezult = GeoRegion.objects.filter(name__istartswith=q).order_by("name", "country__name")[:24]
-        for s in rezult:
-            regions.append(u"%s/%s" % (s.name, s.country.name))
+        regions = geocache.tree().region_index.lookup(q, geocache.LIMIT)
     return HttpResponse(JSONEncoder().encode(regions))
 
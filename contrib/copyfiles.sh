@@ -46,7 +46,7 @@ cat cemetery.sql | psql -U postgres cemetery
 echo "PYTHONPATH=/home/django/projects/cemetery:\$PYTHONPATH" >> /etc/crontab
 echo "DJANGO_SETTINGS_MODULE=settings" >> /etc/crontab
 echo "5 16 * * *    www-data   python /home/django/projects/cemetery/contrib/dumpdb.py" >> /etc/crontab
-echo "15 15 * * *    www-data   python /home/django/projects/cemetery/contrib/export2term.py" >> /etc/crontab
+echo "15 15 * * *    www-data   python /home/django/projects/cemetery/manage.py export_terminals" >> /etc/crontab
 #Start django daemon
 /etc/init.d/django restart
 /etc/init.d/nginx restart
@@ -12,7 +12,7 @@ setup_environ(settings)
 
 from django.conf import settings
 from django.db import transaction
-from common.models import Soul, Person, PersonRole, UserProfile, Burial, Burial1, Organization, OrderComments
+from common.models import Soul, Person, PersonRole, UserProfile, Burial, Organization, OrderComments
 from common.models import Cemetery, GeoCountry, GeoRegion, GeoCity, Street, Location, Operation
 from common.models import OrderFiles, Phone, Place, ProductType, SoulProducttypeOperation, Role
 from common.models import Env, DeathCertificate
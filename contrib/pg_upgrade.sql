@@ -0,0 +1,84 @@
+-- Изменения схемы для уже развернутых баз (приложение common живет без
+-- миграций South, syncdb новые поля в существующие таблицы не добавляет).
+-- После применения блока запускать указанную в нем команду manage.py.
+
+-- Нормализованные ключи ФИО для поиска.
+-- manage.py build_search_keys
+ALTER TABLE common_person ADD COLUMN last_name_key varchar(128) NOT NULL DEFAULT '';
+ALTER TABLE common_person ADD COLUMN first_name_key varchar(30) NOT NULL DEFAULT '';
+ALTER TABLE common_person ADD COLUMN patronymic_key varchar(30) NOT NULL DEFAULT '';
+CREATE INDEX common_person_last_name_key ON common_person (last_name_key);
+CREATE INDEX common_person_last_name_key_like ON common_person (last_name_key varchar_pattern_ops);
+CREATE INDEX common_person_first_name_key ON common_person (first_name_key);
+CREATE INDEX common_person_first_name_key_like ON common_person (first_name_key varchar_pattern_ops);
+CREATE INDEX common_person_patronymic_key ON common_person (patronymic_key);
+CREATE INDEX common_person_patronymic_key_like ON common_person (patronymic_key varchar_pattern_ops);
+
+-- Фонетический ключ фамилии (поиск "похожие по звучанию").
+-- manage.py build_search_keys
+ALTER TABLE common_person ADD COLUMN last_name_phonetic varchar(128) NOT NULL DEFAULT '';
+CREATE INDEX common_person_last_name_phonetic ON common_person (last_name_phonetic);
+
+-- N-граммный индекс для поиска по подстроке ("*етер", комментарии).
+-- Таблицу common_searchgram создает syncdb, заполняет manage.py build_search_keys.
+-- Если в PostgreSQL (9.3+) есть pg_trgm, вместо таблицы можно поставить
+-- SEARCH_NGRAM_INDEX = "pg_trgm" в settings_local.py и создать индексы:
+-- CREATE EXTENSION pg_trgm;
+-- CREATE INDEX common_person_last_name_key_trgm ON common_person USING gin (last_name_key gin_trgm_ops);
+-- CREATE INDEX common_ordercomments_comment_trgm ON common_ordercomments USING gin (UPPER(comment::text) gin_trgm_ops);
+
+-- Ключи "естественной" сортировки номера в книге учета и участка/ряда/места
+-- вместо представлений common_burial1/common_place1 (contrib/pg_views.sql).
+-- manage.py build_sort_keys
+DROP VIEW IF EXISTS common_burial1;
+DROP VIEW IF EXISTS common_place1;
+ALTER TABLE common_burial ADD COLUMN abn_prefix varchar(16) NOT NULL DEFAULT '';
+ALTER TABLE common_burial ADD COLUMN abn_number double precision NOT NULL DEFAULT 0;
+ALTER TABLE common_burial ADD COLUMN abn_suffix varchar(16) NOT NULL DEFAULT '';
+CREATE INDEX common_burial_abn_number ON common_burial (abn_number);
+CREATE INDEX common_burial_abn_natural ON common_burial (abn_prefix, abn_number, abn_suffix);
+ALTER TABLE common_place ADD COLUMN area_prefix varchar(9) NOT NULL DEFAULT '';
+ALTER TABLE common_place ADD COLUMN area_number double precision NOT NULL DEFAULT 0;
+ALTER TABLE common_place ADD COLUMN area_suffix varchar(9) NOT NULL DEFAULT '';
+ALTER TABLE common_place ADD COLUMN row_prefix varchar(9) NOT NULL DEFAULT '';
+ALTER TABLE common_place ADD COLUMN row_number double precision NOT NULL DEFAULT 0;
+ALTER TABLE common_place ADD COLUMN row_suffix varchar(9) NOT NULL DEFAULT '';
+ALTER TABLE common_place ADD COLUMN seat_prefix varchar(9) NOT NULL DEFAULT '';
+ALTER TABLE common_place ADD COLUMN seat_number double precision NOT NULL DEFAULT 0;
+ALTER TABLE common_place ADD COLUMN seat_suffix varchar(9) NOT NULL DEFAULT '';
+CREATE INDEX common_place_area_natural ON common_place (area_prefix, area_number, area_suffix);
+CREATE INDEX common_place_row_natural ON common_place (row_prefix, row_number, row_suffix);
+CREATE INDEX common_place_seat_natural ON common_place (seat_prefix, seat_number, seat_suffix);
+
+-- Плоская таблица строк поиска захоронений для главной страницы.
+-- Таблицу и индексы (common/sql/burialsearchrow.sql) создает syncdb,
+-- заполняет manage.py rebuild_search_rows (после build_search_keys и
+-- build_sort_keys: строки копируют их ключи).
+
+-- Счетчики изменений (common.ChangeCounter) для индекса подсказок в памяти
+-- процессов. Таблицу common_changecounter создает syncdb.
+
+-- Задания фонового импорта CSV (common.ImportJob). Таблицу
+-- common_importjob создает syncdb, задания выполняет
+-- manage.py run_import_jobs, запущенный отдельным процессом.
+
+-- Журнал изменений для синхронизации (common.ChangeLog) вместо пометки
+-- захоронений и кладбищ last_sync_date = 2000-01-01 при каждом изменении
+-- связанных с ними людей, мест и адресов. Таблицу common_changelog создает
+-- syncdb; захоронения и кладбища, помеченные к выгрузке, переносятся в
+-- журнал:
+INSERT INTO common_changelog (entity, obj_id, date_of_creation)
+    SELECT 'c', uuid, now() FROM common_cemetery WHERE last_sync_date = '2000-01-01 00:00';
+INSERT INTO common_changelog (entity, obj_id, date_of_creation)
+    SELECT 'b', order_ptr_id, now() FROM common_burial WHERE last_sync_date = '2000-01-01 00:00';
+
+-- Отметки выгрузки и приема изменений (common.SyncState) для
+-- manage.py export_changes и apply_inbox. Таблицу common_syncstate
+-- создает syncdb. Время последнего изменения записей для разрешения
+-- конфликтов при приеме:
+ALTER TABLE common_impcem ADD COLUMN date_of_change timestamp with time zone NULL;
+ALTER TABLE common_impbur ADD COLUMN date_of_change timestamp with time zone NULL;
+
+-- Обработчик задания импорта ("хост:pid"), чтобы задания упавшего
+-- обработчика не оставались RUNNING навсегда:
+ALTER TABLE common_importjob ADD COLUMN worker varchar(100) NOT NULL DEFAULT '';
@@ -96,6 +96,8 @@ class BaseDatabaseFeatures(object):
     # integer primary keys.
     related_fields_match_type = False
     allow_sliced_subqueries = True
+    # True if a single INSERT can add several rows (VALUES (...), (...)).
+    has_bulk_insert = False
 
 class BaseDatabaseOperations(object):
     """
@@ -254,6 +256,13 @@ class BaseDatabaseOperations(object):
         """
         raise NotImplementedError
 
+    def bulk_batch_size(self, fields, objs):
+        """
+        Returns the maximum number of objects that can be inserted with
+        one multi-row INSERT of the given fields.
+        """
+        return len(objs)
+
     def pk_default_value(self):
         """
         Returns the value to use during an INSERT statement to specify that
@@ -80,6 +80,7 @@ class UnicodeCursorWrapper(object):
 
 class DatabaseFeatures(BaseDatabaseFeatures):
     uses_savepoints = True
+    has_bulk_insert = True
 
 class DatabaseWrapper(BaseDatabaseWrapper):
     operators = {
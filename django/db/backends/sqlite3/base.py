@@ -60,8 +60,16 @@ class DatabaseFeatures(BaseDatabaseFeatures):
     # setting ensures we always read result sets fully into memory all in one
     # go.
     can_use_chunked_reads = False
+    # Multi-row VALUES appeared in SQLite 3.7.11.
+    has_bulk_insert = Database.sqlite_version_info >= (3, 7, 11)
 
 class DatabaseOperations(BaseDatabaseOperations):
+    def bulk_batch_size(self, fields, objs):
+        """
+        SQLite allows at most 999 parameters in a query.
+        """
+        return max(999 // max(len(fields), 1), 1)
+
     def date_extract_sql(self, lookup_type, field_name):
         # sqlite doesn't support extract, so we fake it with the user-defined
         # function django_extract that's registered in connect(). Note that
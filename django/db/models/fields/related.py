@@ -1,5 +1,7 @@
+from operator import attrgetter
+
 from django.conf import settings
-from django.db import connection, router, transaction
+from django.db import connection, connections, router, transaction
 from django.db.backends import util
 from django.db.models import signals, get_model
 from django.db.models.fields import (AutoField, Field, IntegerField,
@@ -403,11 +405,27 @@ class ForeignRelatedObjectsDescriptor(object):
         """
         rel_field = self.related.field
         rel_model = self.related.model
+        cache_name = self.related.get_accessor_name()
 
         class RelatedManager(superclass):
             def get_query_set(self):
-                db = self._db or router.db_for_read(rel_model, instance=instance)
-                return superclass.get_query_set(self).using(db).filter(**(self.core_filters))
+                try:
+                    return instance._prefetched_objects_cache[cache_name]
+                except (AttributeError, KeyError):
+                    db = self._db or router.db_for_read(rel_model, instance=instance)
+                    return superclass.get_query_set(self).using(db).filter(**(self.core_filters))
+
+            def get_prefetch_query_set(self, instances):
+                """
+                Query for the related objects of all the instances (see
+                QuerySet.prefetch_related).
+                """
+                attname = rel_field.rel.get_related_field().attname
+                db = self._db or router.db_for_read(rel_model, instance=instances[0])
+                query = {'%s__%s__in' % (rel_field.name, rel_field.rel.get_related_field().name):
+                         list(set([getattr(obj, attname) for obj in instances]))}
+                qs = superclass.get_query_set(self).using(db).filter(**query)
+                return (qs, attrgetter(rel_field.attname), attrgetter(attname), cache_name)
 
             def add(self, *objs):
                 for obj in objs:
@@ -465,9 +483,11 @@ def create_many_related_manager(superclass, rel=False):
     class ManyRelatedManager(superclass):
         def __init__(self, model=None, core_filters=None, instance=None, symmetrical=None,
                 join_table=None, source_field_name=None, target_field_name=None,
-                reverse=False):
+                reverse=False, query_field_name=None, prefetch_cache_name=None):
             super(ManyRelatedManager, self).__init__()
             self.core_filters = core_filters
+            self.query_field_name = query_field_name
+            self.prefetch_cache_name = prefetch_cache_name
             self.model = model
             self.symmetrical = symmetrical
             self.instance = instance
@@ -480,8 +500,28 @@ def create_many_related_manager(superclass, rel=False):
                 raise ValueError("%r instance needs to have a primary key value before a many-to-many relationship can be used." % instance.__class__.__name__)
 
         def get_query_set(self):
-            db = self._db or router.db_for_read(self.instance.__class__, instance=self.instance)
-            return superclass.get_query_set(self).using(db)._next_is_sticky().filter(**(self.core_filters))
+            try:
+                return self.instance._prefetched_objects_cache[self.prefetch_cache_name]
+            except (AttributeError, KeyError):
+                db = self._db or router.db_for_read(self.instance.__class__, instance=self.instance)
+                return superclass.get_query_set(self).using(db)._next_is_sticky().filter(**(self.core_filters))
+
+        def get_prefetch_query_set(self, instances):
+            """
+            Query for the related objects of all the instances (see
+            QuerySet.prefetch_related). The source instance of each object
+            is selected from the join table as '_prefetch_related_val'.
+            """
+            db = self._db or router.db_for_read(self.instance.__class__, instance=instances[0])
+            query = {'%s__pk__in' % self.query_field_name:
+                     list(set([obj._get_pk_val() for obj in instances]))}
+            qs = superclass.get_query_set(self).using(db)._next_is_sticky().filter(**query)
+            source_field = self.through._meta.get_field(self.source_field_name)
+            qn = connections[db].ops.quote_name
+            qs = qs.extra(select={'_prefetch_related_val':
+                                  '%s.%s' % (qn(self.through._meta.db_table), qn(source_field.column))})
+            return (qs, attrgetter('_prefetch_related_val'),
+                    attrgetter(self.instance._meta.pk.attname), self.prefetch_cache_name)
 
         # If the ManyToMany relation has an intermediary model,
         # the add and remove methods do not exist.
@@ -661,7 +701,9 @@ class ManyRelatedObjectsDescriptor(object):
             symmetrical=False,
             source_field_name=self.related.field.m2m_reverse_field_name(),
             target_field_name=self.related.field.m2m_field_name(),
-            reverse=True
+            reverse=True,
+            query_field_name=self.related.field.name,
+            prefetch_cache_name=self.related.get_accessor_name()
         )
 
         return manager
@@ -713,7 +755,9 @@ class ReverseManyRelatedObjectsDescriptor(object):
             symmetrical=self.field.rel.symmetrical,
             source_field_name=self.field.m2m_field_name(),
             target_field_name=self.field.m2m_reverse_field_name(),
-            reverse=False
+            reverse=False,
+            query_field_name=self.field.related_query_name(),
+            prefetch_cache_name=self.field.name
         )
 
         return manager
@@ -6,9 +6,10 @@ from itertools import izip
 
 from django.db import connections, router, transaction, IntegrityError
 from django.db.models.aggregates import Aggregate
-from django.db.models.fields import DateField
+from django.db.models.fields import AutoField, DateField
 from django.db.models.query_utils import Q, select_related_descend, CollectedObjects, CyclicDependency, deferred_class_factory, InvalidQuery
 from django.db.models import signals, sql
+from django.db.models.sql.constants import LOOKUP_SEP
 from django.utils.copycompat import deepcopy
 
 # Used to control how many objects are worked with at once in some cases (e.g.
@@ -35,6 +36,8 @@ class QuerySet(object):
         self._iter = None
         self._sticky_filter = False
         self._for_write = False
+        self._prefetch_related_lookups = []
+        self._prefetch_done = False
 
     ########################
     # PYTHON MAGIC METHODS #
@@ -80,9 +83,15 @@ class QuerySet(object):
                 self._result_cache = list(self.iterator())
         elif self._iter:
             self._result_cache.extend(list(self._iter))
+        if self._prefetch_related_lookups and not self._prefetch_done:
+            self._prefetch_related_objects()
         return len(self._result_cache)
 
     def __iter__(self):
+        if self._prefetch_related_lookups and not self._prefetch_done:
+            # Prefetching needs all the results at once; __len__ fills the
+            # cache and does the prefetch.
+            len(self)
         if self._result_cache is None:
             self._iter = self.iterator()
             self._result_cache = []
@@ -358,6 +367,96 @@ class QuerySet(object):
         obj.save(force_insert=True, using=self.db)
         return obj
 
+    def bulk_create(self, objs, batch_size=None, raw=False):
+        """
+        Inserts the given unsaved instances with multi-row INSERT statements
+        (at most 'batch_size' rows each) and returns them as a list. Every
+        table of a multi-table inheritance chain gets its own statements,
+        parents first, so the primary keys must be known before the insert:
+        UUIDField and other pre_save() generated keys are filled in as by
+        save(), AutoField keys of parent models have to be set explicitly
+        and AutoField keys of plain models are not read back.
+
+        The model's save() method is not called and no pre_save/post_save
+        signals are sent. If 'raw' is True, field values are inserted as
+        they are, without pre_save() (auto_now_add, generated keys), like
+        in a raw save of fixtures.
+        """
+        objs = list(objs)
+        if not objs:
+            return objs
+        assert batch_size is None or batch_size > 0, \
+                "bulk_create() batch_size must be positive."
+        for parent in self.model._meta.get_parent_list():
+            if isinstance(parent._meta.auto_field, AutoField) and \
+                    [obj for obj in objs if obj._get_pk_val(parent._meta) is None]:
+                raise ValueError("bulk_create() can't insert %s objects without primary keys "
+                                 "of the parent model %s." % (self.model._meta.object_name,
+                                                              parent._meta.object_name))
+        self._for_write = True
+        using = self.db
+        if not transaction.is_managed(using=using):
+            transaction.enter_transaction_management(using=using)
+            forced_managed = True
+        else:
+            forced_managed = False
+        try:
+            self._bulk_insert(self.model, objs, batch_size, raw, using)
+            if forced_managed:
+                transaction.commit(using=using)
+            else:
+                transaction.commit_unless_managed(using=using)
+        finally:
+            if forced_managed:
+                transaction.leave_transaction_management(using=using)
+        for obj in objs:
+            obj._state.db = using
+            obj._state.adding = False
+        return objs
+
+    def _bulk_insert(self, cls, objs, batch_size, raw, using):
+        """
+        Inserts the rows of 'objs' into the table of the model 'cls' and,
+        before that, of its parents (the same way as Model.save_base()).
+        """
+        meta = cls._meta
+        if not raw or meta.proxy:
+            for parent, field in meta.parents.items():
+                if field:
+                    for obj in objs:
+                        if getattr(obj, parent._meta.pk.attname) is None and \
+                                getattr(obj, field.attname) is not None:
+                            setattr(obj, parent._meta.pk.attname, getattr(obj, field.attname))
+                self._bulk_insert(parent, objs, batch_size, raw, using)
+                if field:
+                    for obj in objs:
+                        setattr(obj, field.attname, obj._get_pk_val(parent._meta))
+            if meta.proxy:
+                return
+
+        connection = connections[using]
+        if isinstance(meta.auto_field, AutoField):
+            with_pk = [obj for obj in objs if obj._get_pk_val(meta) is not None]
+            without_pk = [obj for obj in objs if obj._get_pk_val(meta) is None]
+            groups = [(meta.local_fields, with_pk),
+                      ([f for f in meta.local_fields if not isinstance(f, AutoField)], without_pk)]
+        else:
+            groups = [(meta.local_fields, objs)]
+        for fields, group in groups:
+            if not group:
+                continue
+            rows = [[f.get_db_prep_save(raw and getattr(obj, f.attname) or f.pre_save(obj, True),
+                                        connection=connection) for f in fields]
+                    for obj in group]
+            if connection.features.has_bulk_insert:
+                size = min(batch_size or len(rows), connection.ops.bulk_batch_size(fields, rows))
+            else:
+                size = 1
+            for start in xrange(0, len(rows), size):
+                query = sql.InsertQuery(cls)
+                query.insert_rows(fields, rows[start:start + size])
+                query.get_compiler(using=using).execute_sql()
+
     def get_or_create(self, **kwargs):
         """
         Looks up an object with the given kwargs, creating one if necessary.
@@ -613,6 +712,23 @@ class QuerySet(object):
             obj.query.max_depth = depth
         return obj
 
+    def prefetch_related(self, *lookups):
+        """
+        Returns a new QuerySet instance that will prefetch the specified
+        reverse ForeignKey and ManyToMany related objects (optionally through
+        forward ForeignKey/OneToOne fields, e.g. 'burial__ordercomments_set')
+        when it is evaluated: one query per relation for all the objects.
+
+        When prefetch_related() is called with None, the list of lookups to
+        prefetch is cleared.
+        """
+        clone = self._clone()
+        if lookups == (None,):
+            clone._prefetch_related_lookups = []
+        else:
+            clone._prefetch_related_lookups.extend(lookups)
+        return clone
+
     def dup_select_related(self, other):
         """
         Copies the related selection status from the QuerySet 'other' to the
@@ -761,6 +877,8 @@ class QuerySet(object):
             query.filter_is_sticky = True
         c = klass(model=self.model, query=query, using=self._db)
         c._for_write = self._for_write
+        if not issubclass(klass, (ValuesQuerySet, DateQuerySet)):
+            c._prefetch_related_lookups = self._prefetch_related_lookups[:]
         c.__dict__.update(kwargs)
         if setup and hasattr(c, '_setup_query'):
             c._setup_query()
@@ -778,6 +896,11 @@ class QuerySet(object):
             except StopIteration:
                 self._iter = None
 
+    def _prefetch_related_objects(self):
+        # This method can only be called once the result cache has been filled.
+        prefetch_related_objects(self._result_cache, self._prefetch_related_lookups)
+        self._prefetch_done = True
+
     def _next_is_sticky(self):
         """
         Indicates that the next filter call and the one following that should
@@ -1516,3 +1639,95 @@ def insert_query(model, values, return_id=False, raw_values=False, using=None):
     query = sql.InsertQuery(model)
     query.insert_values(values, raw_values)
     return query.get_compiler(using=using).execute_sql(return_id)
+
+
+def prefetch_related_objects(result_cache, related_lookups):
+    """
+    Populates prefetched object caches for a list of results from a
+    QuerySet. Each lookup is a '__' separated path of attribute names:
+    reverse ForeignKey and ManyToMany managers are loaded with a single
+    query per level and cached on the instances (see
+    _prefetched_objects_cache), forward ForeignKey/OneToOne fields on the
+    way are loaded with a single IN query as well.
+    """
+    from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor
+
+    if not result_cache:
+        return
+    done_lookups = set()
+    for lookup in related_lookups:
+        if lookup in done_lookups:
+            continue
+        done_lookups.add(lookup)
+        obj_list = result_cache
+        for attr in lookup.split(LOOKUP_SEP):
+            if not obj_list:
+                break
+            descriptor = getattr(obj_list[0].__class__, attr, None)
+            if descriptor is None:
+                raise AttributeError("Cannot find '%s' on %s object, '%s' is an invalid "
+                                     "parameter to prefetch_related()" %
+                                     (attr, obj_list[0].__class__.__name__, lookup))
+            if isinstance(descriptor, ReverseSingleRelatedObjectDescriptor):
+                obj_list = prefetch_forward_objects(obj_list, descriptor.field)
+                continue
+            manager = getattr(obj_list[0], attr)
+            if not hasattr(manager, 'get_prefetch_query_set'):
+                raise ValueError("'%s' does not resolve to a reverse ForeignKey or ManyToMany "
+                                 "manager, '%s' is an invalid parameter to prefetch_related()" %
+                                 (attr, lookup))
+            obj_list = prefetch_one_level(obj_list, manager)
+
+
+def prefetch_forward_objects(instances, field):
+    """
+    Loads the objects referenced by the ForeignKey 'field' of all the
+    instances with a single query and puts them into the field cache.
+    Returns the list of the related objects.
+    """
+    cache_name = field.get_cache_name()
+    rel_field = field.rel.get_related_field()
+    vals = set([getattr(obj, field.attname) for obj in instances
+                if not hasattr(obj, cache_name) and getattr(obj, field.attname) is not None])
+    rel_objs = {}
+    if vals:
+        db = router.db_for_read(field.rel.to, instance=instances[0])
+        qs = field.rel.to._base_manager.using(db).filter(**{'%s__in' % field.rel.field_name: list(vals)})
+        for rel_obj in qs:
+            rel_objs[getattr(rel_obj, rel_field.attname)] = rel_obj
+    result = []
+    for obj in instances:
+        if not hasattr(obj, cache_name):
+            rel_obj = rel_objs.get(getattr(obj, field.attname))
+            if rel_obj is None:
+                # Leave the descriptor to handle missing objects as usual.
+                continue
+            setattr(obj, cache_name, rel_obj)
+        rel_obj = getattr(obj, cache_name)
+        if rel_obj is not None:
+            result.append(rel_obj)
+    return result
+
+
+def prefetch_one_level(instances, manager):
+    """
+    Runs the prefetch query of the related 'manager' for all the instances
+    and stores the results in the instances' _prefetched_objects_cache.
+    Returns the list of all the related objects.
+    """
+    rel_qs, rel_obj_attr, instance_attr, cache_name = manager.get_prefetch_query_set(instances)
+    all_related_objects = list(rel_qs)
+    rel_obj_cache = {}
+    for rel_obj in all_related_objects:
+        rel_obj_cache.setdefault(rel_obj_attr(rel_obj), []).append(rel_obj)
+    for obj in instances:
+        qs = getattr(obj, cache_name).all()
+        if getattr(qs, '_prefetch_done', False) and qs._result_cache is not None:
+            # Already prefetched by an earlier lookup.
+            continue
+        qs._result_cache = rel_obj_cache.get(instance_attr(obj), [])
+        qs._prefetch_done = True
+        if not hasattr(obj, '_prefetched_objects_cache'):
+            obj._prefetched_objects_cache = {}
+        obj._prefetched_objects_cache[cache_name] = qs
+    return all_related_objects
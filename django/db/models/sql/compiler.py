@@ -773,6 +773,11 @@ class SQLInsertCompiler(SQLCompiler):
         opts = self.query.model._meta
         result = ['INSERT INTO %s' % qn(opts.db_table)]
         result.append('(%s)' % ', '.join([qn(c) for c in self.query.columns]))
+        if self.query.rows:
+            rows = ['(%s)' % ', '.join([self.placeholder(*v) for v in row])
+                    for row in self.query.rows]
+            result.append('VALUES %s' % ', '.join(rows))
+            return ' '.join(result), self.query.params
         values = [self.placeholder(*v) for v in self.query.values]
         result.append('VALUES (%s)' % ', '.join(values))
         params = self.query.params
@@ -144,12 +144,14 @@ class InsertQuery(Query):
         super(InsertQuery, self).__init__(*args, **kwargs)
         self.columns = []
         self.values = []
+        self.rows = []
         self.params = ()
 
     def clone(self, klass=None, **kwargs):
         extras = {
             'columns': self.columns[:],
             'values': self.values[:],
+            'rows': self.rows[:],
             'params': self.params
         }
         extras.update(kwargs)
@@ -176,6 +178,19 @@ class InsertQuery(Query):
             self.params += tuple(values)
             self.values.extend(placeholders)
 
+    def insert_rows(self, fields, rows):
+        """
+        Set up a multi-row insert query: 'fields' are the model fields to
+        insert and 'rows' are the lists of their (prepared) values, one list
+        per row.
+        """
+        self.columns = [f.column for f in fields]
+        params = []
+        for row in rows:
+            self.rows.append(zip(fields, row))
+            params.extend(row)
+        self.params = tuple(params)
+
 class DateQuery(Query):
     """
     A DateQuery is a normal query, except that it specifically selects a single
@@ -81,6 +81,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'common.middleware.PrincipalMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     #'pagination.middleware.PaginationMiddleware',
     'common.middleware.NoCacheMiddleware',
@@ -137,6 +138,62 @@ CSV_ENCODING = "utf8"
 PAGINATION_USER_PER_PAGE_MAX = 50
 PAGINATION_PER_PAGE = 5
 
+# Индекс для поиска по подстроке: "table" - таблица n-грамм (common.SearchGram),
+# "pg_trgm" - GIN-индексы PostgreSQL (см. contrib/pg_upgrade.sql).
+SEARCH_NGRAM_INDEX = "table"
+
+# Кэш количества найденных записей (common.counts): время жизни, сек.
+# Сброс - через счетчик изменений в базе, поэтому он виден всем процессам
+# при любом CACHE_BACKEND.
+SEARCH_COUNT_CACHE_TIMEOUT = 300
+# Больше скольки записей в таблице на первой странице показывать оценку
+# PostgreSQL ("≈N") вместо точного COUNT.
+SEARCH_COUNT_ESTIMATE_THRESHOLD = 100000
+
+# Сколько строк печатать за раз (главная страница, print=1); дальше -
+# ссылка "Продолжить печать".
+PRINT_MAX_ROWS = 2000
+
+# Как часто (сек) процесс проверяет, не устарел ли индекс подсказок
+# (common.autocomplete).
+AUTOCOMPLETE_CHECK_INTERVAL = 5
+
+# Загруженные файлы импорта и отчеты заданий импорта (common.ImportJob).
+# Вне MEDIA_ROOT: /media/ отдается nginx без авторизации.
+IMPORT_ROOT = os.path.join(ROOT_PATH, 'imports')
+
+# Процессов на одно задание импорта (manage.py run_import_jobs). Больше
+# одного - только с PostgreSQL, см. common.importer.ParallelImporter.
+IMPORT_PROCESSES = 1
+
+# Способ импорта: "orm" - порциями через ORM (common.importer.CsvImporter),
+# "copy" - COPY во временную таблицу и запросы над всем файлом
+# (common.pgimport.PgCopyImporter, только PostgreSQL; на других базах
+# импортирует ORM).
+IMPORT_BACKEND = "orm"
+
+# Каталог выгрузки изменений для синхронизации серверов (manage.py
+# export_changes).
+OUTBOX_DIR = "/var/cemetery/outbox/"
+# Каталог принятых выгрузок других серверов (manage.py apply_inbox).
+INBOX_DIR = "/var/cemetery/inbox/"
+
+# Выгрузки реестра для терминалов (manage.py export_terminals): реестр
+# читается один раз и пишется во все файлы. Ключи выгрузки:
+#   path - файл (пишется в path.partial и переименовывается);
+#   encoding - кодировка, по умолчанию cp1251;
+#   upper - фамилия и инициалы заглавными буквами;
+#   columns - столбцы из uuid, last_name, initials, date, area, row, seat,
+#     cemetery;
+#   dialect - параметры csv.writer, по умолчанию разделитель - табуляция;
+#   cemeteries - uuid кладбищ, None - все кладбища.
+# Например, для Восточного: {"path": ..., "upper": True,
+# "dialect": {"delimiter": " ", "quotechar": '"', "quoting": csv.QUOTE_ALL}},
+# для Колодищ без столбца cemetery.
+TERMINAL_EXPORTS = (
+    {"path": "/var/cemetery/terminal/export.csv"},
+)
+
 TEMPLATE_CONTEXT_PROCESSORS = (
     # default
     #
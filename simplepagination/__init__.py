@@ -91,17 +91,29 @@ class SimplePaginator(object):
         except KeyError:
             raise KeyError("Key '%s' not found in view's returned dictionary" % self.key)
 
-        # create django built in paginator object
-        paginator = Paginator(paginate_qs, per_page)
-        
+        # view may pass already known number of items as '<key>_count'.
+        count = output.pop('%s_count' % self.key, None)
+
+        # backend may select items of the page by itself (keyset pagination),
+        # otherwise django built in paginator object is used.
+        paginate_objects = getattr(self.backend, 'paginate_objects', None)
         try:
-            # check that asked page is exists
-            page = paginator.page(current_page)
+            if paginate_objects is not None:
+                object_list, number_of_pages, extra = paginate_objects(paginate_qs, per_page,
+                                                                       current_page, params, count)
+            else:
+                paginator = Paginator(paginate_qs, per_page)
+                if count is not None:
+                    paginator._count = count
+                # check that asked page is exists
+                object_list = paginator.page(current_page).object_list
+                number_of_pages = paginator.num_pages
+                extra = {}
         except EmptyPage:
             raise Http404()
 
         # replace paginated items by only items we should see.
-        output[self.key] = page.object_list
+        output[self.key] = object_list
         
         # extra data that we may need to build links
         data = {}
@@ -109,8 +121,9 @@ class SimplePaginator(object):
         data['per_page'] = per_page # items per page
         data['params'] = unicode_urlencode(params) # get parameters
         data['anchor'] = self.anchor # ancor
-        data['number_of_pages'] = number_of_pages = paginator.num_pages # number of pages
+        data['number_of_pages'] = number_of_pages # number of pages
         data['template'] = self.template
+        data.update(extra)
 
         # execute the pagination function
         data.update(self.backend.paginate(self.frame_size, number_of_pages, current_page))
@@ -0,0 +1,209 @@
+import base64
+from math import ceil
+
+from django.core.paginator import EmptyPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.utils import simplejson
+
+from simplepagination.backends import Paginator
+
+
+class KeysetPaginator(Paginator):
+    """
+    Keyset (seek) pagination.
+
+    Next/previous links carry the sort key of the last/first row of the
+    current page ('after'/'before' GET parameters), so the next page is
+    fetched with WHERE (sort key) > (cursor) ... LIMIT per_page instead of
+    OFFSET and costs the same on any depth. Primary key is always appended
+    to the ordering to make the sort key unique.
+
+    Page numbers are kept in links for the digg-style template. Pages near
+    the beginning and near the end of the list can be opened by number:
+    they are read with a small OFFSET from the nearest end.
+    """
+
+    AFTER = 'after'
+    BEFORE = 'before'
+
+    def paginate(self, frame_size, number_of_pages, current_page):
+        output = {}
+        if current_page > 1:
+            output['PREVIOUS'] = current_page - 1
+        if current_page < number_of_pages:
+            output['NEXT'] = current_page + 1
+        edge = max(frame_size / 2, 1)
+        if number_of_pages <= frame_size:
+            output['left_page_numbers'] = range(1, number_of_pages + 1)
+        else:
+            output['left_page_numbers'] = range(1, edge + 1)
+            output['right_page_numbers'] = range(number_of_pages - edge + 1, number_of_pages + 1)
+            if edge < current_page <= number_of_pages - edge:
+                output['middle_page_numbers'] = [current_page]
+        return output
+
+    def paginate_objects(self, queryset, per_page, current_page, params, count=None):
+        """
+        Returns objects of the current page, number of pages and extra
+        data for the template (cursors of the previous and next pages).
+        Cursor parameters are removed from params. Number of objects is
+        counted unless given.
+        """
+        after = self.decode(params.pop(self.AFTER, [None])[0])
+        before = self.decode(params.pop(self.BEFORE, [None])[0])
+
+        ordering = self.ordering(queryset)
+        if count is None:
+            count = queryset.count()
+        number_of_pages = max(int(ceil(count / float(per_page))), 1)
+        if current_page < 1 or current_page > number_of_pages:
+            raise EmptyPage()
+
+        nulls_large = self.nulls_large(queryset)
+        if after is not None:
+            qs = queryset.filter(self.seek(ordering, after, nulls_large))
+            object_list = list(qs.order_by(*ordering)[:per_page])
+        elif before is not None:
+            backward = [self.flip(o) for o in ordering]
+            qs = queryset.filter(self.seek(backward, before, nulls_large))
+            object_list = list(qs.order_by(*backward)[:per_page])
+            object_list.reverse()
+        else:
+            # read the page by number from the nearest end of the list
+            start = (current_page - 1) * per_page
+            stop = min(start + per_page, count)
+            if start <= count - stop:
+                object_list = list(queryset.order_by(*ordering)[start:stop])
+            else:
+                backward = [self.flip(o) for o in ordering]
+                object_list = list(queryset.order_by(*backward)[count - stop:count - start])
+                object_list.reverse()
+
+        extra = {}
+        if object_list:
+            keys = self.keys(queryset, ordering, [object_list[0].pk, object_list[-1].pk])
+            extra['previous_cursor'] = self.encode(keys[object_list[0].pk])
+            extra['next_cursor'] = self.encode(keys[object_list[-1].pk])
+        return object_list, number_of_pages, extra
+
+    def ordering(self, queryset):
+        """
+        Explicit ordering of the queryset with primary key at the end.
+        """
+        query = queryset.query
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering:
+            ordering = list(query.model._meta.ordering)
+        else:
+            ordering = []
+        ordering = [o for o in ordering if o != '?']
+        if not ordering or ordering[-1].lstrip('-') not in ('pk', query.model._meta.pk.name):
+            ordering.append('pk')
+        return ordering
+
+    def chunks(self, queryset, size, after=None):
+        """
+        Iterates over the whole queryset in lists of 'size' objects with
+        the same seek condition as the page links, starting after the sort
+        key 'after' (see sort_key) if given.
+        """
+        ordering = self.ordering(queryset)
+        nulls_large = self.nulls_large(queryset)
+        queryset = queryset.order_by(*ordering)
+        while True:
+            qs = queryset
+            if after is not None:
+                qs = qs.filter(self.seek(ordering, after, nulls_large))
+            objects = list(qs[:size])
+            if objects:
+                yield objects
+            if len(objects) < size:
+                break
+            after = self.sort_key(queryset, objects[-1])
+
+    def has_more(self, queryset, after):
+        """
+        Are there objects after the sort key 'after'?
+        """
+        ordering = self.ordering(queryset)
+        return queryset.filter(self.seek(ordering, after, self.nulls_large(queryset))).exists()
+
+    def sort_key(self, queryset, obj):
+        """
+        Sort key values of the object (a cursor before encoding).
+        """
+        ordering = self.ordering(queryset)
+        fields = [o.lstrip('-') for o in ordering]
+        if [f for f in fields if LOOKUP_SEP in f]:
+            return self.keys(queryset, ordering, [obj.pk])[obj.pk]
+        opts = queryset.model._meta
+        return [f == 'pk' and obj.pk or getattr(obj, opts.get_field(f).attname) for f in fields]
+
+    def keys(self, queryset, ordering, pks):
+        """
+        Sort key values of the rows with given primary keys.
+        """
+        fields = [o.lstrip('-') for o in ordering]
+        rows = queryset.model._default_manager.using(queryset.db) \
+            .filter(pk__in=pks).values_list(*fields)
+        return dict([(row[-1], list(row)) for row in rows])
+
+    def flip(self, order):
+        if order.startswith('-'):
+            return order[1:]
+        return '-%s' % order
+
+    def nulls_large(self, queryset):
+        """
+        PostgreSQL sorts NULL after all values, SQLite and MySQL before.
+        """
+        engine = connections[queryset.db].settings_dict['ENGINE']
+        return 'postgresql' in engine
+
+    def seek(self, ordering, values, nulls_large):
+        """
+        Condition "sort key goes after values in the given ordering":
+        (f1 > v1) OR (f1 = v1 AND f2 > v2) OR ...
+        """
+        condition = None
+        equal = Q()
+        for order, value in zip(ordering, values):
+            field = order.lstrip('-')
+            ascending = not order.startswith('-')
+            # NULL goes at the end of this ordering
+            nulls_last = ascending == nulls_large
+            if value is None:
+                greater = not nulls_last and Q(**{'%s__isnull' % field: False}) or None
+                same = Q(**{'%s__isnull' % field: True})
+            else:
+                lookup = ascending and 'gt' or 'lt'
+                greater = Q(**{'%s__%s' % (field, lookup): value})
+                if nulls_last and field != 'pk':
+                    greater |= Q(**{'%s__isnull' % field: True})
+                same = Q(**{field: value})
+            if greater is not None:
+                greater = equal & greater
+                condition = condition is None and greater or condition | greater
+            equal &= same
+        if condition is None:
+            # nothing goes after the last row
+            condition = Q(pk__in=[])
+        return condition
+
+    def encode(self, values):
+        return base64.urlsafe_b64encode(simplejson.dumps(values, cls=DjangoJSONEncoder))
+
+    def decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError, UnicodeError):
+            return None
+        if not isinstance(values, list):
+            return None
+        return values
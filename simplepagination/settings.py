@@ -5,9 +5,11 @@ from django.conf import settings
 # Class must have 'paginate' function inside that receive 3 parameters                                       #
 # frame_size, number_of_pages and current_page_number                                                        #
 # this function must return dictionary that will be added to view dictionary under key 'paginator'           #
+# Class may also have 'paginate_objects' function that selects items of the page by itself (see keyset).     #
 PAGINATION_BACKENDS = getattr(settings, 'PAGINATION_BACKENDS', {                                             #
     'digg': 'simplepagination.backends.digg.DiggPaginator',                                                  #
     'filmfeed': 'simplepagination.backends.filmfeed.FilmfeedPaginator',                                      #
+    'keyset': 'simplepagination.backends.keyset.KeysetPaginator',                                            #
 })                                                                                                           #
 ##############################################################################################################
 
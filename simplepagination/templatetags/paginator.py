@@ -11,3 +11,12 @@ def page_link(page_number, params, anchor):
     if anchor:
         link += '#%s' % anchor
     return link
+
+@register.simple_tag
+def cursor_link(page_number, cursor_name, cursor, params, anchor):
+    link = '?page=%s&amp;%s=%s' % (page_number, cursor_name, cursor)
+    if params:
+        link = '%s&amp;%s' % (link, params.replace('&', '&amp;'))
+    if anchor:
+        link += '#%s' % anchor
+    return link
@@ -33,6 +33,9 @@ urlpatterns = patterns('',
     (r'^orderfilecomment/(.{36})/$', 'common.views.order_filecomment_edit'),
     (r'^management/$', 'common.views.management'),
     (r'^management/import/$', 'common.views.import_csv'),
+    (r'^management/import/(.{36})/$', 'common.views.import_job'),
+    (r'^management/import/(.{36})/status/$', 'common.views.import_job_status'),
+    (r'^management/import/(.{36})/report/$', 'common.views.import_job_report'),
     (r'^management/user/$', 'common.views.management_user'),
     (r'^management/user/edit/(.{36})/$', 'common.views.management_edit_user'),
     (r'^management/cemetery/$', 'common.views.management_cemetery'),
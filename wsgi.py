@@ -14,3 +14,7 @@ sys.path.insert(0, os.path.dirname(__file__))
 
 import django.core.handlers.wsgi
 application = django.core.handlers.wsgi.WSGIHandler()
+
+# Индекс подсказок для полей поиска строится при запуске процесса.
+from common import autocomplete
+autocomplete.warm()